@@ -0,0 +1,227 @@
+import json
+import boto3
+import redis
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from inbox import update_inbox_row
+from message_cache import get_redis_client, invalidate_participants, unread_counts_key, UNREAD_COUNTS_TTL
+
+# Initialize AWS clients
+sns = boto3.client('sns')
+
+# Environment variables
+GROUP_NOTIFICATIONS_TOPIC = os.environ.get('GROUP_NOTIFICATIONS_TOPIC', '')
+USER_CONVERSATIONS_TABLE = os.environ.get('USER_CONVERSATIONS_TABLE', '')
+IO_CONCURRENCY = max(1, int(os.environ.get('IO_CONCURRENCY', '16')))
+PUBLISH_BATCH_MAX_RETRIES = int(os.environ.get('PUBLISH_BATCH_MAX_RETRIES', '3'))
+
+# PublishBatch accepts at most 10 entries per call
+PUBLISH_BATCH_MAX_ENTRIES = 10
+
+# Worker pool and per-thread resources reused across warm invocations
+_executor = ThreadPoolExecutor(max_workers=IO_CONCURRENCY)
+_thread_local = threading.local()
+
+def handler(event, context):
+    """
+    Fan group messages out to their recipients. Each SQS record is one job
+    holding a chunk of recipients of a single message. The queue is FIFO
+    per conversation and chunk: once a job fails, the later jobs of its
+    message group are left for the retry so they stay in order.
+    """
+    records = event['Records']
+    failed_message_ids = set()
+
+    jobs = {}
+    for record in records:
+        try:
+            jobs[record['messageId']] = json.loads(record['body'])
+        except Exception as e:
+            print(f"Error parsing fan-out job {record.get('messageId')}: {str(e)}")
+            failed_message_ids.add(record['messageId'])
+
+    # Move the conversation up in every recipient's inbox first; the writes
+    # are conditional, so a retried job repeats them safely
+    failed_message_ids.update(update_inboxes(jobs))
+    failed_message_ids = with_group_followers(records, failed_message_ids)
+
+    # Notify the recipients of every chunk, in queue order
+    job_ids = list(jobs)
+    for i in range(0, len(job_ids), PUBLISH_BATCH_MAX_ENTRIES):
+        chunk = {
+            job_id: jobs[job_id] for job_id in job_ids[i:i + PUBLISH_BATCH_MAX_ENTRIES]
+            if job_id not in failed_message_ids
+        }
+        if chunk:
+            failed_message_ids.update(publish_jobs(chunk))
+            failed_message_ids = with_group_followers(records, failed_message_ids)
+
+    # Count the message as unread for every notified recipient; best effort,
+    # a retry would count it twice
+    increment_unread_counters([job for job_id, job in jobs.items() if job_id not in failed_message_ids])
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps(f'Fanned out {len(records) - len(failed_message_ids)} of {len(records)} jobs'),
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]
+    }
+
+def with_group_followers(records, failed_message_ids):
+    """
+    Add every record after a failed one in the same FIFO message group to
+    the failed records, so the group is retried in order
+    """
+    failed = set(failed_message_ids)
+    failed_groups = set()
+
+    for record in records:
+        group_id = record.get('attributes', {}).get('MessageGroupId')
+        if record['messageId'] in failed or (group_id is not None and group_id in failed_groups):
+            failed.add(record['messageId'])
+            if group_id is not None:
+                failed_groups.add(group_id)
+
+    return failed
+
+def get_dynamodb():
+    """Return the DynamoDB resource of the current thread (resources are not thread safe)"""
+    if not hasattr(_thread_local, 'dynamodb'):
+        _thread_local.dynamodb = boto3.session.Session().resource('dynamodb')
+    return _thread_local.dynamodb
+
+def write_inbox_row(user_id, job):
+    """Update one recipient's inbox row with the thread's DynamoDB resource"""
+    return update_inbox_row(
+        get_dynamodb().Table(USER_CONVERSATIONS_TABLE),
+        user_id, job['conversation_id'], job['timestamp'], job.get('preview', '')
+    )
+
+def update_inboxes(jobs):
+    """
+    Copy each job's message activity onto its recipients' user_conversations
+    rows on the worker pool. Returns the SQS message IDs of jobs whose rows
+    could not all be updated.
+    """
+    futures = [
+        (job_id, _executor.submit(write_inbox_row, user_id, job))
+        for job_id, job in jobs.items()
+        for user_id in job['recipient_ids']
+    ]
+
+    failed_job_ids = set()
+    for job_id, future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Error updating inbox row for fan-out job {job_id}: {str(e)}")
+            failed_job_ids.add(job_id)
+
+    return failed_job_ids
+
+def build_publish_entry(entry_id, job):
+    """Build a PublishBatch entry notifying the recipients of a job"""
+    notification = {key: value for key, value in job.items() if key != 'chunk_index'}
+
+    entry = {
+        'Id': entry_id,
+        'Message': json.dumps(notification),
+        'MessageAttributes': {
+            'conversation_id': {
+                'DataType': 'String',
+                'StringValue': job['conversation_id']
+            },
+            'message_type': {
+                'DataType': 'String',
+                'StringValue': job['message_type']
+            }
+        }
+    }
+
+    if GROUP_NOTIFICATIONS_TOPIC.endswith('.fifo'):
+        entry['MessageGroupId'] = job['conversation_id']
+        entry['MessageDeduplicationId'] = f"{job['message_id']}-{job['chunk_index']}"
+
+    return entry
+
+def publish_jobs(jobs):
+    """
+    Publish up to 10 jobs with PublishBatch, retrying failed entries that are
+    not sender faults. Returns the SQS message IDs of jobs that failed.
+    """
+    failed_job_ids = set()
+    pending = dict(jobs)
+
+    attempt = 0
+    while pending:
+        try:
+            response = sns.publish_batch(
+                TopicArn=GROUP_NOTIFICATIONS_TOPIC,
+                PublishBatchRequestEntries=[build_publish_entry(job_id, job) for job_id, job in pending.items()]
+            )
+        except Exception as e:
+            print(f"Error publishing fan-out batch: {str(e)}")
+            failed_job_ids.update(pending)
+            break
+
+        retry = {}
+        for failure in response.get('Failed', []):
+            if failure.get('SenderFault'):
+                print(f"Fan-out job {failure['Id']} rejected: {failure.get('Code')} {failure.get('Message')}")
+                failed_job_ids.add(failure['Id'])
+            else:
+                retry[failure['Id']] = pending[failure['Id']]
+        pending = retry
+
+        if not pending:
+            break
+
+        attempt += 1
+        if attempt > PUBLISH_BATCH_MAX_RETRIES:
+            failed_job_ids.update(pending)
+            break
+
+        time.sleep(min(0.05 * (2 ** (attempt - 1)), 2))
+
+    return failed_job_ids
+
+def increment_unread_counters(jobs):
+    """Increment the unread counter of every recipient of the jobs in one pipeline"""
+    redis_client = get_redis_client()
+    if redis_client is None or not jobs:
+        return
+
+    pipe = redis_client.pipeline(transaction=False)
+    for job in jobs:
+        for user_id in job['recipient_ids']:
+            key = unread_counts_key(user_id)
+            pipe.hincrby(key, job['conversation_id'], 1)
+            pipe.expire(key, UNREAD_COUNTS_TTL)
+
+    try:
+        pipe.execute()
+    except redis.RedisError as e:
+        print(f"Error updating unread counters: {str(e)}")
+
+def invalidation_handler(event, context):
+    """
+    Drop cached participant sets when membership changes. Receives INSERT
+    and REMOVE records from the user_conversations stream.
+    """
+    conversation_ids = {
+        record['dynamodb']['Keys']['conversation_id']['S']
+        for record in event['Records']
+        if record.get('eventName') in ('INSERT', 'REMOVE')
+    }
+
+    redis_client = get_redis_client()
+    if redis_client is not None:
+        for conversation_id in conversation_ids:
+            invalidate_participants(redis_client, conversation_id)
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps(f'Invalidated participants of {len(conversation_ids)} conversations')
+    }
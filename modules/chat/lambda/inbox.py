@@ -0,0 +1,41 @@
+import base64
+import json
+
+# user_conversations GSI listing a user's conversations by recency
+INBOX_INDEX = 'InboxIndex'
+
+def update_inbox_row(user_conversations_table, user_id, conversation_id, timestamp, preview, create=False):
+    """
+    Copy a conversation's latest activity onto a participant's
+    user_conversations row. Rows whose activity is already newer are left
+    alone, and so are missing rows unless create is set (the sender's row).
+    Returns False when the row was left alone.
+    """
+    condition = 'attribute_not_exists(last_activity) OR last_activity < :timestamp'
+    if not create:
+        condition = f'attribute_exists(conversation_id) AND ({condition})'
+
+    try:
+        user_conversations_table.update_item(
+            Key={
+                'user_id': user_id,
+                'conversation_id': conversation_id
+            },
+            UpdateExpression='SET last_activity = :timestamp, last_message_preview = :preview',
+            ConditionExpression=condition,
+            ExpressionAttributeValues={
+                ':timestamp': timestamp,
+                ':preview': preview
+            }
+        )
+        return True
+    except user_conversations_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+def encode_cursor(last_evaluated_key):
+    """Opaque cursor for the next inbox page"""
+    return base64.urlsafe_b64encode(json.dumps(last_evaluated_key).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """ExclusiveStartKey from an inbox cursor"""
+    return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
@@ -0,0 +1,133 @@
+import gzip
+import json
+import os
+import time
+
+# Messages older than the hot window live in S3 as one gzipped JSON segment
+# per conversation and day, newest message first, plus a small per-
+# conversation index of the segments. message_archiver writes both before it
+# deletes the rows, so a message is always readable from one of the tiers.
+SEGMENT_KEY_PREFIX = 'segments/'
+INDEX_KEY_PREFIX = 'index/'
+
+# Seconds a container trusts a cached conversation index
+ARCHIVE_INDEX_CACHE_TTL = int(os.environ.get('ARCHIVE_INDEX_CACHE_TTL', '300'))
+
+# conversation_id -> (index, expiry), reused across warm invocations
+_indexes = {}
+
+def segment_key(conversation_id, day):
+    """S3 key of the archived messages of a conversation on one day"""
+    return f"{SEGMENT_KEY_PREFIX}{conversation_id}/{day}.json.gz"
+
+def index_key(conversation_id):
+    """S3 key of the segment index of a conversation"""
+    return f"{INDEX_KEY_PREFIX}{conversation_id}.json"
+
+def encode_segment(messages):
+    """Gzipped JSON of formatted messages, newest first"""
+    ordered = sorted(messages, key=lambda message: message['timestamp_message_id'], reverse=True)
+    return gzip.compress(json.dumps(ordered, separators=(',', ':')).encode('utf-8'))
+
+def decode_segment(body):
+    """Formatted messages of a segment, newest first"""
+    return json.loads(gzip.decompress(body))
+
+def read_segment(s3, bucket, conversation_id, day):
+    """Return the messages of a segment, or [] when it does not exist"""
+    try:
+        response = s3.get_object(Bucket=bucket, Key=segment_key(conversation_id, day))
+    except s3.exceptions.NoSuchKey:
+        return []
+    return decode_segment(response['Body'].read())
+
+def write_segment(s3, bucket, conversation_id, day, messages):
+    """Write a segment, merging in any messages archived for the day before"""
+    merged = {message['message_id']: message for message in read_segment(s3, bucket, conversation_id, day)}
+    merged.update((message['message_id'], message) for message in messages)
+    ordered = sorted(merged.values(), key=lambda message: message['timestamp_message_id'], reverse=True)
+
+    s3.put_object(
+        Bucket=bucket,
+        Key=segment_key(conversation_id, day),
+        Body=encode_segment(ordered),
+        ContentType='application/json',
+        ContentEncoding='gzip'
+    )
+
+    return {
+        'day': day,
+        'count': len(ordered),
+        'oldest': ordered[-1]['timestamp_message_id'],
+        'newest': ordered[0]['timestamp_message_id']
+    }
+
+def load_index(s3, bucket, conversation_id, use_cache=True):
+    """
+    Return the segment index of a conversation ({'segments': [...]},
+    newest day first), served from the container cache when fresh.
+    """
+    now = time.time()
+    cached = _indexes.get(conversation_id)
+    if use_cache and cached is not None and cached[1] > now:
+        return cached[0]
+
+    try:
+        response = s3.get_object(Bucket=bucket, Key=index_key(conversation_id))
+        index = json.loads(response['Body'].read())
+    except s3.exceptions.NoSuchKey:
+        index = {'segments': []}
+
+    _indexes[conversation_id] = (index, now + ARCHIVE_INDEX_CACHE_TTL)
+    return index
+
+def write_index(s3, bucket, conversation_id, segments):
+    """Merge segment summaries into the index of a conversation"""
+    index = load_index(s3, bucket, conversation_id, use_cache=False)
+
+    by_day = {segment['day']: segment for segment in index['segments']}
+    by_day.update((segment['day'], segment) for segment in segments)
+    index = {'segments': sorted(by_day.values(), key=lambda segment: segment['day'], reverse=True)}
+
+    s3.put_object(
+        Bucket=bucket,
+        Key=index_key(conversation_id),
+        Body=json.dumps(index, separators=(',', ':')).encode('utf-8'),
+        ContentType='application/json'
+    )
+    _indexes[conversation_id] = (index, time.time() + ARCHIVE_INDEX_CACHE_TTL)
+
+def read_archived_messages(s3, bucket, conversation_id, before, limit):
+    """
+    Return up to `limit` archived messages older than `before` (a
+    timestamp_message_id, or None for the newest), newest first, and
+    whether older archived messages exist.
+    """
+    index = load_index(s3, bucket, conversation_id)
+
+    # Archiving moves the oldest rows of the table, so messages archived
+    # since the index was cached are newer than every segment in it. The
+    # cached index is only trusted for pages inside the range it covers;
+    # the page right after the table runs out reloads it.
+    newest = index['segments'][0]['newest'] if index['segments'] else None
+    if before is None or newest is None or newest < before:
+        index = load_index(s3, bucket, conversation_id, use_cache=False)
+
+    segments = [
+        segment for segment in index['segments']
+        if before is None or segment['oldest'] < before
+    ]
+
+    messages = []
+    for position, segment in enumerate(segments):
+        older = [
+            message for message in read_segment(s3, bucket, conversation_id, segment['day'])
+            if before is None or message['timestamp_message_id'] < before
+        ]
+        remaining = limit - len(messages)
+        messages.extend(older[:remaining])
+
+        if len(messages) >= limit:
+            return messages, len(older) > remaining or position + 1 < len(segments)
+
+    return messages, False
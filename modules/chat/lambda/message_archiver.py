@@ -0,0 +1,237 @@
+import json
+import boto3
+import os
+import time
+from datetime import datetime, timezone, timedelta
+
+from message_archive import write_segment, write_index
+from message_cache import format_message
+from message_shards import SHARD_COUNT_ATTRIBUTE, partition_keys
+
+# Initialize AWS clients
+dynamodb = boto3.resource('dynamodb')
+s3 = boto3.client('s3')
+lambda_client = boto3.client('lambda')
+
+# Environment variables
+CHAT_MESSAGES_TABLE = os.environ['CHAT_MESSAGES_TABLE']
+CONVERSATIONS_TABLE = os.environ['CONVERSATIONS_TABLE']
+MESSAGE_ARCHIVE_BUCKET = os.environ['MESSAGE_ARCHIVE_BUCKET']
+# Messages older than this many days move from DynamoDB to S3
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '90'))
+BATCH_WRITE_MAX_RETRIES = int(os.environ.get('BATCH_WRITE_MAX_RETRIES', '5'))
+
+# BatchWriteItem accepts at most 25 put/delete requests per call
+BATCH_WRITE_MAX_ITEMS = 25
+
+# Hand the rest of the run to a fresh invocation below this much time left
+CONTINUATION_THRESHOLD_MS = 60 * 1000
+
+# Rows archived per step: written to S3 and deleted before the next are read
+ARCHIVE_PAGE_SIZE = int(os.environ.get('ARCHIVE_PAGE_SIZE', '1000'))
+
+def handler(event, context):
+    """
+    Move messages older than the hot window into per-conversation, per-day
+    S3 segments and delete the archived rows. Long runs continue in a new
+    asynchronous invocation from the last conversation scanned, finishing
+    first a conversation that was cut off part way.
+    """
+    try:
+        cutoff = event.get('cutoff') or (
+            datetime.now(timezone.utc) - timedelta(days=ARCHIVE_AFTER_DAYS)
+        ).isoformat()
+
+        archived = 0
+        failed_conversations = []
+
+        resume = event.get('resume_conversation')
+        if resume:
+            try:
+                count, complete = archive_conversation(
+                    resume['conversation_id'], int(resume['shard_count']), cutoff, context
+                )
+                archived += count
+                if not complete:
+                    continue_run(context, cutoff, event.get('exclusive_start_key'), resume)
+                    return run_result(cutoff, archived, failed_conversations)
+            except Exception as e:
+                print(f"Error archiving conversation {resume['conversation_id']}: {str(e)}")
+                failed_conversations.append(resume['conversation_id'])
+
+        conversations_table = dynamodb.Table(CONVERSATIONS_TABLE)
+        scan_kwargs = {
+            'ProjectionExpression': 'conversation_id, #shards',
+            'ExpressionAttributeNames': {'#shards': SHARD_COUNT_ATTRIBUTE}
+        }
+        if event.get('exclusive_start_key'):
+            scan_kwargs['ExclusiveStartKey'] = event['exclusive_start_key']
+
+        # Key of the last conversation finished, where a continuation resumes
+        last_key = event.get('exclusive_start_key')
+
+        while True:
+            response = conversations_table.scan(**scan_kwargs)
+
+            for conversation in response.get('Items', []):
+                conversation_id = conversation['conversation_id']
+                shard_count = int(conversation.get(SHARD_COUNT_ATTRIBUTE, 0))
+
+                if context.get_remaining_time_in_millis() < CONTINUATION_THRESHOLD_MS:
+                    continue_run(context, cutoff, last_key)
+                    return run_result(cutoff, archived, failed_conversations)
+
+                try:
+                    count, complete = archive_conversation(conversation_id, shard_count, cutoff, context)
+                    archived += count
+                    if not complete:
+                        continue_run(context, cutoff, {'conversation_id': conversation_id}, {
+                            'conversation_id': conversation_id,
+                            'shard_count': shard_count
+                        })
+                        return run_result(cutoff, archived, failed_conversations)
+                except Exception as e:
+                    # The rows stay in DynamoDB and are picked up by the next run
+                    print(f"Error archiving conversation {conversation_id}: {str(e)}")
+                    failed_conversations.append(conversation_id)
+
+                last_key = {'conversation_id': conversation_id}
+
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        return run_result(cutoff, archived, failed_conversations)
+
+    except Exception as e:
+        print(f"Error archiving messages: {str(e)}")
+        raise e
+
+def run_result(cutoff, archived, failed_conversations):
+    """Response summarizing the work of one invocation"""
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'cutoff': cutoff,
+            'archived_messages': archived,
+            'failed_conversations': failed_conversations
+        })
+    }
+
+def continue_run(context, cutoff, exclusive_start_key, resume_conversation=None):
+    """
+    Invoke this function asynchronously to resume the scan, after finishing
+    resume_conversation when one was cut off
+    """
+    payload = {
+        'cutoff': cutoff,
+        'exclusive_start_key': exclusive_start_key
+    }
+    if resume_conversation:
+        payload['resume_conversation'] = resume_conversation
+
+    lambda_client.invoke(
+        FunctionName=context.function_name,
+        InvocationType='Event',
+        Payload=json.dumps(payload)
+    )
+
+def archive_conversation(conversation_id, shard_count, cutoff, context):
+    """
+    Archive the messages of a conversation older than the cutoff, across
+    all of its partitions, ARCHIVE_PAGE_SIZE rows at a time: a page's
+    segments and index are written and its rows deleted before the next
+    page is read, so an interrupted run keeps its progress. Returns the
+    number of archived messages and whether the conversation is done; it
+    stops early when the invocation runs low on time.
+    """
+    archived = 0
+
+    for partition_key in partition_keys(conversation_id, shard_count):
+        while True:
+            if context.get_remaining_time_in_millis() < CONTINUATION_THRESHOLD_MS:
+                return archived, False
+
+            # Archived rows are deleted, so each query starts from the oldest left
+            items = query_older_items(partition_key, cutoff, ARCHIVE_PAGE_SIZE)
+            if items:
+                archive_page(conversation_id, items)
+                archived += len(items)
+
+            if len(items) < ARCHIVE_PAGE_SIZE:
+                break
+
+    return archived, True
+
+def archive_page(conversation_id, items):
+    """Write a page of rows to its day segments and the index, then delete the rows"""
+    messages_by_day = {}
+    for item in items:
+        messages_by_day.setdefault(item['timestamp'][:10], []).append(format_message(item))
+
+    segments = [
+        write_segment(s3, MESSAGE_ARCHIVE_BUCKET, conversation_id, day, messages)
+        for day, messages in messages_by_day.items()
+    ]
+    write_index(s3, MESSAGE_ARCHIVE_BUCKET, conversation_id, segments)
+
+    undeleted = batch_delete_items(items)
+    if undeleted:
+        raise RuntimeError(f"{len(undeleted)} archived rows could not be deleted")
+
+def query_older_items(partition_key, cutoff, limit):
+    """Page through up to `limit` of a partition's oldest rows before the cutoff"""
+    messages_table = dynamodb.Table(CHAT_MESSAGES_TABLE)
+    query_kwargs = {
+        'KeyConditionExpression': 'conversation_id = :conversation_id AND timestamp_message_id < :cutoff',
+        'ExpressionAttributeValues': {
+            ':conversation_id': partition_key,
+            ':cutoff': cutoff
+        }
+    }
+
+    items = []
+    while len(items) < limit:
+        query_kwargs['Limit'] = limit - len(items)
+        response = messages_table.query(**query_kwargs)
+        items.extend(response.get('Items', []))
+
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    return items
+
+def batch_delete_items(items):
+    """
+    Delete rows with BatchWriteItem in chunks of 25, retrying unprocessed
+    keys with exponential backoff. Returns the keys that were not deleted.
+    """
+    undeleted = []
+
+    for i in range(0, len(items), BATCH_WRITE_MAX_ITEMS):
+        requests = [
+            {'DeleteRequest': {'Key': {
+                'conversation_id': item['conversation_id'],
+                'timestamp_message_id': item['timestamp_message_id']
+            }}}
+            for item in items[i:i + BATCH_WRITE_MAX_ITEMS]
+        ]
+
+        attempt = 0
+        while requests:
+            response = dynamodb.batch_write_item(RequestItems={CHAT_MESSAGES_TABLE: requests})
+            requests = response.get('UnprocessedItems', {}).get(CHAT_MESSAGES_TABLE, [])
+
+            if not requests:
+                break
+
+            attempt += 1
+            if attempt > BATCH_WRITE_MAX_RETRIES:
+                undeleted.extend(request['DeleteRequest']['Key'] for request in requests)
+                break
+
+            # Exponential backoff: 50ms, 100ms, 200ms, ... capped at 2s
+            time.sleep(min(0.05 * (2 ** (attempt - 1)), 2))
+
+    return undeleted
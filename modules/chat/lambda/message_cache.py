@@ -0,0 +1,188 @@
+import json
+import redis
+import os
+from redis.cluster import RedisCluster
+from datetime import datetime
+
+from message_codec import decode_content
+from message_shards import logical_conversation_id
+
+REDIS_ENDPOINT = os.environ.get('REDIS_ENDPOINT', '')
+
+# Number of most recent messages kept in Redis per conversation
+RECENT_MESSAGES_CACHE_SIZE = int(os.environ.get('RECENT_MESSAGES_CACHE_SIZE', '200'))
+RECENT_MESSAGES_CACHE_TTL = int(os.environ.get('RECENT_MESSAGES_CACHE_TTL', str(24 * 60 * 60)))
+
+RECENT_MESSAGES_KEY_PREFIX = 'conversation_messages:'
+
+# Per-user hash of conversation_id -> unread message count
+UNREAD_COUNTS_KEY_PREFIX = 'unread_messages:'
+UNREAD_COUNTS_TTL = 30 * 24 * 60 * 60
+
+# Participant sets are cached until membership changes (see
+# group_fanout.invalidation_handler); the TTL only bounds stale entries
+PARTICIPANTS_KEY_PREFIX = 'conversation_participants:'
+PARTICIPANTS_CACHE_TTL = int(os.environ.get('PARTICIPANTS_CACHE_TTL', str(6 * 60 * 60)))
+
+# Scored below every message; present only while the cache holds the whole
+# history of the conversation. Trimming the set removes it first.
+HISTORY_START_MEMBER = '__history_start__'
+
+# Redis connection reused across warm invocations
+_redis_client = None
+
+def get_redis_client():
+    """Return the shared Redis client, or None when Redis is not configured"""
+    global _redis_client
+
+    if _redis_client is None and REDIS_ENDPOINT:
+        # The realtime Redis runs in cluster mode: the client follows the
+        # slot map, and each script or transaction must stay within one slot
+        _redis_client = RedisCluster(
+            host=REDIS_ENDPOINT.split(':')[0],
+            port=int(REDIS_ENDPOINT.split(':')[1]) if ':' in REDIS_ENDPOINT else 6379,
+            decode_responses=True
+        )
+
+    return _redis_client
+
+def get_values(redis_client, keys):
+    """
+    Values of several string keys, None where missing, with a pipeline of
+    GETs: the keys hash to different cluster slots, where MGET fails
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.get(key)
+    return pipe.execute()
+
+def recent_messages_key(conversation_id):
+    """Redis sorted set holding the recent messages of a conversation"""
+    return f"{RECENT_MESSAGES_KEY_PREFIX}{conversation_id}"
+
+def unread_counts_key(user_id):
+    """Redis hash holding the unread counters of a user"""
+    return f"{UNREAD_COUNTS_KEY_PREFIX}{user_id}"
+
+def format_message(item):
+    """Client-facing representation of a chat_messages item"""
+    return {
+        'message_id': item['message_id'],
+        'conversation_id': logical_conversation_id(item),
+        'timestamp_message_id': item['timestamp_message_id'],
+        'user_id': item['user_id'],
+        'content': decode_content(item),
+        'message_type': item.get('message_type', 'text'),
+        'timestamp': item['timestamp']
+    }
+
+def message_score(message):
+    """Sort messages in the cache by their timestamp"""
+    return datetime.fromisoformat(message['timestamp']).timestamp()
+
+def cache_messages(redis_client, conversation_id, messages, history_complete=False):
+    """
+    Add formatted messages to the capped recent-messages set of a
+    conversation. history_complete marks that no older messages exist.
+    """
+    key = recent_messages_key(conversation_id)
+    members = {
+        json.dumps(message, sort_keys=True, separators=(',', ':')): message_score(message)
+        for message in messages
+    }
+    if history_complete:
+        members[HISTORY_START_MEMBER] = 0
+
+    pipe = redis_client.pipeline(transaction=False)
+    if members:
+        pipe.zadd(key, members)
+    # Keep only the newest messages
+    pipe.zremrangebyrank(key, 0, -(RECENT_MESSAGES_CACHE_SIZE + 1))
+    pipe.expire(key, RECENT_MESSAGES_CACHE_TTL)
+    pipe.execute()
+
+def read_recent_messages(redis_client, conversation_id, limit):
+    """
+    Return the newest `limit` messages (newest first) and whether older
+    messages may exist, or None when the cache cannot serve the page.
+
+    The cache gains every stored message after its key was created, and a
+    failed cache write drops the key (see drop_recent_messages), so once it
+    holds `limit` messages they are exactly the newest `limit`.
+    """
+    members = redis_client.zrevrange(recent_messages_key(conversation_id), 0, limit)
+
+    history_complete = HISTORY_START_MEMBER in members
+    messages = [json.loads(member) for member in members if member != HISTORY_START_MEMBER][:limit]
+
+    if len(messages) < limit and not history_complete:
+        return None
+
+    return messages, not history_complete
+
+def drop_recent_messages(redis_client, conversation_id):
+    """
+    Delete the recent-messages set of a conversation after a failed cache
+    write, so the next read repopulates it from DynamoDB instead of serving
+    a page with the missing messages
+    """
+    try:
+        redis_client.delete(recent_messages_key(conversation_id))
+    except redis.RedisError as e:
+        print(f"Error dropping recent messages cache for conversation {conversation_id}: {str(e)}")
+
+def participants_key(conversation_id):
+    """Redis set holding the participant user IDs of a conversation"""
+    return f"{PARTICIPANTS_KEY_PREFIX}{conversation_id}"
+
+def query_participants(user_conversations_table, conversation_id):
+    """Page through ConversationParticipantsIndex once for a conversation"""
+    query_kwargs = {
+        'IndexName': 'ConversationParticipantsIndex',
+        'KeyConditionExpression': 'conversation_id = :conversation_id',
+        'ExpressionAttributeValues': {':conversation_id': conversation_id},
+        'ProjectionExpression': 'user_id'
+    }
+
+    participants = []
+    while True:
+        response = user_conversations_table.query(**query_kwargs)
+        participants.extend(item['user_id'] for item in response.get('Items', []))
+
+        if 'LastEvaluatedKey' not in response:
+            return participants
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def get_participants(redis_client, user_conversations_table, conversation_id):
+    """
+    Return the participant user IDs of a conversation from the Redis cache,
+    loading them from ConversationParticipantsIndex on a miss.
+    """
+    key = participants_key(conversation_id)
+
+    if redis_client is not None:
+        try:
+            participants = redis_client.smembers(key)
+            if participants:
+                return list(participants)
+        except redis.RedisError as e:
+            print(f"Participants cache unavailable: {str(e)}")
+
+    participants = query_participants(user_conversations_table, conversation_id)
+
+    if redis_client is not None and participants:
+        try:
+            # Readers see the old set, no set (a miss) or the new one
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.delete(key)
+            pipe.sadd(key, *participants)
+            pipe.expire(key, PARTICIPANTS_CACHE_TTL)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Error caching participants: {str(e)}")
+
+    return participants
+
+def invalidate_participants(redis_client, conversation_id):
+    """Drop the cached participants of a conversation after a membership change"""
+    redis_client.delete(participants_key(conversation_id))
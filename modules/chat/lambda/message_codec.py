@@ -0,0 +1,47 @@
+import json
+import os
+import zlib
+
+# Message bodies larger than this many bytes are stored zlib-compressed as a
+# DynamoDB Binary, with content_encoding telling readers how to decode them.
+# Smaller bodies, and bodies that do not shrink, are stored verbatim.
+COMPRESSION_THRESHOLD_BYTES = int(os.environ.get('MESSAGE_COMPRESSION_THRESHOLD_BYTES', '512'))
+COMPRESSION_LEVEL = 6
+
+ENCODING_ATTRIBUTE = 'content_encoding'
+# Compressed UTF-8 text
+ZLIB_ENCODING = 'zlib'
+# Compressed JSON of a structured (rich) payload
+ZLIB_JSON_ENCODING = 'zlib-json'
+
+def encode_content(content):
+    """
+    Return the chat_messages attributes storing a message body: `content`
+    and, when it was compressed, `content_encoding`.
+    """
+    if isinstance(content, str):
+        raw, encoding = content.encode('utf-8'), ZLIB_ENCODING
+    else:
+        raw, encoding = json.dumps(content, separators=(',', ':')).encode('utf-8'), ZLIB_JSON_ENCODING
+
+    if len(raw) > COMPRESSION_THRESHOLD_BYTES:
+        compressed = zlib.compress(raw, COMPRESSION_LEVEL)
+        if len(compressed) < len(raw):
+            return {'content': compressed, ENCODING_ATTRIBUTE: encoding}
+
+    return {'content': content}
+
+def decode_content(item):
+    """Message body of a chat_messages item, whatever its encoding"""
+    encoding = item.get(ENCODING_ATTRIBUTE)
+    if encoding is None:
+        return item['content']
+
+    # The DynamoDB resource returns Binary values, which wrap the bytes
+    raw = zlib.decompress(bytes(getattr(item['content'], 'value', item['content'])))
+
+    if encoding == ZLIB_ENCODING:
+        return raw.decode('utf-8')
+    if encoding == ZLIB_JSON_ENCODING:
+        return json.loads(raw)
+    raise ValueError(f"Unknown message content encoding: {encoding}")
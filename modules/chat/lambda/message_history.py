@@ -0,0 +1,287 @@
+import json
+import boto3
+import redis
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from inbox import INBOX_INDEX, encode_cursor, decode_cursor
+from message_cache import (
+    get_redis_client, format_message, cache_messages, read_recent_messages,
+    unread_counts_key, RECENT_MESSAGES_CACHE_SIZE
+)
+from message_archive import read_archived_messages
+from message_shards import get_shard_counts, partition_keys, merge_pages
+
+# Initialize AWS clients
+dynamodb = boto3.resource('dynamodb')
+s3 = boto3.client('s3')
+
+# Environment variables
+CHAT_MESSAGES_TABLE = os.environ['CHAT_MESSAGES_TABLE']
+CONVERSATIONS_TABLE = os.environ['CONVERSATIONS_TABLE']
+USER_CONVERSATIONS_TABLE = os.environ['USER_CONVERSATIONS_TABLE']
+# Messages past the hot window are read through from their S3 segments
+MESSAGE_ARCHIVE_BUCKET = os.environ.get('MESSAGE_ARCHIVE_BUCKET', '')
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', '50'))
+MAX_PAGE_SIZE = 100
+# Upper bound on concurrent shard queries of a sharded conversation
+SHARD_QUERY_CONCURRENCY = max(1, int(os.environ.get('SHARD_QUERY_CONCURRENCY', '8')))
+
+# Worker pool and per-thread resources reused across warm invocations
+_executor = ThreadPoolExecutor(max_workers=SHARD_QUERY_CONCURRENCY)
+_thread_local = threading.local()
+
+def handler(event, context):
+    """
+    Read conversation history and unread state
+    """
+    try:
+        action = event.get('action', 'get_messages')
+
+        if action == 'get_unread_counts':
+            # Every unread counter of a user in one call
+            user_id = event.get('user_id')
+            if not user_id:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps('user_id is required')
+                }
+
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'user_id': user_id,
+                    'unread_counts': get_unread_counts(user_id)
+                })
+            }
+
+        if action == 'get_inbox':
+            # The user's conversations by recency in one paginated Query
+            user_id = event.get('user_id')
+            if not user_id:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps('user_id is required')
+                }
+
+            limit = min(int(event.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+            page = get_inbox(user_id, limit, event.get('cursor'))
+
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'user_id': user_id,
+                    'conversations': page['conversations'],
+                    'next_cursor': page['next_cursor']
+                })
+            }
+
+        conversation_id = event.get('conversation_id')
+
+        if not conversation_id:
+            return {
+                'statusCode': 400,
+                'body': json.dumps('conversation_id is required')
+            }
+
+        if action == 'mark_read':
+            # Read receipt: move the read marker and reset the unread counter
+            user_id = event.get('user_id')
+            if not user_id:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps('user_id is required')
+                }
+
+            mark_read(user_id, conversation_id, event.get('timestamp'))
+            return {
+                'statusCode': 200,
+                'body': json.dumps(f'Conversation {conversation_id} marked read for user {user_id}')
+            }
+
+        limit = min(int(event.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        page = get_messages(conversation_id, limit, event.get('cursor'))
+
+        return {
+            'statusCode': 200,
+            'body': json.dumps({
+                'conversation_id': conversation_id,
+                'messages': page['messages'],
+                'next_cursor': page['next_cursor']
+            })
+        }
+
+    except Exception as e:
+        print(f"Error reading message history: {str(e)}")
+        return {
+            'statusCode': 500,
+            'body': json.dumps(f'Error: {str(e)}')
+        }
+
+def get_messages(conversation_id, limit, cursor=None):
+    """
+    Return a page of messages, newest first. The first page is served from
+    the Redis recent-messages cache when it can; older pages, and cache
+    misses, are read from DynamoDB with the cursor (the timestamp_message_id
+    of the oldest message already returned).
+    """
+    redis_client = get_redis_client()
+
+    if cursor is None and redis_client is not None:
+        try:
+            cached = read_recent_messages(redis_client, conversation_id, limit)
+            if cached is not None:
+                messages, has_more = cached
+                return {
+                    'messages': messages,
+                    'next_cursor': messages[-1]['timestamp_message_id'] if has_more and messages else None
+                }
+        except redis.RedisError as e:
+            print(f"Recent messages cache unavailable: {str(e)}")
+
+    page = query_messages(conversation_id, limit, cursor)
+
+    # Warm the cache with the newest page read from the table
+    if cursor is None and redis_client is not None and limit <= RECENT_MESSAGES_CACHE_SIZE:
+        try:
+            cache_messages(
+                redis_client, conversation_id, page['messages'],
+                history_complete=page['next_cursor'] is None
+            )
+        except redis.RedisError as e:
+            print(f"Error warming recent messages cache: {str(e)}")
+
+    return page
+
+def get_dynamodb():
+    """Return the DynamoDB resource of the current thread (resources are not thread safe)"""
+    if not hasattr(_thread_local, 'dynamodb'):
+        _thread_local.dynamodb = boto3.session.Session().resource('dynamodb')
+    return _thread_local.dynamodb
+
+def query_messages(conversation_id, limit, cursor=None):
+    """
+    Query a page of messages older than the cursor from DynamoDB. Sharded
+    conversations query every partition concurrently and merge the pages
+    by timestamp_message_id. Once the table runs out of older messages the
+    page is filled from the archived S3 segments.
+    """
+    try:
+        shard_count = get_shard_counts(dynamodb, CONVERSATIONS_TABLE, [conversation_id])[conversation_id]
+    except Exception as e:
+        # Without the shard count only the unsharded partition can be read
+        print(f"Error loading shard count of conversation {conversation_id}: {str(e)}")
+        shard_count = 0
+
+    if shard_count:
+        pages = list(_executor.map(
+            lambda key: query_partition(get_dynamodb().Table(CHAT_MESSAGES_TABLE), key, limit, cursor),
+            partition_keys(conversation_id, shard_count)
+        ))
+        items, has_more = merge_pages(pages, limit)
+    else:
+        items, has_more = query_partition(dynamodb.Table(CHAT_MESSAGES_TABLE), conversation_id, limit, cursor)
+
+    messages = [format_message(item) for item in items]
+
+    if not has_more and len(messages) < limit and MESSAGE_ARCHIVE_BUCKET:
+        before = messages[-1]['timestamp_message_id'] if messages else cursor
+        archived, has_more = read_archived_messages(
+            s3, MESSAGE_ARCHIVE_BUCKET, conversation_id, before, limit - len(messages)
+        )
+        messages.extend(archived)
+
+    return {
+        'messages': messages,
+        'next_cursor': messages[-1]['timestamp_message_id'] if has_more and messages else None
+    }
+
+def query_partition(messages_table, partition_key, limit, cursor=None):
+    """Query one chat_messages partition, newest first. Returns (items, has_more)."""
+    key_condition = 'conversation_id = :conversation_id'
+    expression_values = {':conversation_id': partition_key}
+
+    if cursor:
+        key_condition += ' AND timestamp_message_id < :cursor'
+        expression_values[':cursor'] = cursor
+
+    response = messages_table.query(
+        KeyConditionExpression=key_condition,
+        ExpressionAttributeValues=expression_values,
+        ScanIndexForward=False,  # Most recent first
+        Limit=limit
+    )
+
+    return response.get('Items', []), 'LastEvaluatedKey' in response
+
+def get_inbox(user_id, limit, cursor=None):
+    """
+    Return a page of the user's conversations, most recent activity first,
+    from the InboxIndex GSI. last_activity and the preview are copied onto
+    every participant's row on write, so no per-conversation reads are needed.
+    """
+    user_conversations_table = dynamodb.Table(USER_CONVERSATIONS_TABLE)
+
+    query_kwargs = {
+        'IndexName': INBOX_INDEX,
+        'KeyConditionExpression': 'user_id = :user_id',
+        'ExpressionAttributeValues': {':user_id': user_id},
+        'ScanIndexForward': False,  # Most recent first
+        'Limit': limit
+    }
+    if cursor:
+        query_kwargs['ExclusiveStartKey'] = decode_cursor(cursor)
+
+    response = user_conversations_table.query(**query_kwargs)
+    unread_counts = get_unread_counts(user_id)
+
+    conversations = [
+        {
+            'conversation_id': item['conversation_id'],
+            'last_activity': item.get('last_activity'),
+            'last_message_preview': item.get('last_message_preview', ''),
+            'last_read_timestamp': item.get('last_read_timestamp'),
+            'unread_count': unread_counts.get(item['conversation_id'], 0) if unread_counts is not None else None
+        }
+        for item in response.get('Items', [])
+    ]
+
+    return {
+        'conversations': conversations,
+        'next_cursor': encode_cursor(response['LastEvaluatedKey']) if 'LastEvaluatedKey' in response else None
+    }
+
+def get_unread_counts(user_id):
+    """
+    Return conversation_id -> unread count for every conversation with
+    unread messages. The counts are best effort: None when Redis fails.
+    """
+    redis_client = get_redis_client()
+    if redis_client is None:
+        return {}
+
+    try:
+        counts = redis_client.hgetall(unread_counts_key(user_id))
+    except redis.RedisError as e:
+        print(f"Error reading unread counters: {str(e)}")
+        return None
+    return {conversation_id: int(count) for conversation_id, count in counts.items() if int(count) > 0}
+
+def mark_read(user_id, conversation_id, timestamp=None):
+    """Record a read receipt on user_conversations and reset the unread counter"""
+    timestamp = timestamp or datetime.now(timezone.utc).isoformat()
+
+    dynamodb.Table(USER_CONVERSATIONS_TABLE).update_item(
+        Key={
+            'user_id': user_id,
+            'conversation_id': conversation_id
+        },
+        UpdateExpression='SET last_read_timestamp = :timestamp',
+        ExpressionAttributeValues={':timestamp': timestamp}
+    )
+
+    redis_client = get_redis_client()
+    if redis_client is not None:
+        redis_client.hdel(unread_counts_key(user_id), conversation_id)
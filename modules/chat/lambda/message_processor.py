@@ -1,12 +1,24 @@
 import json
 import boto3
+import redis
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from decimal import Decimal
 
-# Initialize AWS clients
-dynamodb = boto3.resource('dynamodb')
+from inbox import update_inbox_row
+from message_cache import (
+    get_redis_client, get_values, format_message, cache_messages, drop_recent_messages, get_participants,
+    unread_counts_key, UNREAD_COUNTS_TTL
+)
+from message_codec import encode_content
+from message_shards import get_shard_counts, shard_item
+
+# Initialize AWS clients (clients are thread safe, resources are created per thread)
 sns = boto3.client('sns')
+sqs = boto3.client('sqs')
 
 # Environment variables
 CHAT_MESSAGES_TABLE = os.environ['CHAT_MESSAGES_TABLE']
@@ -15,100 +27,792 @@ USER_CONVERSATIONS_TABLE = os.environ['USER_CONVERSATIONS_TABLE']
 USER_PRESENCE_TABLE = os.environ['USER_PRESENCE_TABLE']
 CHAT_NOTIFICATIONS_TOPIC = os.environ['CHAT_NOTIFICATIONS_TOPIC']
 GROUP_NOTIFICATIONS_TOPIC = os.environ['GROUP_NOTIFICATIONS_TOPIC']
+FANOUT_QUEUE_URL = os.environ['FANOUT_QUEUE_URL']
+BATCH_WRITE_MAX_RETRIES = int(os.environ.get('BATCH_WRITE_MAX_RETRIES', '5'))
+# Seconds a conversation's newest activity is buffered in Redis before it is
+# written to the conversations table; 0 writes through on every batch
+ACTIVITY_FLUSH_INTERVAL_SECONDS = int(os.environ.get('ACTIVITY_FLUSH_INTERVAL_SECONDS', '30'))
+# Upper bound on concurrent DynamoDB/SNS calls per invocation
+IO_CONCURRENCY = max(1, int(os.environ.get('IO_CONCURRENCY', '8')))
+
+# BatchWriteItem accepts at most 25 put/delete requests per call
+BATCH_WRITE_MAX_ITEMS = 25
+
+# Recipients per fan-out job for group messages
+FANOUT_CHUNK_SIZE = int(os.environ.get('FANOUT_CHUNK_SIZE', '200'))
+
+# SendMessageBatch accepts at most 10 entries per call
+SEND_MESSAGE_BATCH_MAX_ENTRIES = 10
+
+# PublishBatch accepts at most 10 entries per call
+PUBLISH_BATCH_MAX_ENTRIES = 10
+PUBLISH_BATCH_MAX_RETRIES = int(os.environ.get('PUBLISH_BATCH_MAX_RETRIES', '3'))
+
+# Records that went through the whole pipeline are remembered by SQS
+# messageId, so a redelivery of the same record is skipped
+PROCESSED_KEY_PREFIX = 'processed_message:'
+PROCESSED_MARKER_TTL = int(os.environ.get('PROCESSED_MARKER_TTL', str(24 * 60 * 60)))
+
+# Redis keys for the conversation activity write-behind buffer
+ACTIVITY_KEY_PREFIX = 'conversation_activity:'
+ACTIVITY_DIRTY_KEY = 'conversation_activity_dirty'
+ACTIVITY_BUFFER_TTL = 24 * 60 * 60
+
+# Only replace the buffered activity when the incoming timestamp is newer
+BUFFER_ACTIVITY_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], 'last_activity')
+if current and current >= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'last_activity', ARGV[1], 'last_message_preview', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+# Take the buffered activity of a conversation and clear it in one step, so
+# activity buffered meanwhile is never deleted unflushed
+TAKE_ACTIVITY_SCRIPT = """
+local activity = redis.call('HGETALL', KEYS[1])
+redis.call('DEL', KEYS[1])
+return activity
+"""
+
+# Worker pool and per-thread resources reused across warm invocations
+_executor = ThreadPoolExecutor(max_workers=IO_CONCURRENCY)
+_thread_local = threading.local()
 
 def handler(event, context):
     """
     Process chat messages from SQS queue
     """
+    if event.get('action') == 'flush_conversation_activity':
+        # Scheduled flush of the conversation activity buffer
+        flushed = flush_conversation_activity(force=True)
+        return {
+            'statusCode': 200,
+            'body': json.dumps(f'Flushed activity for {flushed} conversations')
+        }
+
     try:
-        # Get tables
-        messages_table = dynamodb.Table(CHAT_MESSAGES_TABLE)
-        conversations_table = dynamodb.Table(CONVERSATIONS_TABLE)
-        user_conversations_table = dynamodb.Table(USER_CONVERSATIONS_TABLE)
-        
-        for record in event['Records']:
-            # Parse SQS message
-            message_body = json.loads(record['body'])
-            
-            # Extract message data
-            conversation_id = message_body['conversation_id']
-            user_id = message_body['user_id']
-            message_content = message_body['content']
-            message_type = message_body.get('message_type', 'text')
-            timestamp = datetime.now(timezone.utc).isoformat()
-            
-            # Create composite sort key
-            timestamp_message_id = f"{timestamp}#{record['messageId']}"
-            
-            # Store message in DynamoDB
-            message_item = {
-                'conversation_id': conversation_id,
-                'timestamp_message_id': timestamp_message_id,
-                'user_id': user_id,
-                'content': message_content,
-                'message_type': message_type,
-                'timestamp': timestamp,
-                'message_id': record['messageId']
-            }
-            
-            # Add TTL if enabled (7 days from now)
-            if 'ttl' in message_body:
-                message_item['ttl'] = int((datetime.now(timezone.utc).timestamp()) + 604800)
-            
-            messages_table.put_item(Item=message_item)
-            
-            # Update conversation last activity
-            conversations_table.update_item(
-                Key={'conversation_id': conversation_id},
-                UpdateExpression='SET last_activity = :timestamp, last_message_preview = :preview',
-                ExpressionAttributeValues={
-                    ':timestamp': timestamp,
-                    ':preview': message_content[:100] if message_type == 'text' else f'[{message_type}]'
-                }
-            )
-            
-            # Update user conversation read status
-            user_conversations_table.update_item(
-                Key={
-                    'user_id': user_id,
-                    'conversation_id': conversation_id
-                },
-                UpdateExpression='SET last_sent_timestamp = :timestamp',
-                ExpressionAttributeValues={':timestamp': timestamp}
-            )
-            
-            # Send notifications
-            notification_message = {
-                'conversation_id': conversation_id,
-                'user_id': user_id,
-                'message_type': message_type,
-                'timestamp': timestamp,
-                'message_id': record['messageId']
-            }
-            
-            # Determine which SNS topic to use
-            topic_arn = GROUP_NOTIFICATIONS_TOPIC if message_body.get('is_group', False) else CHAT_NOTIFICATIONS_TOPIC
-            
-            sns.publish(
-                TopicArn=topic_arn,
-                Message=json.dumps(notification_message),
-                MessageAttributes={
-                    'conversation_id': {
-                        'DataType': 'String',
-                        'StringValue': conversation_id
-                    },
-                    'message_type': {
-                        'DataType': 'String',
-                        'StringValue': message_type
-                    }
-                }
-            )
-        
+        records = event['Records']
+        failed_message_ids = set()
+
+        messages = []
+        for record in records:
+            try:
+                messages.append(parse_record(record))
+            except Exception as e:
+                print(f"Error parsing message {record.get('messageId')}: {str(e)}")
+                failed_message_ids.add(record['messageId'])
+
+        # Skip records an earlier delivery already processed completely
+        already_processed = find_processed_messages([message['message_id'] for message in messages])
+        messages = [message for message in messages if message['message_id'] not in already_processed]
+
+        # Spread the messages of hot conversations over their shards
+        apply_message_shards(messages)
+
+        # Store all messages of the batch with BatchWriteItem
+        unwritten_items = batch_put_items(CHAT_MESSAGES_TABLE, [message['item'] for message in messages])
+        failed_message_ids.update(item['message_id'] for item in unwritten_items)
+
+        # Only stored messages go on to activity updates and notifications
+        messages = [message for message in messages if message['message_id'] not in failed_message_ids]
+
+        conversation_updates, user_conversation_updates = group_activity_updates(messages)
+
+        # Direct messages are published here; group messages are fanned out
+        # to their recipients by the group fan-out workers
+        direct_messages = [message for message in messages if not message['is_group']]
+        group_messages = [message for message in messages if message['is_group']]
+
+        # Once the messages are stored, activity updates and notifications are
+        # independent of each other and run concurrently on the worker pool
+        activity_future = _executor.submit(record_conversation_activity, conversation_updates)
+        user_conversation_futures = {
+            key: _executor.submit(update_user_conversation, key[0], key[1], message['timestamp'])
+            for key, message in user_conversation_updates.items()
+        }
+        publish_futures = [
+            _executor.submit(publish_lane, topic_arn, chunks)
+            for topic_arn, chunks in plan_publish_lanes(direct_messages)
+        ]
+        cache_future = _executor.submit(cache_recent_messages, messages)
+        participant_futures = {
+            conversation_id: _executor.submit(load_participants, conversation_id)
+            for conversation_id in conversation_updates
+        }
+
+        # Update conversation last activity, once per conversation
+        failed_conversations = activity_future.result()
+        failed_message_ids.update(
+            message['message_id'] for message in messages
+            if message['conversation_id'] in failed_conversations
+        )
+
+        # Update user conversation read status, once per sender and conversation
+        for (user_id, conversation_id), future in user_conversation_futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error updating user conversation {user_id}/{conversation_id}: {str(e)}")
+                failed_message_ids.update(
+                    m['message_id'] for m in messages
+                    if m['user_id'] == user_id and m['conversation_id'] == conversation_id
+                )
+
+        # Copy the newest activity onto the participants' inbox rows
+        failed_conversations = update_inboxes(messages, conversation_updates, participant_futures)
+        failed_message_ids.update(
+            message['message_id'] for message in messages
+            if message['conversation_id'] in failed_conversations
+        )
+
+        # Send notifications with PublishBatch, grouped by topic
+        for future in publish_futures:
+            failed_message_ids.update(future.result())
+
+        # Split group messages into recipient chunks on the fan-out queue
+        failed_message_ids.update(enqueue_fanout(group_messages, participant_futures))
+
+        # Records returned to the queue: the failed ones and, on FIFO queues,
+        # the records after them in their message group
+        failures = batch_item_failures(records, failed_message_ids)
+        returned_message_ids = {failure['itemIdentifier'] for failure in failures}
+        completed = [message for message in messages if message['message_id'] not in returned_message_ids]
+
+        # The recent messages cache and unread counters are best effort and
+        # never fail a record. Returned records are counted when they come
+        # back from SQS, so only the completed ones are counted now.
+        cache_future.result()
+        update_unread_counters(completed, participant_futures)
+
+        # Returned records are not marked, so their retry processes them again
+        mark_messages_processed([message['message_id'] for message in completed])
+
+        processed = len(records) - len(returned_message_ids)
+
+        # Only returned records are retried (ReportBatchItemFailures)
         return {
             'statusCode': 200,
-            'body': json.dumps(f'Processed {len(event["Records"])} messages successfully')
+            'body': json.dumps(f'Processed {processed} of {len(records)} messages successfully'),
+            'batchItemFailures': failures
         }
-        
+
     except Exception as e:
         print(f"Error processing messages: {str(e)}")
-        raise e
\ No newline at end of file
+        raise e
+
+def parse_record(record):
+    """Build the message item and notification for a single SQS record"""
+    # Parse SQS message
+    message_body = json.loads(record['body'])
+
+    # Extract message data
+    conversation_id = message_body['conversation_id']
+    user_id = message_body['user_id']
+    message_content = message_body['content']
+    message_type = message_body.get('message_type', 'text')
+    timestamp = message_timestamp(record)
+
+    # Create composite sort key
+    timestamp_message_id = f"{timestamp}#{record['messageId']}"
+
+    message_item = {
+        'conversation_id': conversation_id,
+        'timestamp_message_id': timestamp_message_id,
+        'user_id': user_id,
+        # Large bodies are stored compressed
+        **encode_content(message_content),
+        'message_type': message_type,
+        'timestamp': timestamp,
+        'message_id': record['messageId']
+    }
+
+    # Add TTL if enabled (7 days from now)
+    if 'ttl' in message_body:
+        message_item['ttl'] = int((datetime.now(timezone.utc).timestamp()) + 604800)
+
+    notification_message = {
+        'conversation_id': conversation_id,
+        'user_id': user_id,
+        'message_type': message_type,
+        'timestamp': timestamp,
+        'message_id': record['messageId']
+    }
+
+    return {
+        'message_id': record['messageId'],
+        'conversation_id': conversation_id,
+        'user_id': user_id,
+        'message_type': message_type,
+        'timestamp': timestamp,
+        'preview': message_content[:100] if message_type == 'text' else f'[{message_type}]',
+        'item': message_item,
+        'notification': notification_message,
+        # Determine which SNS topic to use
+        'is_group': message_body.get('is_group', False),
+        'topic_arn': GROUP_NOTIFICATIONS_TOPIC if message_body.get('is_group', False) else CHAT_NOTIFICATIONS_TOPIC
+    }
+
+def message_timestamp(record):
+    """
+    Timestamp of a record taken from its SQS SentTimestamp, so every
+    delivery of the record gets the same sort key and overwrites the same
+    row instead of adding a duplicate.
+    """
+    sent_timestamp = record.get('attributes', {}).get('SentTimestamp')
+    if sent_timestamp is None:
+        sent_at = datetime.now(timezone.utc)
+    else:
+        sent_at = datetime.fromtimestamp(int(sent_timestamp) / 1000, tz=timezone.utc)
+    # Fixed width keeps timestamp_message_id ordered as a string
+    return sent_at.isoformat(timespec='microseconds')
+
+def processed_message_key(message_id):
+    """Redis marker of a fully processed SQS record"""
+    return f"{PROCESSED_KEY_PREFIX}{message_id}"
+
+def find_processed_messages(message_ids):
+    """Return the message IDs already processed by an earlier delivery"""
+    redis_client = get_redis_client()
+    if redis_client is None or not message_ids:
+        return set()
+
+    try:
+        markers = get_values(redis_client, [processed_message_key(message_id) for message_id in message_ids])
+    except redis.RedisError as e:
+        # Without the markers the records are processed again; the writes are
+        # idempotent, only notifications may repeat
+        print(f"Processed message markers unavailable: {str(e)}")
+        return set()
+
+    return {message_id for message_id, marker in zip(message_ids, markers) if marker is not None}
+
+def mark_messages_processed(message_ids):
+    """Remember fully processed records for PROCESSED_MARKER_TTL seconds"""
+    redis_client = get_redis_client()
+    if redis_client is None or not message_ids:
+        return
+
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for message_id in message_ids:
+            pipe.set(processed_message_key(message_id), 1, ex=PROCESSED_MARKER_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        print(f"Error marking messages processed: {str(e)}")
+
+def group_activity_updates(messages):
+    """
+    Collapse the batch to the newest message per conversation and per
+    (sender, conversation), so each key is written once per batch.
+    """
+    conversation_updates = {}
+    user_conversation_updates = {}
+
+    for message in messages:
+        conversation_id = message['conversation_id']
+        current = conversation_updates.get(conversation_id)
+        if current is None or message['timestamp'] >= current['timestamp']:
+            conversation_updates[conversation_id] = message
+
+        user_key = (message['user_id'], conversation_id)
+        current = user_conversation_updates.get(user_key)
+        if current is None or message['timestamp'] >= current['timestamp']:
+            user_conversation_updates[user_key] = message
+
+    return conversation_updates, user_conversation_updates
+
+def apply_message_shards(messages):
+    """
+    Key the items of sharded conversations on their shard partitions. When
+    the shard counts cannot be read the items stay on the unsharded
+    partition, which readers always include.
+    """
+    try:
+        shard_counts = get_shard_counts(
+            get_dynamodb(), CONVERSATIONS_TABLE, [message['conversation_id'] for message in messages]
+        )
+    except Exception as e:
+        print(f"Error loading conversation shard counts: {str(e)}")
+        return
+
+    for message in messages:
+        message['item'] = shard_item(message['item'], shard_counts.get(message['conversation_id'], 0))
+
+def batch_item_failures(records, failed_message_ids):
+    """
+    Build the batchItemFailures list for ReportBatchItemFailures. On FIFO
+    queues every record after a failure in the same message group is also
+    returned, so the group is retried in order.
+    """
+    failures = []
+    failed_groups = set()
+
+    for record in records:
+        message_id = record['messageId']
+        group_id = record.get('attributes', {}).get('MessageGroupId')
+
+        if message_id in failed_message_ids or (group_id is not None and group_id in failed_groups):
+            failures.append({'itemIdentifier': message_id})
+            if group_id is not None:
+                failed_groups.add(group_id)
+
+    return failures
+
+def get_dynamodb():
+    """Return the DynamoDB resource of the current thread (resources are not thread safe)"""
+    if not hasattr(_thread_local, 'dynamodb'):
+        _thread_local.dynamodb = boto3.session.Session().resource('dynamodb')
+    return _thread_local.dynamodb
+
+def batch_put_items(table_name, items):
+    """
+    Write items with BatchWriteItem in chunks of 25, running the chunks
+    concurrently. Returns the items that could not be written.
+    """
+    chunks = [items[i:i + BATCH_WRITE_MAX_ITEMS] for i in range(0, len(items), BATCH_WRITE_MAX_ITEMS)]
+
+    unwritten = []
+    for chunk_unwritten in _executor.map(lambda chunk: put_chunk(table_name, chunk), chunks):
+        unwritten.extend(chunk_unwritten)
+
+    return unwritten
+
+def put_chunk(table_name, chunk):
+    """
+    Write up to 25 items with BatchWriteItem, retrying unprocessed items
+    with exponential backoff. Returns the items that could not be written.
+    """
+    requests = [{'PutRequest': {'Item': item}} for item in chunk]
+
+    try:
+        attempt = 0
+        while requests:
+            response = get_dynamodb().batch_write_item(RequestItems={table_name: requests})
+            requests = response.get('UnprocessedItems', {}).get(table_name, [])
+
+            if not requests:
+                break
+
+            attempt += 1
+            if attempt > BATCH_WRITE_MAX_RETRIES:
+                print(f"{len(requests)} items still unprocessed in {table_name} after {BATCH_WRITE_MAX_RETRIES} retries")
+                return [request['PutRequest']['Item'] for request in requests]
+
+            # Exponential backoff: 50ms, 100ms, 200ms, ... capped at 2s
+            time.sleep(min(0.05 * (2 ** (attempt - 1)), 2))
+
+    except Exception as e:
+        print(f"Error writing batch to {table_name}: {str(e)}")
+        # Nothing is known about this call, treat the remaining requests as failed
+        return [request['PutRequest']['Item'] for request in requests]
+
+    return []
+
+def update_user_conversation(user_id, conversation_id, timestamp):
+    """Record the sender's last sent timestamp on their user_conversations row"""
+    get_dynamodb().Table(USER_CONVERSATIONS_TABLE).update_item(
+        Key={
+            'user_id': user_id,
+            'conversation_id': conversation_id
+        },
+        UpdateExpression='SET last_sent_timestamp = :timestamp',
+        ExpressionAttributeValues={':timestamp': timestamp}
+    )
+
+def build_publish_entry(entry_id, message):
+    """Build a PublishBatch entry for a message notification"""
+    entry = {
+        'Id': entry_id,
+        'Message': json.dumps(message['notification']),
+        'MessageAttributes': {
+            'conversation_id': {
+                'DataType': 'String',
+                'StringValue': message['conversation_id']
+            },
+            'message_type': {
+                'DataType': 'String',
+                'StringValue': message['message_type']
+            }
+        }
+    }
+
+    if message['topic_arn'].endswith('.fifo'):
+        # Keep notifications of a conversation ordered; the SQS message ID is
+        # stable across redeliveries, so a retried record is deduplicated
+        entry['MessageGroupId'] = message['conversation_id']
+        entry['MessageDeduplicationId'] = message['message_id']
+
+    return entry
+
+def plan_publish_lanes(messages):
+    """
+    Split notifications into lanes of PublishBatch chunks. Lanes run
+    concurrently and the chunks of a lane run in order, so all
+    notifications of a conversation stay in one lane and keep their order.
+    Small conversations share a chunk; a conversation with more than 10
+    messages gets a lane of its own.
+    """
+    conversations_by_topic = {}
+    for message in messages:
+        conversations = conversations_by_topic.setdefault(message['topic_arn'], {})
+        conversations.setdefault(message['conversation_id'], []).append(message)
+
+    lanes = []
+    for topic_arn, conversations in conversations_by_topic.items():
+        shared_chunk = []
+        for conversation_messages in conversations.values():
+            if len(conversation_messages) > PUBLISH_BATCH_MAX_ENTRIES:
+                lanes.append((topic_arn, [
+                    conversation_messages[i:i + PUBLISH_BATCH_MAX_ENTRIES]
+                    for i in range(0, len(conversation_messages), PUBLISH_BATCH_MAX_ENTRIES)
+                ]))
+                continue
+
+            if len(shared_chunk) + len(conversation_messages) > PUBLISH_BATCH_MAX_ENTRIES:
+                lanes.append((topic_arn, [shared_chunk]))
+                shared_chunk = []
+            shared_chunk.extend(conversation_messages)
+
+        if shared_chunk:
+            lanes.append((topic_arn, [shared_chunk]))
+
+    return lanes
+
+def publish_lane(topic_arn, chunks):
+    """Publish the chunks of a lane in order. Returns the message IDs that were not published."""
+    failed_message_ids = set()
+    for chunk in chunks:
+        failed_message_ids.update(publish_chunk(topic_arn, chunk))
+    return failed_message_ids
+
+def publish_chunk(topic_arn, chunk):
+    """
+    Publish up to 10 notifications with PublishBatch. Failed entries that
+    are not sender faults are retried on their own with backoff. Returns
+    the message IDs that were not published.
+    """
+    failed_message_ids = set()
+    pending = {str(n): message for n, message in enumerate(chunk)}
+
+    attempt = 0
+    while pending:
+        try:
+            response = sns.publish_batch(
+                TopicArn=topic_arn,
+                PublishBatchRequestEntries=[
+                    build_publish_entry(entry_id, message) for entry_id, message in pending.items()
+                ]
+            )
+        except Exception as e:
+            print(f"Error publishing batch to {topic_arn}: {str(e)}")
+            failed_message_ids.update(message['message_id'] for message in pending.values())
+            break
+
+        retry = {}
+        for failure in response.get('Failed', []):
+            message = pending[failure['Id']]
+            if failure.get('SenderFault'):
+                print(f"Notification for message {message['message_id']} rejected: {failure.get('Code')} {failure.get('Message')}")
+                failed_message_ids.add(message['message_id'])
+            else:
+                retry[failure['Id']] = message
+        pending = retry
+
+        if not pending:
+            break
+
+        attempt += 1
+        if attempt > PUBLISH_BATCH_MAX_RETRIES:
+            print(f"{len(pending)} notifications still failing on {topic_arn} after {PUBLISH_BATCH_MAX_RETRIES} retries")
+            failed_message_ids.update(message['message_id'] for message in pending.values())
+            break
+
+        time.sleep(min(0.05 * (2 ** (attempt - 1)), 2))
+
+    return failed_message_ids
+
+def write_conversation_activity(conversation_id, timestamp, preview):
+    """
+    Conditionally set last_activity so an older timestamp never overwrites a
+    newer one. Returns False when the stored activity is already newer.
+    """
+    conversations_table = get_dynamodb().Table(CONVERSATIONS_TABLE)
+
+    try:
+        conversations_table.update_item(
+            Key={'conversation_id': conversation_id},
+            UpdateExpression='SET last_activity = :timestamp, last_message_preview = :preview',
+            ConditionExpression='attribute_not_exists(last_activity) OR last_activity < :timestamp',
+            ExpressionAttributeValues={
+                ':timestamp': timestamp,
+                ':preview': preview
+            }
+        )
+        return True
+    except conversations_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+def buffer_conversation_activity(redis_client, conversation_id, timestamp, preview):
+    """Keep the newest activity for a conversation in the Redis buffer"""
+    redis_client.eval(
+        BUFFER_ACTIVITY_SCRIPT, 1,
+        f"{ACTIVITY_KEY_PREFIX}{conversation_id}",
+        timestamp, preview, ACTIVITY_BUFFER_TTL
+    )
+    # NX keeps the time the conversation first became dirty, so a busy
+    # conversation is still flushed once per interval
+    redis_client.zadd(ACTIVITY_DIRTY_KEY, {conversation_id: time.time()}, nx=True)
+
+def record_conversation_activity(conversation_updates):
+    """
+    Record the newest activity of each conversation in the batch. With a
+    flush interval the value goes to the Redis write-behind buffer and due
+    conversations are flushed; otherwise it is written through directly.
+    Returns the conversation IDs whose activity could not be recorded.
+    """
+    redis_client = get_redis_client() if ACTIVITY_FLUSH_INTERVAL_SECONDS > 0 else None
+
+    if redis_client is not None:
+        try:
+            for conversation_id, message in conversation_updates.items():
+                buffer_conversation_activity(redis_client, conversation_id, message['timestamp'], message['preview'])
+        except redis.RedisError as e:
+            print(f"Activity buffer unavailable, writing through: {str(e)}")
+        else:
+            try:
+                flush_conversation_activity()
+            except redis.RedisError as e:
+                # Buffered values stay dirty and are picked up by the next flush
+                print(f"Error flushing activity buffer: {str(e)}")
+            return set()
+
+    failed_conversations = set()
+    for conversation_id, message in conversation_updates.items():
+        try:
+            write_conversation_activity(conversation_id, message['timestamp'], message['preview'])
+        except Exception as e:
+            print(f"Error updating conversation {conversation_id}: {str(e)}")
+            failed_conversations.add(conversation_id)
+
+    return failed_conversations
+
+def cache_recent_messages(messages):
+    """Push stored messages into the Redis recent-messages cache of their conversation"""
+    redis_client = get_redis_client()
+    if redis_client is None:
+        return
+
+    messages_by_conversation = {}
+    for message in messages:
+        messages_by_conversation.setdefault(message['conversation_id'], []).append(format_message(message['item']))
+
+    for conversation_id, conversation_messages in messages_by_conversation.items():
+        try:
+            cache_messages(redis_client, conversation_id, conversation_messages)
+        except redis.RedisError as e:
+            print(f"Error caching recent messages for conversation {conversation_id}: {str(e)}")
+            drop_recent_messages(redis_client, conversation_id)
+
+def load_participants(conversation_id):
+    """Return the participants of a conversation through the Redis participants cache"""
+    return get_participants(get_redis_client(), get_dynamodb().Table(USER_CONVERSATIONS_TABLE), conversation_id)
+
+def plan_recipients(conversation_messages, participants):
+    """
+    Pair each message of a conversation with the users it is unread for:
+    every participant except its sender and anyone who sent a later message
+    in the batch, since they have read the conversation up to that point.
+    """
+    users = set(participants) | {message['user_id'] for message in conversation_messages}
+    later_senders = set()
+    planned = []
+
+    for message in reversed(conversation_messages):
+        planned.append((message, users - later_senders - {message['user_id']}))
+        later_senders.add(message['user_id'])
+
+    planned.reverse()
+    return planned
+
+def group_by_conversation(messages):
+    """Group messages by conversation, keeping batch order"""
+    messages_by_conversation = {}
+    for message in messages:
+        messages_by_conversation.setdefault(message['conversation_id'], []).append(message)
+    return messages_by_conversation
+
+def update_unread_counters(messages, participant_futures):
+    """
+    Reset the unread counter of every sender in the batch and, for direct
+    conversations, increment the counters of the recipients. Group
+    recipients are counted by the fan-out workers. All counters of the batch
+    are updated in one pipeline.
+    """
+    redis_client = get_redis_client()
+    if redis_client is None:
+        return
+
+    pipe = redis_client.pipeline(transaction=False)
+
+    for conversation_id, conversation_messages in group_by_conversation(messages).items():
+        for sender in {message['user_id'] for message in conversation_messages}:
+            pipe.hdel(unread_counts_key(sender), conversation_id)
+
+        if conversation_messages[0]['is_group']:
+            continue
+
+        try:
+            participants = participant_futures[conversation_id].result()
+        except Exception as e:
+            print(f"Error loading participants of conversation {conversation_id}: {str(e)}")
+            continue
+
+        unread = {}
+        for message, recipients in plan_recipients(conversation_messages, participants):
+            for user_id in recipients:
+                unread[user_id] = unread.get(user_id, 0) + 1
+
+        for user_id, count in unread.items():
+            key = unread_counts_key(user_id)
+            pipe.hincrby(key, conversation_id, count)
+            pipe.expire(key, UNREAD_COUNTS_TTL)
+
+    try:
+        pipe.execute()
+    except redis.RedisError as e:
+        print(f"Error updating unread counters: {str(e)}")
+
+def update_inboxes(messages, conversation_updates, participant_futures):
+    """
+    Copy the newest activity of each conversation onto its participants'
+    user_conversations rows (the inbox) on the worker pool. For group
+    conversations only the senders' rows are updated here; the fan-out
+    workers update the recipients. Returns the conversation IDs whose rows
+    could not all be updated.
+    """
+    failed_conversations = set()
+    futures = []
+
+    for conversation_id, conversation_messages in group_by_conversation(messages).items():
+        newest = conversation_updates[conversation_id]
+        senders = {message['user_id'] for message in conversation_messages}
+        users = set(senders)
+
+        if not newest['is_group']:
+            try:
+                users.update(participant_futures[conversation_id].result())
+            except Exception as e:
+                print(f"Error loading participants of conversation {conversation_id}: {str(e)}")
+                failed_conversations.add(conversation_id)
+                continue
+
+        for user_id in users:
+            futures.append((conversation_id, _executor.submit(
+                write_inbox_row, user_id, conversation_id, newest['timestamp'], newest['preview'], user_id in senders
+            )))
+
+    for conversation_id, future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Error updating inbox rows of conversation {conversation_id}: {str(e)}")
+            failed_conversations.add(conversation_id)
+
+    return failed_conversations
+
+def write_inbox_row(user_id, conversation_id, timestamp, preview, is_sender):
+    """Update one inbox row with the thread's DynamoDB resource"""
+    return update_inbox_row(
+        get_dynamodb().Table(USER_CONVERSATIONS_TABLE),
+        user_id, conversation_id, timestamp, preview, create=is_sender
+    )
+
+def enqueue_fanout(group_messages, participant_futures):
+    """
+    Split every group message into jobs of FANOUT_CHUNK_SIZE recipients and
+    send them to the fan-out queue, so large groups spread across parallel
+    workers. Jobs of the same conversation and chunk share a FIFO message
+    group, which keeps their notifications in order. Returns the message
+    IDs whose jobs could not be enqueued.
+    """
+    failed_message_ids = set()
+    jobs = []
+
+    for conversation_id, conversation_messages in group_by_conversation(group_messages).items():
+        try:
+            participants = participant_futures[conversation_id].result()
+        except Exception as e:
+            print(f"Error loading participants of conversation {conversation_id}: {str(e)}")
+            failed_message_ids.update(message['message_id'] for message in conversation_messages)
+            continue
+
+        for message, recipients in plan_recipients(conversation_messages, participants):
+            recipients = sorted(recipients)
+            for chunk_index, i in enumerate(range(0, len(recipients), FANOUT_CHUNK_SIZE)):
+                jobs.append((message['message_id'], f"{conversation_id}#{chunk_index}", {
+                    **message['notification'],
+                    'preview': message['preview'],
+                    'chunk_index': chunk_index,
+                    'recipient_ids': recipients[i:i + FANOUT_CHUNK_SIZE]
+                }))
+
+    for i in range(0, len(jobs), SEND_MESSAGE_BATCH_MAX_ENTRIES):
+        batch = jobs[i:i + SEND_MESSAGE_BATCH_MAX_ENTRIES]
+        try:
+            response = sqs.send_message_batch(
+                QueueUrl=FANOUT_QUEUE_URL,
+                Entries=[
+                    {
+                        'Id': str(n),
+                        'MessageBody': json.dumps(job),
+                        'MessageGroupId': group_id,
+                        'MessageDeduplicationId': f"{message_id}-{job['chunk_index']}"
+                    }
+                    for n, (message_id, group_id, job) in enumerate(batch)
+                ]
+            )
+            for failure in response.get('Failed', []):
+                failed_message_ids.add(batch[int(failure['Id'])][0])
+        except Exception as e:
+            print(f"Error enqueueing fan-out jobs: {str(e)}")
+            failed_message_ids.update(message_id for message_id, group_id, job in batch)
+
+    return failed_message_ids
+
+def flush_conversation_activity(force=False):
+    """
+    Write buffered conversation activity to DynamoDB. Only conversations that
+    have been dirty for the flush interval are written unless force is set.
+    Returns the number of conversations flushed.
+    """
+    redis_client = get_redis_client()
+    if redis_client is None:
+        return 0
+
+    max_score = '+inf' if force else time.time() - ACTIVITY_FLUSH_INTERVAL_SECONDS
+    due_conversations = redis_client.zrangebyscore(ACTIVITY_DIRTY_KEY, '-inf', max_score)
+
+    flushed = 0
+    for conversation_id in due_conversations:
+        # ZREM doubles as a claim so concurrent containers flush each conversation once
+        if not redis_client.zrem(ACTIVITY_DIRTY_KEY, conversation_id):
+            continue
+
+        activity_key = f"{ACTIVITY_KEY_PREFIX}{conversation_id}"
+        fields = redis_client.eval(TAKE_ACTIVITY_SCRIPT, 1, activity_key)
+        activity = dict(zip(fields[::2], fields[1::2]))
+
+        if not activity:
+            continue
+
+        try:
+            write_conversation_activity(conversation_id, activity['last_activity'], activity['last_message_preview'])
+            flushed += 1
+        except Exception as e:
+            print(f"Error flushing activity for conversation {conversation_id}: {str(e)}")
+            buffer_conversation_activity(redis_client, conversation_id, activity['last_activity'], activity['last_message_preview'])
+
+    return flushed
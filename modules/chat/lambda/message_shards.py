@@ -0,0 +1,119 @@
+import os
+import random
+import time
+import zlib
+
+# Hot conversations carry message_shards = N on their conversations row and
+# spread new messages over the chat_messages partitions conversation_id#0..N-1.
+# The unsharded partition keeps the messages written before the flag was set
+# (or while a container still had the old count cached), so readers always
+# include it. N may be raised but never lowered, or messages become unreadable.
+SHARD_COUNT_ATTRIBUTE = 'message_shards'
+SHARD_ATTRIBUTE = 'conversation_shard'
+SHARD_SEPARATOR = '#'
+
+# Seconds a container trusts a conversation's cached shard count
+SHARD_COUNT_CACHE_TTL = int(os.environ.get('SHARD_COUNT_CACHE_TTL', '60'))
+
+# BatchGetItem accepts at most 100 keys per call
+BATCH_GET_MAX_KEYS = 100
+BATCH_GET_MAX_RETRIES = int(os.environ.get('BATCH_GET_MAX_RETRIES', '5'))
+
+# conversation_id -> (shard count, expiry), reused across warm invocations
+_shard_counts = {}
+
+def shard_key(conversation_id, shard):
+    """chat_messages partition key of one shard of a conversation"""
+    return f"{conversation_id}{SHARD_SEPARATOR}{shard}"
+
+def partition_keys(conversation_id, shard_count):
+    """Every chat_messages partition key that may hold messages of a conversation"""
+    return [conversation_id] + [shard_key(conversation_id, shard) for shard in range(shard_count)]
+
+def pick_shard(message_id, shard_count):
+    """Stable shard for a message, so a retried record lands on the same key"""
+    return zlib.crc32(message_id.encode('utf-8')) % shard_count
+
+def shard_item(item, shard_count):
+    """Return a chat_messages item keyed on its shard of a sharded conversation"""
+    if not shard_count:
+        return item
+
+    shard = pick_shard(item['message_id'], shard_count)
+    return {
+        **item,
+        'conversation_id': shard_key(item['conversation_id'], shard),
+        SHARD_ATTRIBUTE: shard
+    }
+
+def logical_conversation_id(item):
+    """Conversation ID of a chat_messages item, sharded or not"""
+    if SHARD_ATTRIBUTE in item:
+        return item['conversation_id'].rsplit(SHARD_SEPARATOR, 1)[0]
+    return item['conversation_id']
+
+def get_shard_counts(dynamodb, conversations_table, conversation_ids):
+    """
+    Return conversation_id -> shard count (0 when not sharded), reading
+    conversations missing from the container cache with BatchGetItem.
+    Raises RuntimeError when DynamoDB keeps leaving keys unprocessed rather
+    than caching a count of 0 for them.
+    """
+    now = time.time()
+    counts = {}
+    missing = []
+
+    for conversation_id in set(conversation_ids):
+        cached = _shard_counts.get(conversation_id)
+        if cached is not None and cached[1] > now:
+            counts[conversation_id] = cached[0]
+        else:
+            missing.append(conversation_id)
+
+    for i in range(0, len(missing), BATCH_GET_MAX_KEYS):
+        keys = [{'conversation_id': conversation_id} for conversation_id in missing[i:i + BATCH_GET_MAX_KEYS]]
+        request = {
+            conversations_table: {
+                'Keys': keys,
+                'ProjectionExpression': 'conversation_id, #shards',
+                'ExpressionAttributeNames': {'#shards': SHARD_COUNT_ATTRIBUTE}
+            }
+        }
+
+        attempt = 0
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response.get('Responses', {}).get(conversations_table, []):
+                counts[item['conversation_id']] = int(item.get(SHARD_COUNT_ATTRIBUTE, 0))
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+
+            attempt += 1
+            if attempt > BATCH_GET_MAX_RETRIES:
+                raise RuntimeError(f"Shard counts still unprocessed after {BATCH_GET_MAX_RETRIES} retries")
+
+            # Exponential backoff: 50ms, 100ms, 200ms, ... capped at 2s, with
+            # jitter so concurrent containers do not retry in step
+            time.sleep(min(0.05 * (2 ** (attempt - 1)), 2) + random.uniform(0, 0.05))
+
+    expiry = now + SHARD_COUNT_CACHE_TTL
+    for conversation_id in missing:
+        counts.setdefault(conversation_id, 0)
+        _shard_counts[conversation_id] = (counts[conversation_id], expiry)
+
+    return counts
+
+def merge_pages(pages, limit):
+    """
+    Merge newest-first pages of several partitions into one page of `limit`
+    items ordered by timestamp_message_id. Each page is (items, has_more).
+    Returns the merged items and whether older items may exist.
+    """
+    items = sorted(
+        (item for page_items, _ in pages for item in page_items),
+        key=lambda item: item['timestamp_message_id'],
+        reverse=True
+    )
+    has_more = len(items) > limit or any(has_more for _, has_more in pages)
+    return items[:limit], has_more
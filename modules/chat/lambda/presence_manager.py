@@ -1,13 +1,148 @@
 import json
 import boto3
+import redis
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
+from message_cache import get_redis_client, get_values, get_participants, participants_key
+
 # Initialize AWS clients
 dynamodb = boto3.resource('dynamodb')
+sns = boto3.client('sns')
 
 # Environment variables
 USER_PRESENCE_TABLE = os.environ['USER_PRESENCE_TABLE']
+USER_CONVERSATIONS_TABLE = os.environ.get('USER_CONVERSATIONS_TABLE', '')
+PRESENCE_TOPIC = os.environ.get('PRESENCE_TOPIC', '')
+PUBLISH_BATCH_MAX_RETRIES = int(os.environ.get('PUBLISH_BATCH_MAX_RETRIES', '3'))
+IO_CONCURRENCY = max(1, int(os.environ.get('IO_CONCURRENCY', '16')))
+
+# Presence expires this many seconds after the last update
+PRESENCE_TTL = 300
+
+# Redis copy of each user's presence, written through on every update
+PRESENCE_KEY_PREFIX = 'presence:'
+
+# BatchGetItem accepts at most 100 keys per call
+BATCH_GET_MAX_KEYS = 100
+BATCH_GET_MAX_RETRIES = int(os.environ.get('BATCH_GET_MAX_RETRIES', '5'))
+
+# Heartbeats only touch Redis: online users sit in a sorted set scored by
+# last_seen, and a user is written to DynamoDB again once their record is
+# older than HEARTBEAT_PERSIST_INTERVAL. The interval plus the flush period
+# (one minute) must stay below PRESENCE_TTL so live records never expire.
+# The shared presence keys carry one hash tag so scripts touching several of
+# them run in a single cluster slot; per-user entries live in their own slots.
+ONLINE_USERS_KEY = '{presence}:online'
+PRESENCE_DIRTY_KEY = '{presence}:dirty'
+HEARTBEAT_PERSIST_INTERVAL = int(os.environ.get('HEARTBEAT_PERSIST_INTERVAL', '120'))
+
+# Flushed heartbeats are conditional puts, which BatchWriteItem does not
+# support, so they run on a worker pool with one resource per thread
+_executor = ThreadPoolExecutor(max_workers=IO_CONCURRENCY)
+_thread_local = threading.local()
+
+# Users persisted per flush step
+FLUSH_CHUNK_SIZE = 500
+
+# Stop flushing below this much remaining time, the rest waits for the next run
+FLUSH_TIME_MARGIN_MS = 5 * 1000
+
+# Status transitions ([user_id, previous, status, last_seen]) queued for the
+# next flush, which publishes them to PRESENCE_TOPIC
+PRESENCE_TRANSITIONS_KEY = '{presence}:transitions'
+
+# PublishBatch accepts at most 10 entries per call
+PUBLISH_BATCH_MAX_ENTRIES = 10
+
+# Set a user's status entry and return the previous status; the caller
+# then updates the online set and queues a transition when it changed. A
+# missing entry means offline.
+SET_STATUS_SCRIPT = """
+local previous = 'offline'
+local cached = redis.call('GET', KEYS[1])
+if cached then
+    previous = cjson.decode(cached)[1]
+end
+redis.call('SET', KEYS[1], cjson.encode({ARGV[1], ARGV[2], tonumber(ARGV[3])}), 'EX', ARGV[4])
+return previous
+"""
+
+# Take every queued transition and clear the queue in one step
+DRAIN_TRANSITIONS_SCRIPT = """
+local queued = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1])
+return queued
+"""
+
+# Remove up to ARGV[2] online users idle since ARGV[1] and queue their
+# offline transitions, atomically so a concurrent heartbeat is never lost
+EXPIRE_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES', 'LIMIT', 0, ARGV[2])
+for i = 1, #expired, 2 do
+    local user_id = expired[i]
+    redis.call('ZREM', KEYS[1], user_id)
+    redis.call('SREM', KEYS[2], user_id)
+    redis.call('RPUSH', KEYS[3], cjson.encode({user_id, 'online', 'offline', tonumber(expired[i + 1])}))
+end
+return #expired / 2
+"""
+
+# Cached presence entries are [status, last_seen, persisted_at]. A heartbeat
+# keeps the status and refreshes the entry, returning {status, persisted_at};
+# the caller then refreshes the online set. Without a cached entry nothing
+# changes and the caller loads the record first.
+HEARTBEAT_SCRIPT = """
+local cached = redis.call('GET', KEYS[1])
+if not cached then
+    return false
+end
+local entry = cjson.decode(cached)
+local persisted_at = tonumber(entry[3]) or 0
+redis.call('SET', KEYS[1], cjson.encode({entry[1], ARGV[1], persisted_at}), 'EX', ARGV[2])
+return {entry[1], tostring(persisted_at)}
+"""
+
+# Apply a user's status (ARGV[2]) to the shared keys: the online set
+# (KEYS[1]) scored by ARGV[3], the dirty set (KEYS[2], added to when ARGV[4]
+# is '1') and, when ARGV[5] holds a different previous status, a transition
+# on KEYS[3] with last_seen ARGV[6]
+ONLINE_STATUS_SCRIPT = """
+if ARGV[2] == 'online' then
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+    if ARGV[4] == '1' then
+        redis.call('SADD', KEYS[2], ARGV[1])
+    end
+else
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('SREM', KEYS[2], ARGV[1])
+end
+if ARGV[5] ~= '' and ARGV[5] ~= ARGV[2] then
+    redis.call('RPUSH', KEYS[3], cjson.encode({ARGV[1], ARGV[5], ARGV[2], ARGV[6]}))
+end
+return 1
+"""
+
+# Conversations up to this many participants are read in one SMEMBERS;
+# larger ones are scanned in chunks so a single call never blocks Redis for long
+ONLINE_INTERSECT_MAX_PARTICIPANTS = 1000
+
+# Record when an online user was persisted, keeping the entry's expiry
+MARK_PERSISTED_SCRIPT = """
+local cached = redis.call('GET', KEYS[1])
+local ttl = redis.call('PTTL', KEYS[1])
+if not cached or ttl <= 0 then
+    return 0
+end
+local entry = cjson.decode(cached)
+entry[3] = tonumber(ARGV[1])
+redis.call('SET', KEYS[1], cjson.encode(entry), 'PX', ttl)
+return 1
+"""
 
 def handler(event, context):
     """
@@ -18,6 +153,54 @@ def handler(event, context):
         
         # Parse the event
         action = event.get('action')
+
+        if action == 'flush_presence':
+            # Scheduled write-behind of heartbeats, expiry of idle users and
+            # publication of the window's status transitions
+            persisted, expired = flush_presence(context)
+            published = publish_transitions()
+            return {
+                'statusCode': 200,
+                'body': json.dumps(
+                    f'Persisted {persisted} heartbeats, expired {expired} users, published {published} transitions'
+                )
+            }
+
+        if action == 'get_status_batch':
+            # Presence of many users (e.g. every contact on screen) in one call
+            user_ids = event.get('user_ids')
+            if not user_ids or not isinstance(user_ids, list):
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps('user_ids is required')
+                }
+
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'presence': get_presence_batch(list(dict.fromkeys(user_ids)))
+                })
+            }
+
+        if action == 'get_online_participants':
+            # The online subset of a conversation's participants
+            conversation_id = event.get('conversation_id')
+            if not conversation_id:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps('conversation_id is required')
+                }
+
+            online = get_online_participants(conversation_id)
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'conversation_id': conversation_id,
+                    'online_user_ids': online,
+                    'online_count': len(online)
+                })
+            }
+
         user_id = event.get('user_id')
         
         if not user_id:
@@ -27,7 +210,7 @@ def handler(event, context):
             }
         
         current_timestamp = datetime.now(timezone.utc).isoformat()
-        ttl_timestamp = int(datetime.now(timezone.utc).timestamp()) + 300  # 5 minutes TTL
+        ttl_timestamp = int(datetime.now(timezone.utc).timestamp()) + PRESENCE_TTL  # 5 minutes TTL
         
         if action == 'online':
             # Set user as online
@@ -39,6 +222,7 @@ def handler(event, context):
                     'ttl': ttl_timestamp
                 }
             )
+            set_presence_status(user_id, 'online', current_timestamp)
             
         elif action == 'offline':
             # Set user as offline
@@ -50,41 +234,35 @@ def handler(event, context):
                     'ttl': ttl_timestamp
                 }
             )
+            set_presence_status(user_id, 'offline', current_timestamp)
             
         elif action == 'heartbeat':
-            # Update last seen timestamp
-            presence_table.update_item(
-                Key={'user_id': user_id},
-                UpdateExpression='SET last_seen = :timestamp, #ttl = :ttl',
-                ExpressionAttributeNames={'#ttl': 'ttl'},
-                ExpressionAttributeValues={
-                    ':timestamp': current_timestamp,
-                    ':ttl': ttl_timestamp
-                }
-            )
+            # Update last seen timestamp in Redis, the flusher persists it
+            if not record_heartbeat(user_id, current_timestamp):
+                response = presence_table.update_item(
+                    Key={'user_id': user_id},
+                    UpdateExpression='SET last_seen = :timestamp, #ttl = :ttl',
+                    ExpressionAttributeNames={'#ttl': 'ttl'},
+                    ExpressionAttributeValues={
+                        ':timestamp': current_timestamp,
+                        ':ttl': ttl_timestamp
+                    },
+                    ReturnValues='ALL_NEW'
+                )
+                cache_presence({user_id: (response['Attributes'].get('status', 'offline'), current_timestamp)})
             
         elif action == 'get_status':
-            # Get user's current status
-            response = presence_table.get_item(Key={'user_id': user_id})
-            
-            if 'Item' in response:
-                return {
-                    'statusCode': 200,
-                    'body': json.dumps({
-                        'user_id': user_id,
-                        'status': response['Item'].get('status', 'offline'),
-                        'last_seen': response['Item'].get('last_seen')
-                    })
-                }
-            else:
-                return {
-                    'statusCode': 200,
-                    'body': json.dumps({
-                        'user_id': user_id,
-                        'status': 'offline',
-                        'last_seen': None
-                    })
-                }
+            # Get user's current status (the table lags heartbeats, the cache does not)
+            presence = get_presence_batch([user_id])[user_id]
+
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'user_id': user_id,
+                    'status': presence['status'],
+                    'last_seen': presence['last_seen']
+                })
+            }
         
         return {
             'statusCode': 200,
@@ -96,4 +274,449 @@ def handler(event, context):
         return {
             'statusCode': 500,
             'body': json.dumps(f'Error: {str(e)}')
-        }
\ No newline at end of file
+        }
+
+def presence_key(user_id):
+    """Redis string holding the cached presence of a user"""
+    return f"{PRESENCE_KEY_PREFIX}{user_id}"
+
+def cache_presence(presence, ttls=None):
+    """
+    Write user_id -> (status, last_seen) into the presence cache. Entries
+    expire with the presence record, after ttls[user_id] or PRESENCE_TTL
+    seconds.
+    """
+    redis_client = get_redis_client()
+    if redis_client is None or not presence:
+        return
+
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for user_id, (status, last_seen) in presence.items():
+            ttl = (ttls or {}).get(user_id, PRESENCE_TTL)
+            # The record was written PRESENCE_TTL seconds before it expires
+            persisted_at = time.time() + ttl - PRESENCE_TTL
+            pipe.set(presence_key(user_id), json.dumps([status, last_seen, persisted_at]), ex=max(1, ttl))
+        pipe.execute()
+    except redis.RedisError as e:
+        print(f"Error caching presence: {str(e)}")
+
+def get_online_participants(conversation_id):
+    """
+    Return the online participants of a conversation, intersecting the
+    cached participant set with the online users set inside Redis. The
+    participants are only loaded when their set is not cached, and presence
+    is looked up per participant only when Redis is not available.
+    """
+    redis_client = get_redis_client()
+    participants = None
+
+    if redis_client is not None:
+        try:
+            online = intersect_online(redis_client, conversation_id)
+            if online is None:
+                # Cache the participant set, then intersect again
+                participants = load_conversation_participants(redis_client, conversation_id)
+                if not participants:
+                    return []
+                online = intersect_online(redis_client, conversation_id)
+            if online is not None:
+                return sorted(online)
+        except redis.RedisError as e:
+            print(f"Online users unavailable: {str(e)}")
+
+    if participants is None:
+        participants = load_conversation_participants(redis_client, conversation_id)
+    presence = get_presence_batch(participants)
+    return sorted(user_id for user_id, entry in presence.items() if entry['status'] == 'online')
+
+def load_conversation_participants(redis_client, conversation_id):
+    """Participants of a conversation through the Redis participants cache"""
+    return get_participants(redis_client, dynamodb.Table(USER_CONVERSATIONS_TABLE), conversation_id)
+
+def intersect_online(redis_client, conversation_id):
+    """
+    Intersect a conversation's cached participant set with the online users
+    set. The two sit in different cluster slots, so the participants are
+    read (in one SMEMBERS, or with SSCAN for large groups) and their scores
+    looked up with ZMSCORE. Returns None when the participant set is not
+    cached.
+    """
+    cutoff = time.time() - PRESENCE_TTL
+    key = participants_key(conversation_id)
+
+    count = redis_client.scard(key)
+    if count == 0:
+        return None
+
+    if count <= ONLINE_INTERSECT_MAX_PARTICIPANTS:
+        return online_among(redis_client, list(redis_client.smembers(key)), cutoff)
+
+    online = set()
+    cursor = 0
+    while True:
+        cursor, user_ids = redis_client.sscan(key, cursor, count=ONLINE_INTERSECT_MAX_PARTICIPANTS)
+        online.update(online_among(redis_client, user_ids, cutoff))
+        if cursor == 0:
+            return online
+
+def online_among(redis_client, user_ids, cutoff):
+    """The users whose online score is at least cutoff"""
+    if not user_ids:
+        return set()
+    scores = redis_client.zmscore(ONLINE_USERS_KEY, user_ids)
+    return {user_id for user_id, score in zip(user_ids, scores) if score is not None and score >= cutoff}
+
+def set_presence_status(user_id, status, timestamp):
+    """
+    Cache a user's new status (just persisted), update the online set and
+    queue a transition if the status changed
+    """
+    redis_client = get_redis_client()
+    if redis_client is None:
+        return
+
+    try:
+        now = time.time()
+        previous = redis_client.eval(SET_STATUS_SCRIPT, 1, presence_key(user_id), status, timestamp, now, PRESENCE_TTL)
+        apply_online_status(redis_client, user_id, status, now, previous=previous, last_seen=timestamp)
+    except redis.RedisError as e:
+        print(f"Error caching presence of {user_id}: {str(e)}")
+
+def apply_online_status(redis_client, user_id, status, score, mark_dirty=False, previous='', last_seen=''):
+    """
+    Bring the shared online, dirty and transition keys in line with a status
+    just written to a user's entry. The entry and the shared keys sit in
+    different cluster slots, so this is a second step: the entry is read
+    again afterwards and a status changed concurrently in between wins.
+    """
+    redis_client.eval(
+        ONLINE_STATUS_SCRIPT, 3, ONLINE_USERS_KEY, PRESENCE_DIRTY_KEY, PRESENCE_TRANSITIONS_KEY,
+        user_id, status, score, '1' if mark_dirty else '0', previous, last_seen
+    )
+
+    cached = redis_client.get(presence_key(user_id))
+    current = json.loads(cached)[0] if cached else status
+    if current != status:
+        redis_client.eval(
+            ONLINE_STATUS_SCRIPT, 3, ONLINE_USERS_KEY, PRESENCE_DIRTY_KEY, PRESENCE_TRANSITIONS_KEY,
+            user_id, current, time.time(), '0', '', ''
+        )
+
+def record_heartbeat(user_id, timestamp):
+    """
+    Record a heartbeat in Redis only. Returns False when Redis is not
+    available and the heartbeat must be written to DynamoDB directly.
+    """
+    redis_client = get_redis_client()
+    if redis_client is None:
+        return False
+
+    try:
+        for _ in range(2):
+            entry = redis_client.eval(HEARTBEAT_SCRIPT, 1, presence_key(user_id), timestamp, PRESENCE_TTL)
+            if entry is not None:
+                status, persisted_at = entry
+                if status == 'online':
+                    now = time.time()
+                    apply_online_status(
+                        redis_client, user_id, 'online', now,
+                        mark_dirty=now - float(persisted_at) >= HEARTBEAT_PERSIST_INTERVAL
+                    )
+                return True
+            # Not cached (evicted, or the presence expired): load the record
+            # into the cache and apply the heartbeat to it
+            get_presence_batch([user_id])
+        return False
+    except redis.RedisError as e:
+        print(f"Error recording heartbeat in Redis: {str(e)}")
+        return False
+
+def flush_presence(context):
+    """
+    Expire online users whose last heartbeat is older than PRESENCE_TTL and
+    persist the dirty heartbeats to DynamoDB with conditional puts. Returns
+    the number of persisted and expired users.
+    """
+    redis_client = get_redis_client()
+    if redis_client is None:
+        return 0, 0
+
+    now = time.time()
+    expired = 0
+    while True:
+        count = redis_client.eval(
+            EXPIRE_SCRIPT, 3, ONLINE_USERS_KEY, PRESENCE_DIRTY_KEY, PRESENCE_TRANSITIONS_KEY,
+            now - PRESENCE_TTL, FLUSH_CHUNK_SIZE
+        )
+        expired += count
+        if count < FLUSH_CHUNK_SIZE or context.get_remaining_time_in_millis() <= FLUSH_TIME_MARGIN_MS:
+            break
+
+    persisted = 0
+    while context.get_remaining_time_in_millis() > FLUSH_TIME_MARGIN_MS:
+        user_ids = redis_client.spop(PRESENCE_DIRTY_KEY, FLUSH_CHUNK_SIZE)
+        if not user_ids:
+            break
+
+        pipe = redis_client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.zscore(ONLINE_USERS_KEY, user_id)
+        scores = pipe.execute()
+
+        # Users who went offline since their heartbeat have no score
+        last_seen = {user_id: score for user_id, score in zip(user_ids, scores) if score is not None}
+        unwritten = persist_heartbeats(last_seen)
+
+        if unwritten:
+            redis_client.sadd(PRESENCE_DIRTY_KEY, *unwritten)
+
+        pipe = redis_client.pipeline(transaction=False)
+        for user_id in last_seen:
+            if user_id not in unwritten:
+                pipe.eval(MARK_PERSISTED_SCRIPT, 1, presence_key(user_id), now)
+        pipe.execute()
+
+        persisted += len(last_seen) - len(unwritten)
+
+    return persisted, expired
+
+def drain_transitions(redis_client):
+    """
+    Take every queued transition and collapse them to one per user: the
+    first previous status and the last new status of the window. Users who
+    ended the window in the status they started it in are left out.
+    """
+    queued = redis_client.eval(DRAIN_TRANSITIONS_SCRIPT, 1, PRESENCE_TRANSITIONS_KEY)
+
+    transitions = {}
+    for entry in queued:
+        user_id, previous, status, last_seen = json.loads(entry)
+        if isinstance(last_seen, (int, float)):
+            last_seen = datetime.fromtimestamp(last_seen, tz=timezone.utc).isoformat()
+
+        if user_id in transitions:
+            previous = transitions[user_id]['previous_status']
+        transitions[user_id] = {
+            'user_id': user_id,
+            'status': status,
+            'previous_status': previous,
+            'last_seen': last_seen
+        }
+
+    return [
+        transition for transition in transitions.values()
+        if transition['status'] != transition['previous_status']
+    ]
+
+def publish_transitions():
+    """
+    Publish the status transitions of the flush window to PRESENCE_TOPIC
+    with PublishBatch. Returns the number of published transitions.
+    """
+    redis_client = get_redis_client()
+    if redis_client is None or not PRESENCE_TOPIC:
+        return 0
+
+    transitions = drain_transitions(redis_client)
+
+    published = 0
+    unpublished = []
+    for i in range(0, len(transitions), PUBLISH_BATCH_MAX_ENTRIES):
+        chunk = transitions[i:i + PUBLISH_BATCH_MAX_ENTRIES]
+        failed = publish_transition_batch(chunk)
+        published += len(chunk) - len(failed)
+        unpublished.extend(transition for transition in chunk if transition['user_id'] in failed)
+
+    if unpublished:
+        requeue_transitions(redis_client, unpublished)
+
+    return published
+
+def requeue_transitions(redis_client, transitions):
+    """
+    Put transitions that could not be published back on the queue for the
+    next flush. They go to the head so transitions queued since the drain
+    still collapse onto them in order.
+    """
+    entries = [
+        json.dumps([t['user_id'], t['previous_status'], t['status'], t['last_seen']])
+        for t in transitions
+    ]
+    try:
+        redis_client.lpush(PRESENCE_TRANSITIONS_KEY, *entries)
+    except redis.RedisError as e:
+        print(f"Error requeueing {len(entries)} presence transitions: {str(e)}")
+
+def publish_transition_batch(transitions):
+    """
+    Publish up to 10 transitions with PublishBatch, retrying failed entries
+    that are not sender faults. Returns the user IDs that were not published.
+    """
+    failed_user_ids = set()
+    pending = {str(i): transition for i, transition in enumerate(transitions)}
+
+    attempt = 0
+    while pending:
+        try:
+            response = sns.publish_batch(
+                TopicArn=PRESENCE_TOPIC,
+                PublishBatchRequestEntries=[
+                    {
+                        'Id': entry_id,
+                        'Message': json.dumps(transition),
+                        'MessageAttributes': {
+                            'status': {
+                                'DataType': 'String',
+                                'StringValue': transition['status']
+                            }
+                        }
+                    }
+                    for entry_id, transition in pending.items()
+                ]
+            )
+        except Exception as e:
+            print(f"Error publishing presence transitions: {str(e)}")
+            failed_user_ids.update(transition['user_id'] for transition in pending.values())
+            break
+
+        retry = {}
+        for failure in response.get('Failed', []):
+            if failure.get('SenderFault'):
+                print(f"Presence transition {failure['Id']} rejected: {failure.get('Code')} {failure.get('Message')}")
+                failed_user_ids.add(pending[failure['Id']]['user_id'])
+            else:
+                retry[failure['Id']] = pending[failure['Id']]
+        pending = retry
+
+        if not pending:
+            break
+
+        attempt += 1
+        if attempt > PUBLISH_BATCH_MAX_RETRIES:
+            failed_user_ids.update(transition['user_id'] for transition in pending.values())
+            break
+
+        time.sleep(min(0.05 * (2 ** (attempt - 1)), 2))
+
+    return failed_user_ids
+
+def get_presence_table():
+    """Return the user_presence table of the current thread (resources are not thread safe)"""
+    if not hasattr(_thread_local, 'presence_table'):
+        _thread_local.presence_table = boto3.session.Session().resource('dynamodb').Table(USER_PRESENCE_TABLE)
+    return _thread_local.presence_table
+
+def persist_heartbeat(user_id, seen):
+    """
+    Put the presence record of an online user from its last heartbeat epoch,
+    unless the record was written after that heartbeat (e.g. the user went
+    offline since the flush read it). Returns False when the put failed.
+    """
+    presence_table = get_presence_table()
+    last_seen = datetime.fromtimestamp(seen, tz=timezone.utc).isoformat()
+    try:
+        presence_table.put_item(
+            Item={
+                'user_id': user_id,
+                'status': 'online',
+                'last_seen': last_seen,
+                'ttl': int(seen) + PRESENCE_TTL
+            },
+            ConditionExpression='attribute_not_exists(user_id) OR last_seen < :last_seen',
+            ExpressionAttributeValues={':last_seen': last_seen}
+        )
+    except presence_table.meta.client.exceptions.ConditionalCheckFailedException:
+        # A newer record stands; nothing left to persist
+        pass
+    except Exception as e:
+        print(f"Error persisting heartbeat of user {user_id}: {str(e)}")
+        return False
+    return True
+
+def persist_heartbeats(last_seen):
+    """
+    Persist the heartbeats of online users (user_id -> last heartbeat epoch)
+    concurrently. Returns the user IDs that were not written.
+    """
+    user_ids = list(last_seen)
+    written = _executor.map(lambda user_id: persist_heartbeat(user_id, last_seen[user_id]), user_ids)
+    # Unwritten users stay dirty and are retried on the next flush
+    return {user_id for user_id, ok in zip(user_ids, written) if not ok}
+
+def get_presence_batch(user_ids):
+    """
+    Return user_id -> {'status', 'last_seen'} for every user, reading the
+    presence cache first and the misses from user_presence with
+    BatchGetItem. Users without a live presence record are offline.
+    """
+    presence = {}
+    redis_client = get_redis_client()
+
+    if redis_client is not None:
+        try:
+            cached_entries = get_values(redis_client, [presence_key(user_id) for user_id in user_ids])
+            for user_id, cached in zip(user_ids, cached_entries):
+                if cached is not None:
+                    status, last_seen = json.loads(cached)[:2]
+                    presence[user_id] = {'status': status, 'last_seen': last_seen}
+        except redis.RedisError as e:
+            print(f"Presence cache unavailable: {str(e)}")
+
+    misses = [user_id for user_id in user_ids if user_id not in presence]
+    loaded, ttls = load_presence(misses)
+
+    # Misses without a record are cached as offline too; online and
+    # offline updates overwrite the entry
+    cache_presence(loaded, ttls)
+    presence.update(
+        (user_id, {'status': status, 'last_seen': last_seen})
+        for user_id, (status, last_seen) in loaded.items()
+    )
+
+    return presence
+
+def load_presence(user_ids):
+    """
+    Read presence records with BatchGetItem in chunks of 100. Returns
+    user_id -> (status, last_seen) for every user and the seconds each
+    record has left to live. Records past their TTL that DynamoDB has not
+    deleted yet count as offline. Raises RuntimeError when DynamoDB keeps
+    leaving keys unprocessed, rather than caching those users as offline.
+    """
+    now = int(time.time())
+    presence = {user_id: ('offline', None) for user_id in user_ids}
+    ttls = {}
+
+    for i in range(0, len(user_ids), BATCH_GET_MAX_KEYS):
+        request = {
+            USER_PRESENCE_TABLE: {
+                'Keys': [{'user_id': user_id} for user_id in user_ids[i:i + BATCH_GET_MAX_KEYS]],
+                'ProjectionExpression': 'user_id, #status, last_seen, #ttl',
+                'ExpressionAttributeNames': {'#status': 'status', '#ttl': 'ttl'}
+            }
+        }
+
+        attempt = 0
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response.get('Responses', {}).get(USER_PRESENCE_TABLE, []):
+                ttl = int(item.get('ttl', 0)) - now
+                if ttl > 0:
+                    presence[item['user_id']] = (item.get('status', 'offline'), item.get('last_seen'))
+                    ttls[item['user_id']] = ttl
+                else:
+                    presence[item['user_id']] = ('offline', item.get('last_seen'))
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+
+            attempt += 1
+            if attempt > BATCH_GET_MAX_RETRIES:
+                raise RuntimeError(f"Presence records still unprocessed after {BATCH_GET_MAX_RETRIES} retries")
+
+            # Exponential backoff: 50ms, 100ms, 200ms, ... capped at 2s, with
+            # jitter so concurrent containers do not retry in step
+            time.sleep(min(0.05 * (2 ** (attempt - 1)), 2) + random.uniform(0, 0.05))
+
+    return presence, ttls
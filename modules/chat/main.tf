@@ -1,3 +1,5 @@
+# Hot conversations (message_shards = N on their conversations row) write
+# to conversation_id#0..N-1 partitions; readers merge all of them
 resource "aws_dynamodb_table" "chat_messages" {
   name           = "${var.name_prefix}-chat-messages"
   billing_mode   = "PAY_PER_REQUEST"
@@ -107,6 +109,10 @@ resource "aws_dynamodb_table" "user_conversations" {
   hash_key     = "user_id"
   range_key    = "conversation_id"
 
+  # Membership changes invalidate the cached participant sets
+  stream_enabled   = true
+  stream_view_type = "KEYS_ONLY"
+
   attribute {
     name = "user_id"
     type = "S"
@@ -122,6 +128,11 @@ resource "aws_dynamodb_table" "user_conversations" {
     type = "S"
   }
 
+  attribute {
+    name = "last_activity"
+    type = "S"
+  }
+
   global_secondary_index {
     name            = "ConversationParticipantsIndex"
     hash_key        = "conversation_id"
@@ -136,6 +147,15 @@ resource "aws_dynamodb_table" "user_conversations" {
     projection_type = "KEYS_ONLY"
   }
 
+  # Inbox: a user's conversations by recency, activity is copied onto
+  # every participant's row when a message is sent
+  global_secondary_index {
+    name            = "InboxIndex"
+    hash_key        = "user_id"
+    range_key       = "last_activity"
+    projection_type = "ALL"
+  }
+
   point_in_time_recovery {
     enabled = true
   }
@@ -199,4 +219,47 @@ resource "aws_kms_key" "chat_encryption" {
 resource "aws_kms_alias" "chat_encryption" {
   name          = "alias/${var.name_prefix}-chat-services"
   target_key_id = aws_kms_key.chat_encryption.key_id
-}
\ No newline at end of file
+}
+
+# Compressed per-conversation, per-day segments of messages past the hot window
+resource "aws_s3_bucket" "message_archive" {
+  bucket = "${var.name_prefix}-chat-message-archive-${data.aws_caller_identity.current.account_id}"
+  tags   = var.tags
+}
+
+resource "aws_s3_bucket_server_side_encryption_configuration" "message_archive" {
+  bucket = aws_s3_bucket.message_archive.id
+
+  rule {
+    apply_server_side_encryption_by_default {
+      sse_algorithm = "AES256"
+    }
+  }
+}
+
+resource "aws_s3_bucket_public_access_block" "message_archive" {
+  bucket = aws_s3_bucket.message_archive.id
+
+  block_public_acls       = true
+  block_public_policy     = true
+  ignore_public_acls      = true
+  restrict_public_buckets = true
+}
+
+resource "aws_s3_bucket_lifecycle_configuration" "message_archive" {
+  bucket = aws_s3_bucket.message_archive.id
+
+  rule {
+    id     = "message_segments"
+    status = "Enabled"
+
+    filter {
+      prefix = "segments/"
+    }
+
+    transition {
+      days          = 30
+      storage_class = "STANDARD_IA"
+    }
+  }
+}
@@ -8,6 +8,21 @@ output "group_chat_queue_arn" {
   value       = aws_sqs_queue.group_chat_fifo.arn
 }
 
+output "group_fanout_queue_arn" {
+  description = "SQS queue ARN for group message fan-out jobs"
+  value       = aws_sqs_queue.group_fanout.arn
+}
+
+output "presence_updates_topic_arn" {
+  description = "SNS topic ARN for presence status transitions"
+  value       = aws_sns_topic.presence_updates.arn
+}
+
+output "message_archive_bucket_name" {
+  description = "S3 bucket holding archived chat message segments"
+  value       = aws_s3_bucket.message_archive.bucket
+}
+
 output "chat_notifications_topic_arn" {
   description = "SNS topic ARN for chat notifications"
   value       = aws_sns_topic.chat_notifications.arn
@@ -56,4 +71,9 @@ output "message_processor_function_name" {
 output "presence_manager_function_name" {
   description = "Lambda function name for presence management"
   value       = aws_lambda_function.presence_manager.function_name
-}
\ No newline at end of file
+}
+
+output "message_history_function_name" {
+  description = "Lambda function name for reading conversation history"
+  value       = aws_lambda_function.message_history.function_name
+}
@@ -20,6 +20,32 @@ resource "aws_sqs_queue" "message_dlq" {
   tags = var.tags
 }
 
+# Queue of group message fan-out jobs (one chunk of recipients per message).
+# FIFO with one message group per conversation and chunk keeps each
+# recipient's notifications in conversation order, while different
+# conversations and chunks still run on parallel workers.
+resource "aws_sqs_queue" "group_fanout" {
+  name                       = "${var.name_prefix}-group-fanout.fifo"
+  fifo_queue                 = true
+  deduplication_scope        = "messageGroup"
+  fifo_throughput_limit      = "perMessageGroupId"
+  message_retention_seconds  = 86400
+  visibility_timeout_seconds = 60
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.group_fanout_dlq.arn
+    maxReceiveCount     = 3
+  })
+
+  tags = var.tags
+}
+
+resource "aws_sqs_queue" "group_fanout_dlq" {
+  name       = "${var.name_prefix}-group-fanout-dlq.fifo"
+  fifo_queue = true
+  tags       = var.tags
+}
+
 # FIFO queue for group chat ordering
 resource "aws_sqs_queue" "group_chat_fifo" {
   name                        = "${var.name_prefix}-group-chat.fifo"
@@ -60,6 +86,16 @@ resource "aws_sns_topic" "group_chat_notifications" {
   tags = var.tags
 }
 
+# Presence transitions (online <-> offline), published once per flush window
+resource "aws_sns_topic" "presence_updates" {
+  name = "${var.name_prefix}-presence-updates"
+
+  # Enable encryption
+  kms_master_key_id = aws_kms_key.chat_encryption.id
+
+  tags = var.tags
+}
+
 # Lambda function for message processing
 resource "aws_lambda_function" "message_processor" {
   filename         = data.archive_file.message_processor.output_path
@@ -79,6 +115,14 @@ resource "aws_lambda_function" "message_processor" {
       CHAT_NOTIFICATIONS_TOPIC  = aws_sns_topic.chat_notifications.arn
       GROUP_NOTIFICATIONS_TOPIC = aws_sns_topic.group_chat_notifications.arn
       REDIS_ENDPOINT            = var.redis_realtime_endpoint
+
+      ACTIVITY_FLUSH_INTERVAL_SECONDS = var.activity_flush_interval_seconds
+      IO_CONCURRENCY                  = var.message_processor_io_concurrency
+      RECENT_MESSAGES_CACHE_SIZE      = var.recent_messages_cache_size
+      FANOUT_QUEUE_URL                = aws_sqs_queue.group_fanout.url
+      FANOUT_CHUNK_SIZE               = var.group_fanout_chunk_size
+
+      MESSAGE_COMPRESSION_THRESHOLD_BYTES = var.message_compression_threshold_bytes
     }
   }
 
@@ -108,8 +152,127 @@ resource "aws_lambda_function" "presence_manager" {
 
   environment {
     variables = {
-      USER_PRESENCE_TABLE = aws_dynamodb_table.user_presence.name
-      REDIS_ENDPOINT      = var.redis_realtime_endpoint
+      USER_PRESENCE_TABLE        = aws_dynamodb_table.user_presence.name
+      USER_CONVERSATIONS_TABLE   = aws_dynamodb_table.user_conversations.name
+      REDIS_ENDPOINT             = var.redis_realtime_endpoint
+      HEARTBEAT_PERSIST_INTERVAL = var.presence_heartbeat_persist_interval_seconds
+      PRESENCE_TOPIC             = aws_sns_topic.presence_updates.arn
+    }
+  }
+
+  # VPC configuration for Redis access
+  dynamic "vpc_config" {
+    for_each = var.vpc_id != "" ? [1] : []
+    content {
+      subnet_ids         = var.subnet_ids
+      security_group_ids = [aws_security_group.lambda.id]
+    }
+  }
+
+  tags = var.tags
+}
+
+# Lambda function for reading conversation history
+resource "aws_lambda_function" "message_history" {
+  filename         = data.archive_file.message_history.output_path
+  function_name    = "${var.name_prefix}-message-history"
+  role            = aws_iam_role.lambda_execution.arn
+  handler         = "message_history.handler"
+  source_code_hash = data.archive_file.message_history.output_base64sha256
+  runtime         = "python3.11"
+  timeout         = 30
+
+  environment {
+    variables = {
+      CHAT_MESSAGES_TABLE        = aws_dynamodb_table.chat_messages.name
+      CONVERSATIONS_TABLE        = aws_dynamodb_table.conversations.name
+      USER_CONVERSATIONS_TABLE   = aws_dynamodb_table.user_conversations.name
+      REDIS_ENDPOINT             = var.redis_realtime_endpoint
+      RECENT_MESSAGES_CACHE_SIZE = var.recent_messages_cache_size
+      MESSAGE_ARCHIVE_BUCKET     = aws_s3_bucket.message_archive.bucket
+    }
+  }
+
+  # VPC configuration for Redis access
+  dynamic "vpc_config" {
+    for_each = var.vpc_id != "" ? [1] : []
+    content {
+      subnet_ids         = var.subnet_ids
+      security_group_ids = [aws_security_group.lambda.id]
+    }
+  }
+
+  tags = var.tags
+}
+
+# Lambda function fanning group messages out to recipient chunks
+resource "aws_lambda_function" "group_fanout" {
+  filename         = data.archive_file.group_fanout.output_path
+  function_name    = "${var.name_prefix}-group-fanout"
+  role            = aws_iam_role.lambda_execution.arn
+  handler         = "group_fanout.handler"
+  source_code_hash = data.archive_file.group_fanout.output_base64sha256
+  runtime         = "python3.11"
+  timeout         = 30
+
+  environment {
+    variables = {
+      GROUP_NOTIFICATIONS_TOPIC = aws_sns_topic.group_chat_notifications.arn
+      USER_CONVERSATIONS_TABLE  = aws_dynamodb_table.user_conversations.name
+      REDIS_ENDPOINT            = var.redis_realtime_endpoint
+    }
+  }
+
+  # VPC configuration for Redis access
+  dynamic "vpc_config" {
+    for_each = var.vpc_id != "" ? [1] : []
+    content {
+      subnet_ids         = var.subnet_ids
+      security_group_ids = [aws_security_group.lambda.id]
+    }
+  }
+
+  tags = var.tags
+}
+
+# Lambda function moving messages past the hot window to S3 segments
+resource "aws_lambda_function" "message_archiver" {
+  filename         = data.archive_file.message_archiver.output_path
+  function_name    = "${var.name_prefix}-message-archiver"
+  role            = aws_iam_role.lambda_execution.arn
+  handler         = "message_archiver.handler"
+  source_code_hash = data.archive_file.message_archiver.output_base64sha256
+  runtime         = "python3.11"
+  timeout         = 900
+
+  environment {
+    variables = {
+      CHAT_MESSAGES_TABLE    = aws_dynamodb_table.chat_messages.name
+      CONVERSATIONS_TABLE    = aws_dynamodb_table.conversations.name
+      MESSAGE_ARCHIVE_BUCKET = aws_s3_bucket.message_archive.bucket
+      ARCHIVE_AFTER_DAYS     = var.message_archive_after_days
+    }
+  }
+
+  # A single run at a time owns the read-modify-write of segments and indexes
+  reserved_concurrent_executions = 1
+
+  tags = var.tags
+}
+
+# Lambda function dropping cached participants on membership changes
+resource "aws_lambda_function" "participant_cache_invalidator" {
+  filename         = data.archive_file.group_fanout.output_path
+  function_name    = "${var.name_prefix}-participant-cache-invalidator"
+  role            = aws_iam_role.lambda_execution.arn
+  handler         = "group_fanout.invalidation_handler"
+  source_code_hash = data.archive_file.group_fanout.output_base64sha256
+  runtime         = "python3.11"
+  timeout         = 30
+
+  environment {
+    variables = {
+      REDIS_ENDPOINT = var.redis_realtime_endpoint
     }
   }
 
@@ -133,10 +296,47 @@ resource "aws_lambda_event_source_mapping" "message_processor" {
   
   # Error handling
   maximum_batching_window_in_seconds = 5
+
+  # Only failed records are returned to the queue
+  function_response_types = ["ReportBatchItemFailures"]
   
   depends_on = [aws_iam_role_policy_attachment.lambda_sqs_execution]
 }
 
+resource "aws_lambda_event_source_mapping" "group_fanout" {
+  event_source_arn = aws_sqs_queue.group_fanout.arn
+  function_name    = aws_lambda_function.group_fanout.arn
+  batch_size       = 10
+
+  # Only failed records are returned to the queue
+  function_response_types = ["ReportBatchItemFailures"]
+
+  # Spread large groups across parallel workers
+  scaling_config {
+    maximum_concurrency = var.group_fanout_max_concurrency
+  }
+
+  depends_on = [aws_iam_role_policy_attachment.lambda_sqs_execution]
+}
+
+resource "aws_lambda_event_source_mapping" "participant_cache_invalidator" {
+  event_source_arn  = aws_dynamodb_table.user_conversations.stream_arn
+  function_name     = aws_lambda_function.participant_cache_invalidator.arn
+  starting_position = "LATEST"
+  batch_size        = 100
+
+  maximum_batching_window_in_seconds = 1
+
+  # Only membership changes, not read/sent timestamp updates
+  filter_criteria {
+    filter {
+      pattern = jsonencode({
+        eventName = ["INSERT", "REMOVE"]
+      })
+    }
+  }
+}
+
 # EventBridge for real-time events
 resource "aws_cloudwatch_event_rule" "user_activity" {
   name        = "${var.name_prefix}-user-activity"
@@ -164,6 +364,86 @@ resource "aws_lambda_permission" "allow_eventbridge" {
   source_arn    = aws_cloudwatch_event_rule.user_activity.arn
 }
 
+# Periodic flush of the conversation activity write-behind buffer
+resource "aws_cloudwatch_event_rule" "conversation_activity_flush" {
+  count               = var.activity_flush_interval_seconds > 0 ? 1 : 0
+  name                = "${var.name_prefix}-conversation-activity-flush"
+  description         = "Flush buffered conversation last_activity to DynamoDB"
+  schedule_expression = "rate(1 minute)"
+
+  tags = var.tags
+}
+
+resource "aws_cloudwatch_event_target" "conversation_activity_flush" {
+  count     = var.activity_flush_interval_seconds > 0 ? 1 : 0
+  rule      = aws_cloudwatch_event_rule.conversation_activity_flush[0].name
+  target_id = "MessageProcessorActivityFlush"
+  arn       = aws_lambda_function.message_processor.arn
+
+  input = jsonencode({
+    action = "flush_conversation_activity"
+  })
+}
+
+resource "aws_lambda_permission" "allow_activity_flush" {
+  count         = var.activity_flush_interval_seconds > 0 ? 1 : 0
+  statement_id  = "AllowExecutionFromActivityFlushSchedule"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.message_processor.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.conversation_activity_flush[0].arn
+}
+
+# Periodic write-behind of presence heartbeats and expiry of idle users
+resource "aws_cloudwatch_event_rule" "presence_flush" {
+  name                = "${var.name_prefix}-presence-flush"
+  description         = "Persist buffered presence heartbeats and publish status transitions"
+  schedule_expression = "rate(1 minute)"
+
+  tags = var.tags
+}
+
+resource "aws_cloudwatch_event_target" "presence_flush" {
+  rule      = aws_cloudwatch_event_rule.presence_flush.name
+  target_id = "PresenceManagerFlush"
+  arn       = aws_lambda_function.presence_manager.arn
+
+  input = jsonencode({
+    action = "flush_presence"
+  })
+}
+
+resource "aws_lambda_permission" "allow_presence_flush" {
+  statement_id  = "AllowExecutionFromPresenceFlushSchedule"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.presence_manager.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.presence_flush.arn
+}
+
+# Daily archival of messages past the hot window
+resource "aws_cloudwatch_event_rule" "message_archival" {
+  name                = "${var.name_prefix}-message-archival"
+  description         = "Move old chat messages to compressed S3 segments"
+  schedule_expression = "cron(0 3 * * ? *)" # Daily at 3 AM UTC
+
+  tags = var.tags
+}
+
+resource "aws_cloudwatch_event_target" "message_archival" {
+  rule      = aws_cloudwatch_event_rule.message_archival.name
+  target_id = "MessageArchiver"
+  arn       = aws_lambda_function.message_archiver.arn
+}
+
+resource "aws_lambda_permission" "allow_message_archival" {
+  statement_id  = "AllowExecutionFromMessageArchivalSchedule"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.message_archiver.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.message_archival.arn
+}
+
 # Security group for Lambda functions
 resource "aws_security_group" "lambda" {
   count  = var.vpc_id != "" ? 1 : 0
@@ -221,6 +501,8 @@ resource "aws_iam_role_policy" "lambda_execution" {
         Effect = "Allow"
         Action = [
           "dynamodb:PutItem",
+          "dynamodb:BatchWriteItem",
+          "dynamodb:BatchGetItem",
           "dynamodb:GetItem",
           "dynamodb:UpdateItem",
           "dynamodb:DeleteItem",
@@ -243,7 +525,8 @@ resource "aws_iam_role_policy" "lambda_execution" {
         ]
         Resource = [
           aws_sns_topic.chat_notifications.arn,
-          aws_sns_topic.group_chat_notifications.arn
+          aws_sns_topic.group_chat_notifications.arn,
+          aws_sns_topic.presence_updates.arn
         ]
       },
       {
@@ -255,9 +538,51 @@ resource "aws_iam_role_policy" "lambda_execution" {
         ]
         Resource = [
           aws_sqs_queue.message_processing.arn,
-          aws_sqs_queue.group_chat_fifo.arn
+          aws_sqs_queue.group_chat_fifo.arn,
+          aws_sqs_queue.group_fanout.arn
         ]
       },
+      {
+        Effect = "Allow"
+        Action = [
+          "sqs:SendMessage"
+        ]
+        Resource = aws_sqs_queue.group_fanout.arn
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "dynamodb:DescribeStream",
+          "dynamodb:GetRecords",
+          "dynamodb:GetShardIterator",
+          "dynamodb:ListStreams"
+        ]
+        Resource = aws_dynamodb_table.user_conversations.stream_arn
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "s3:GetObject",
+          "s3:PutObject"
+        ]
+        Resource = "${aws_s3_bucket.message_archive.arn}/*"
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "s3:ListBucket"
+        ]
+        # Lets GetObject report missing segments as NoSuchKey
+        Resource = aws_s3_bucket.message_archive.arn
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "lambda:InvokeFunction"
+        ]
+        # The archiver hands long runs over to a new invocation of itself
+        Resource = "arn:aws:lambda:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:function:${var.name_prefix}-message-archiver"
+      },
       {
         Effect = "Allow"
         Action = [
@@ -329,6 +654,101 @@ data "archive_file" "message_processor" {
     content  = file("${path.module}/lambda/message_processor.py")
     filename = "message_processor.py"
   }
+  source {
+    content  = file("${path.module}/lambda/inbox.py")
+    filename = "inbox.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/message_cache.py")
+    filename = "message_cache.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/message_codec.py")
+    filename = "message_codec.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/message_shards.py")
+    filename = "message_shards.py"
+  }
+}
+
+data "archive_file" "message_history" {
+  type        = "zip"
+  output_path = "/tmp/message_history.zip"
+  source {
+    content  = file("${path.module}/lambda/message_history.py")
+    filename = "message_history.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/inbox.py")
+    filename = "inbox.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/message_archive.py")
+    filename = "message_archive.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/message_cache.py")
+    filename = "message_cache.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/message_codec.py")
+    filename = "message_codec.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/message_shards.py")
+    filename = "message_shards.py"
+  }
+}
+
+data "archive_file" "group_fanout" {
+  type        = "zip"
+  output_path = "/tmp/group_fanout.zip"
+  source {
+    content  = file("${path.module}/lambda/group_fanout.py")
+    filename = "group_fanout.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/inbox.py")
+    filename = "inbox.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/message_cache.py")
+    filename = "message_cache.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/message_codec.py")
+    filename = "message_codec.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/message_shards.py")
+    filename = "message_shards.py"
+  }
+}
+
+data "archive_file" "message_archiver" {
+  type        = "zip"
+  output_path = "/tmp/message_archiver.zip"
+  source {
+    content  = file("${path.module}/lambda/message_archiver.py")
+    filename = "message_archiver.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/message_archive.py")
+    filename = "message_archive.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/message_cache.py")
+    filename = "message_cache.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/message_codec.py")
+    filename = "message_codec.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/message_shards.py")
+    filename = "message_shards.py"
+  }
 }
 
 data "archive_file" "presence_manager" {
@@ -338,6 +758,18 @@ data "archive_file" "presence_manager" {
     content  = file("${path.module}/lambda/presence_manager.py")
     filename = "presence_manager.py"
   }
+  source {
+    content  = file("${path.module}/lambda/message_cache.py")
+    filename = "message_cache.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/message_codec.py")
+    filename = "message_codec.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/message_shards.py")
+    filename = "message_shards.py"
+  }
 }
 
 # Get current AWS account ID and region
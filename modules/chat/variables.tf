@@ -48,6 +48,59 @@ variable "lambda_reserved_concurrency" {
   default     = 100
 }
 
+variable "activity_flush_interval_seconds" {
+  description = "Seconds conversation last_activity is buffered in Redis before being written to DynamoDB (0 writes through)"
+  type        = number
+  default     = 30
+}
+
+variable "message_processor_io_concurrency" {
+  description = "Maximum concurrent DynamoDB and SNS calls per message processor invocation"
+  type        = number
+  default     = 8
+}
+
+variable "recent_messages_cache_size" {
+  description = "Number of most recent messages per conversation kept in Redis"
+  type        = number
+  default     = 200
+}
+
+variable "group_fanout_chunk_size" {
+  description = "Recipients per group message fan-out job"
+  type        = number
+  default     = 200
+}
+
+variable "group_fanout_max_concurrency" {
+  description = "Maximum concurrent group fan-out workers"
+  type        = number
+  default     = 50
+}
+
+variable "message_archive_after_days" {
+  description = "Age in days after which chat messages move from DynamoDB to compressed S3 segments"
+  type        = number
+  default     = 90
+}
+
+variable "message_compression_threshold_bytes" {
+  description = "Message bodies larger than this many bytes are stored zlib-compressed"
+  type        = number
+  default     = 512
+}
+
+variable "presence_heartbeat_persist_interval_seconds" {
+  description = "Seconds between DynamoDB writes of an online user's heartbeats (heartbeats between them stay in Redis); keep below 240"
+  type        = number
+  default     = 120
+
+  validation {
+    condition     = var.presence_heartbeat_persist_interval_seconds < 240
+    error_message = "The interval plus the one minute flush period must stay below the 300 second presence TTL."
+  }
+}
+
 variable "alarm_actions" {
   description = "SNS topic ARNs for alarm actions"
   type        = list(string)
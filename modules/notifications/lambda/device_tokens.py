@@ -0,0 +1,133 @@
+import json
+import os
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List
+
+# Seconds a user's token list stays cached in Redis; registrations and
+# pruning drop the cached list right away
+DEVICE_TOKEN_CACHE_TTL = int(os.environ.get('DEVICE_TOKEN_CACHE_TTL', '300'))
+DEVICE_TOKEN_KEY_PREFIX = 'device_tokens:'
+
+# BatchWriteItem accepts at most 25 put/delete requests per call
+BATCH_WRITE_MAX_ITEMS = 25
+BATCH_WRITE_MAX_RETRIES = 5
+
+def device_token_key(user_id: str) -> str:
+    return f"{DEVICE_TOKEN_KEY_PREFIX}{user_id}"
+
+def get_device_tokens_batch(redis_client, table, user_ids: Iterable[str]) -> Dict[str, List[str]]:
+    """
+    Device tokens of several users: cached lists in one pipeline,
+    the rest queried from DynamoDB and cached, including users without any
+    token.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    tokens = {}
+
+    cached = [None] * len(user_ids)
+    if redis_client is not None and user_ids:
+        try:
+            # Per-key GETs: the keys hash to different cluster slots, where MGET fails
+            pipe = redis_client.pipeline(transaction=False)
+            for user_id in user_ids:
+                pipe.get(device_token_key(user_id))
+            cached = pipe.execute()
+        except Exception as e:
+            print(f"Error reading cached device tokens: {str(e)}")
+
+    missing = []
+    for user_id, value in zip(user_ids, cached):
+        if value is None:
+            missing.append(user_id)
+        else:
+            tokens[user_id] = json.loads(value)
+
+    if not missing:
+        return tokens
+
+    for user_id in missing:
+        tokens[user_id] = query_device_tokens(table, user_id)
+
+    if redis_client is not None:
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for user_id in missing:
+                pipe.set(device_token_key(user_id), json.dumps(tokens[user_id]), ex=DEVICE_TOKEN_CACHE_TTL)
+            pipe.execute()
+        except Exception as e:
+            print(f"Error caching device tokens: {str(e)}")
+
+    return tokens
+
+def query_device_tokens(table, user_id: str) -> List[str]:
+    """Page through the registered tokens of a user"""
+    query_kwargs = {
+        'KeyConditionExpression': 'user_id = :user_id',
+        'ExpressionAttributeValues': {':user_id': user_id},
+        'ProjectionExpression': 'device_token'
+    }
+
+    tokens = []
+    while True:
+        response = table.query(**query_kwargs)
+        tokens.extend(item['device_token'] for item in response.get('Items', []))
+
+        if 'LastEvaluatedKey' not in response:
+            return tokens
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def register_device_token(redis_client, table, user_id: str, device_token: str, platform: str):
+    """Add or refresh a device token of a user"""
+    table.put_item(
+        Item={
+            'user_id': user_id,
+            'device_token': device_token,
+            'platform': platform,
+            'updated_at': datetime.utcnow().isoformat()
+        }
+    )
+    invalidate_device_tokens(redis_client, [user_id])
+
+def remove_device_tokens(redis_client, dynamodb, table_name: str, tokens_by_user: Dict[str, Iterable[str]]):
+    """
+    Delete device tokens with BatchWriteItem in chunks of 25, retrying
+    unprocessed keys with exponential backoff, and drop the cached lists
+    of their users
+    """
+    keys = [
+        {'user_id': user_id, 'device_token': device_token}
+        for user_id, device_tokens in tokens_by_user.items()
+        for device_token in set(device_tokens)
+    ]
+
+    for i in range(0, len(keys), BATCH_WRITE_MAX_ITEMS):
+        requests = [{'DeleteRequest': {'Key': key}} for key in keys[i:i + BATCH_WRITE_MAX_ITEMS]]
+
+        attempt = 0
+        while requests:
+            response = dynamodb.batch_write_item(RequestItems={table_name: requests})
+            requests = response.get('UnprocessedItems', {}).get(table_name, [])
+
+            if not requests:
+                break
+
+            attempt += 1
+            if attempt > BATCH_WRITE_MAX_RETRIES:
+                print(f"Could not delete {len(requests)} device tokens")
+                break
+
+            # Exponential backoff: 50ms, 100ms, 200ms, ... capped at 2s
+            time.sleep(min(0.05 * (2 ** (attempt - 1)), 2))
+
+    invalidate_device_tokens(redis_client, tokens_by_user.keys())
+
+def invalidate_device_tokens(redis_client, user_ids: Iterable[str]):
+    """Drop cached token lists so the next read goes to DynamoDB"""
+    user_ids = list(user_ids)
+    if redis_client is None or not user_ids:
+        return
+    try:
+        redis_client.delete(*[device_token_key(user_id) for user_id in user_ids])
+    except Exception as e:
+        print(f"Error invalidating cached device tokens: {str(e)}")
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Dict, Any, List, Tuple
+
+from email_templates import Segment, load_template
+
+# SendBulkTemplatedEmail accepts at most 50 destinations per call
+BULK_MAX_DESTINATIONS = 50
+
+# Sends per second one container may make: the SES account send rate
+# divided by the email processor's concurrency. Each destination counts once.
+SES_MAX_SEND_RATE = float(os.environ.get('SES_MAX_SEND_RATE', '14'))
+SES_TEMPLATE_PREFIX = os.environ.get('SES_TEMPLATE_PREFIX', 'notifications')
+
+# Version of the S3 -> SES template conversion, part of the SES template
+# name so templates created by an older conversion are not reused
+SES_TEMPLATE_FORMAT = 2
+
+# SES template names already created by this container
+_ses_templates = set()
+
+class RateLimiter:
+    """Token bucket pacing SES sends within one container"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, count: int = 1):
+        """Block until count sends fit in the rate"""
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= count
+            if self.tokens < 0:
+                # Pay off the debt before returning; later callers wait on top
+                time.sleep(-self.tokens / self.rate)
+
+send_rate_limiter = RateLimiter(SES_MAX_SEND_RATE)
+
+def ses_template_name(template_name: str, etag: str) -> str:
+    """
+    Name of the SES template holding one version of an S3 template, so a
+    changed template is sent as a new SES template rather than updated in
+    place under concurrent sends
+    """
+    version = hashlib.md5(f"{SES_TEMPLATE_FORMAT}:{etag}".encode('utf-8')).hexdigest()[:12]
+    name = re.sub(r'[^A-Za-z0-9_-]', '_', template_name)
+    return f"{SES_TEMPLATE_PREFIX}-{name}"[:51] + f"-{version}"
+
+def ses_template_source(segments: List[Segment]) -> Tuple[str, Dict[str, Tuple[str, str]]]:
+    """
+    SES template text of a compiled template. SES renders with Handlebars,
+    which reads dots and other characters in names as paths, so every
+    placeholder is renamed to a word-only key and literal braces are
+    escaped. Returns the text and key -> (placeholder name, source text).
+    """
+    keys: Dict[str, str] = {}
+    placeholders: Dict[str, Tuple[str, str]] = {}
+    parts = []
+    for segment in segments:
+        if isinstance(segment, str):
+            parts.append(segment.replace('{{', '\\{{'))
+            continue
+
+        name, escape, source = segment
+        if name not in keys:
+            keys[name] = f"p{len(keys)}"
+            placeholders[keys[name]] = (name, source)
+        parts.append(f"{{{{{keys[name]}}}}}" if escape else f"{{{{{{{keys[name]}}}}}}}")
+    return ''.join(parts), placeholders
+
+def ensure_ses_template(ses_client, bucket: str, template_name: str):
+    """
+    Make sure the current version of an S3 template exists in SES. Returns
+    the SES template name and its placeholders (see ses_template_source).
+    """
+    etag, _, segments = load_template(bucket, template_name)
+    name = ses_template_name(template_name, etag)
+    source, placeholders = ses_template_source(segments)
+
+    if name not in _ses_templates:
+        try:
+            ses_client.create_template(
+                Template={
+                    'TemplateName': name,
+                    'SubjectPart': '{{{subject}}}',
+                    'HtmlPart': source
+                }
+            )
+        except ses_client.exceptions.AlreadyExistsException:
+            pass
+        _ses_templates.add(name)
+
+    return name, placeholders
+
+def send_bulk(ses_client, from_email: str, bucket: str, template_name: str,
+              emails: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Send emails sharing a template with SendBulkTemplatedEmail, 50
+    destinations per call. Each email needs 'email', 'subject' and
+    'template_data'. Returns one {'success', 'message_id' | 'error'} per
+    email, in order; emails of a call that failed as a whole are marked
+    'retry' as none of them was sent.
+    """
+    ses_template, placeholders = ensure_ses_template(ses_client, bucket, template_name)
+
+    results = []
+    for i in range(0, len(emails), BULK_MAX_DESTINATIONS):
+        chunk = emails[i:i + BULK_MAX_DESTINATIONS]
+
+        destinations = []
+        for email in chunk:
+            # SES fails to render templates with missing data; keep those
+            # placeholders as written, like single sends do
+            template_data = email['template_data']
+            data = {
+                key: template_data[name] if name in template_data else source
+                for key, (name, source) in placeholders.items()
+            }
+            data['subject'] = email['subject']
+            destinations.append({
+                'Destination': {'ToAddresses': [email['email']]},
+                'ReplacementTemplateData': json.dumps(data, default=str)
+            })
+
+        send_rate_limiter.acquire(len(destinations))
+        try:
+            response = ses_client.send_bulk_templated_email(
+                Source=from_email,
+                Template=ses_template,
+                DefaultTemplateData='{}',
+                Destinations=destinations
+            )
+        except Exception as e:
+            print(f"Error sending bulk email with template {template_name}: {str(e)}")
+            results.extend({'success': False, 'error': str(e), 'retry': True} for _ in chunk)
+            continue
+
+        statuses = response.get('Status', [])
+        if len(statuses) != len(chunk):
+            print(f"SES returned {len(statuses)} statuses for {len(chunk)} destinations of template {template_name}")
+
+        # Statuses are in destination order; destinations without one failed
+        for position in range(len(chunk)):
+            status = statuses[position] if position < len(statuses) else {}
+            if status.get('Status') == 'Success':
+                results.append({'success': True, 'message_id': status.get('MessageId')})
+            else:
+                results.append({'success': False, 'error': status.get('Error') or status.get('Status') or 'No status returned by SES'})
+
+    return results
@@ -2,7 +2,13 @@ import json
 import boto3
 import os
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, List, Tuple
+
+from sqs_batch import batch_item_failures, all_items_failed, record_id, raise_for_sns_failures, has_sns_records
+from preference_cache import preference_keys, prefetch_preferences, is_enabled
+from history_writer import HistoryWriter
+from email_templates import get_template, render
+from email_bulk import send_bulk, send_rate_limiter
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
@@ -11,7 +17,6 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     # Initialize AWS clients
     ses = boto3.client('ses')
-    s3 = boto3.client('s3')
     dynamodb = boto3.resource('dynamodb')
     
     # Environment variables
@@ -19,10 +24,22 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     history_table_name = os.environ['HISTORY_TABLE']
     from_email = os.environ['FROM_EMAIL']
     template_bucket = os.environ['TEMPLATE_BUCKET']
+    # 'single' sends each email on its own, 'bulk' one SES call per template and 50 recipients
+    send_mode = os.environ.get('EMAIL_SEND_MODE', 'single')
     
     try:
         processed_count = 0
         failed_count = 0
+        failed_message_ids = []
+        
+        # Emails to send with SendBulkTemplatedEmail, by template
+        bulk_groups = {}
+        
+        # History rows of the batch, written together once it is processed
+        history = HistoryWriter(dynamodb, history_table_name)
+        
+        # Load the preferences of the whole batch with one BatchGetItem
+        prefetch_preferences(preferences_table_name, preference_keys(event.get('Records', []), 'email'))
         
         for record in event.get('Records', []):
             try:
@@ -45,13 +62,25 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 
                 # Check preferences
                 if should_send_email(preferences_table_name, user_id, 'email'):
-                    # Get email template
-                    template_content = get_email_template(template_bucket, template_name)
+                    if send_mode == 'bulk':
+                        # Sent per template once the whole batch is read
+                        bulk_groups.setdefault(template_name, []).append({
+                            'message_id': record_id(record),
+                            'user_id': user_id,
+                            'email': email,
+                            'subject': subject,
+                            'template_data': template_data
+                        })
+                        continue
+                    
+                    # Get the compiled template, cached across invocations
+                    template = get_template(template_bucket, template_name)
                     
                     # Render template with data
-                    html_content = render_template(template_content, template_data)
+                    html_content = render(template, template_data)
                     
                     # Send email
+                    send_rate_limiter.acquire()
                     result = send_email(
                         ses_client=ses,
                         from_email=from_email,
@@ -62,7 +91,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     
                     # Record history
                     record_email_history(
-                        history_table_name=history_table_name,
+                        history=history,
                         user_id=user_id,
                         email=email,
                         subject=subject,
@@ -78,60 +107,44 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             except Exception as e:
                 print(f"Error processing email record: {str(e)}")
                 failed_count += 1
+                # Returned to the queue for retry instead of being dropped
+                failed_message_ids.append(record_id(record))
+        
+        if bulk_groups:
+            processed, failed, retry_message_ids = send_bulk_groups(
+                ses, from_email, template_bucket, bulk_groups, history
+            )
+            processed_count += processed
+            failed_count += failed
+            failed_message_ids.extend(retry_message_ids)
+        
+        history.flush()
+        
+        # SNS retries only invocations that raise
+        raise_for_sns_failures(event.get('Records', []), failed_message_ids)
         
         return {
             'statusCode': 200,
             'body': json.dumps({
                 'processed': processed_count,
                 'failed': failed_count
-            })
+            }),
+            'batchItemFailures': batch_item_failures(event.get('Records', []), failed_message_ids)
         }
         
     except Exception as e:
         print(f"Error in email processor: {str(e)}")
+        if has_sns_records(event.get('Records', [])):
+            raise
         return {
             'statusCode': 500,
-            'body': json.dumps({'error': str(e)})
+            'body': json.dumps({'error': str(e)}),
+            'batchItemFailures': all_items_failed(event.get('Records', []))
         }
 
 def should_send_email(table_name: str, user_id: str, notification_type: str) -> bool:
     """Check email preferences"""
-    try:
-        dynamodb = boto3.resource('dynamodb')
-        table = dynamodb.Table(table_name)
-        
-        response = table.get_item(
-            Key={
-                'user_id': user_id,
-                'notification_type': notification_type
-            }
-        )
-        
-        return response.get('Item', {}).get('enabled', True)
-        
-    except Exception as e:
-        print(f"Error checking email preferences: {str(e)}")
-        return True
-
-def get_email_template(bucket: str, template_name: str) -> str:
-    """Get email template from S3"""
-    try:
-        s3 = boto3.client('s3')
-        response = s3.get_object(Bucket=bucket, Key=f"templates/{template_name}.html")
-        return response['Body'].read().decode('utf-8')
-    except Exception as e:
-        print(f"Error getting template: {str(e)}")
-        return "<html><body>{{content}}</body></html>"
-
-def render_template(template: str, data: Dict) -> str:
-    """Simple template rendering"""
-    try:
-        for key, value in data.items():
-            template = template.replace(f"{{{{{key}}}}}", str(value))
-        return template
-    except Exception as e:
-        print(f"Error rendering template: {str(e)}")
-        return template
+    return is_enabled(table_name, user_id, notification_type, default=True)
 
 def send_email(ses_client, from_email: str, to_email: str, subject: str, html_content: str) -> Dict:
     """Send email via SES"""
@@ -148,31 +161,70 @@ def send_email(ses_client, from_email: str, to_email: str, subject: str, html_co
     except Exception as e:
         return {'success': False, 'error': str(e)}
 
-def record_email_history(history_table_name: str, user_id: str, email: str, 
-                        subject: str, status: str, error: str = None):
-    """Record email in history"""
-    try:
-        dynamodb = boto3.resource('dynamodb')
-        table = dynamodb.Table(history_table_name)
-        
-        notification_id = f"email_{user_id}_{int(datetime.utcnow().timestamp())}"
-        timestamp = datetime.utcnow().isoformat()
-        
-        item = {
-            'notification_id': notification_id,
-            'timestamp': timestamp,
-            'user_id': user_id,
-            'notification_type': 'email',
-            'subject': subject,
-            'email': email,
-            'status': status,
-            'expires_at': int(datetime.utcnow().timestamp()) + (30 * 24 * 60 * 60)
-        }
-        
-        if error:
-            item['error'] = error
+def send_bulk_groups(ses_client, from_email: str, template_bucket: str,
+                     bulk_groups: Dict[str, List[Dict]], history: HistoryWriter) -> Tuple[int, int, List[str]]:
+    """
+    Send the queued emails of each template in bulk and record the result
+    of every destination. Returns the sent and failed counts, and the record
+    message IDs to retry because their call failed as a whole.
+    """
+    processed_count = 0
+    failed_count = 0
+    retry_message_ids = []
+    
+    for template_name, emails in bulk_groups.items():
+        try:
+            results = send_bulk(ses_client, from_email, template_bucket, template_name, emails)
+        except Exception as e:
+            print(f"Error preparing bulk email template {template_name}: {str(e)}")
+            results = [{'success': False, 'error': str(e), 'retry': True} for _ in emails]
         
-        table.put_item(Item=item)
+        # Every destination needs a result; ones without count as failed
+        if len(results) != len(emails):
+            print(f"Got {len(results)} results for {len(emails)} bulk emails of template {template_name}")
+            results = results[:len(emails)]
+            results += [{'success': False, 'error': 'No result from bulk send'}] * (len(emails) - len(results))
         
-    except Exception as e:
-        print(f"Error recording email history: {str(e)}")
+        for email, result in zip(emails, results):
+            if result.get('retry'):
+                failed_count += 1
+                retry_message_ids.append(email['message_id'])
+                continue
+            
+            record_email_history(
+                history=history,
+                user_id=email['user_id'],
+                email=email['email'],
+                subject=email['subject'],
+                status='sent' if result['success'] else 'failed',
+                error=result.get('error')
+            )
+            
+            if result['success']:
+                processed_count += 1
+            else:
+                failed_count += 1
+    
+    return processed_count, failed_count, retry_message_ids
+
+def record_email_history(history: HistoryWriter, user_id: str, email: str, 
+                        subject: str, status: str, error: str = None):
+    """Record email in history"""
+    notification_id = f"email_{user_id}_{int(datetime.utcnow().timestamp())}"
+    timestamp = datetime.utcnow().isoformat()
+    
+    item = {
+        'notification_id': notification_id,
+        'timestamp': timestamp,
+        'user_id': user_id,
+        'notification_type': 'email',
+        'subject': subject,
+        'email': email,
+        'status': status,
+        'expires_at': int(datetime.utcnow().timestamp()) + (30 * 24 * 60 * 60)
+    }
+    
+    if error:
+        item['error'] = error
+    
+    history.add(item)
@@ -0,0 +1,105 @@
+import boto3
+import html
+import os
+import re
+import time
+from typing import Dict, Any, List, Optional, Tuple, Union
+
+# Seconds a cached template is used before S3 is asked whether it changed
+TEMPLATE_REVALIDATE_SECONDS = int(os.environ.get('TEMPLATE_REVALIDATE_SECONDS', '60'))
+
+DEFAULT_TEMPLATE = "<html><body>{{content}}</body></html>"
+
+# {{name}} inserts an HTML-escaped value, {{{name}}} inserts it verbatim.
+# Names are any run of characters other than braces and whitespace, as
+# templates use keys like {{first-name}} or {{user.name}}.
+PLACEHOLDER = re.compile(r'\{\{\{\s*([^{}\s]+)\s*\}\}\}|\{\{\s*([^{}\s]+)\s*\}\}')
+
+# A compiled template: literal text, and (name, escape, source) placeholders
+Segment = Union[str, Tuple[str, bool, str]]
+
+# A template as served: ETag, source text and compiled segments
+Template = Tuple[str, str, List[Segment]]
+
+# template_name -> (template, last validated), reused across warm invocations
+_templates: Dict[str, Tuple[Template, float]] = {}
+_s3 = None
+
+def get_s3():
+    global _s3
+    if _s3 is None:
+        _s3 = boto3.client('s3')
+    return _s3
+
+def compile_template(template: str) -> List[Segment]:
+    """Split a template into literal text and placeholders"""
+    segments: List[Segment] = []
+    position = 0
+    for match in PLACEHOLDER.finditer(template):
+        if match.start() > position:
+            segments.append(template[position:match.start()])
+        raw_name, escaped_name = match.groups()
+        segments.append((raw_name or escaped_name, raw_name is None, match.group(0)))
+        position = match.end()
+    if position < len(template):
+        segments.append(template[position:])
+    return segments
+
+def render(segments: List[Segment], data: Dict[str, Any]) -> str:
+    """Render a compiled template in one pass. Placeholders without data are kept as written."""
+    parts = []
+    for segment in segments:
+        if isinstance(segment, str):
+            parts.append(segment)
+            continue
+
+        name, escape, source = segment
+        if name not in data:
+            parts.append(source)
+        elif escape:
+            parts.append(html.escape(str(data[name])))
+        else:
+            parts.append(str(data[name]))
+    return ''.join(parts)
+
+def get_template(bucket: str, template_name: str) -> List[Segment]:
+    """Compiled template, from the container cache"""
+    return load_template(bucket, template_name)[2]
+
+def load_template(bucket: str, template_name: str) -> Template:
+    """
+    Template from the container cache. Entries older than
+    TEMPLATE_REVALIDATE_SECONDS are revalidated with a conditional GET on
+    their ETag; S3 errors fall back to the cached or the default template.
+    """
+    now = time.time()
+    cached = _templates.get(template_name)
+    if cached and now - cached[1] < TEMPLATE_REVALIDATE_SECONDS:
+        return cached[0]
+
+    request = {'Bucket': bucket, 'Key': f"templates/{template_name}.html"}
+    if cached:
+        request['IfNoneMatch'] = cached[0][0]
+
+    try:
+        response = get_s3().get_object(**request)
+    except Exception as e:
+        if cached and not_modified(e):
+            _templates[template_name] = (cached[0], now)
+            return cached[0]
+
+        print(f"Error getting template: {str(e)}")
+        return cached[0] if cached else ('default', DEFAULT_TEMPLATE, compile_template(DEFAULT_TEMPLATE))
+
+    source = response['Body'].read().decode('utf-8')
+    template = (response['ETag'], source, compile_template(source))
+    _templates[template_name] = (template, now)
+    return template
+
+def not_modified(error: Exception) -> bool:
+    """Whether a conditional GET failed because the object is unchanged"""
+    response: Optional[Dict[str, Any]] = getattr(error, 'response', None)
+    if not response:
+        return False
+    return (response.get('Error', {}).get('Code') in ('304', 'NotModified')
+            or response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304)
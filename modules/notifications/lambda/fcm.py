@@ -0,0 +1,60 @@
+import os
+import requests
+from requests.adapters import HTTPAdapter
+from typing import Dict, Any, List
+
+FCM_SEND_URL = 'https://fcm.googleapis.com/fcm/send'
+FCM_TIMEOUT_SECONDS = 30
+
+# Tokens per multicast request
+FCM_MULTICAST_MAX_TOKENS = 500
+
+# Keep-alive connections to FCM per container
+FCM_POOL_SIZE = int(os.environ.get('FCM_POOL_SIZE', '10'))
+
+# Per-token errors meaning the token will never be delivered to again
+INVALID_TOKEN_ERRORS = {'NotRegistered', 'InvalidRegistration'}
+
+_session = None
+
+def get_session() -> requests.Session:
+    """HTTP session with pooled keep-alive connections, reused across warm invocations"""
+    global _session
+    if _session is None:
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=FCM_POOL_SIZE))
+        _session = session
+    return _session
+
+def send_multicast(fcm_server_key: str, device_tokens: List[str], title: str, body: str, data: Dict) -> Dict[str, Any]:
+    """
+    Send one notification to up to 500 tokens. On success 'results' holds
+    one {'message_id'} or {'error'} per token, in order; failed requests
+    are marked 'retry' when FCM was unavailable or throttling.
+    """
+    fcm_payload = {
+        'registration_ids': device_tokens,
+        'notification': {
+            'title': title,
+            'body': body,
+            'sound': 'default',
+            'badge': '1'
+        },
+        'data': data,
+        'priority': 'high'
+    }
+
+    headers = {
+        'Authorization': f'key={fcm_server_key}',
+        'Content-Type': 'application/json'
+    }
+
+    response = get_session().post(FCM_SEND_URL, headers=headers, json=fcm_payload, timeout=FCM_TIMEOUT_SECONDS)
+
+    if response.status_code == 200:
+        return {'success': True, 'results': response.json().get('results', [])}
+    return {
+        'success': False,
+        'error': f'FCM error: {response.status_code}',
+        'retry': response.status_code == 429 or response.status_code >= 500
+    }
@@ -0,0 +1,83 @@
+import os
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Any, List
+
+# Statuses recorded as hourly counters per notification type instead of one
+# history row per notification, e.g. "skipped"
+AGGREGATED_STATUSES = {
+    status.strip()
+    for status in os.environ.get('HISTORY_AGGREGATED_STATUSES', '').split(',')
+    if status.strip()
+}
+
+HISTORY_WRITE_MAX_ATTEMPTS = int(os.environ.get('HISTORY_WRITE_MAX_ATTEMPTS', '3'))
+HISTORY_TTL_SECONDS = 30 * 24 * 60 * 60
+
+# Counter rows live in the history table under this notification_id prefix
+COUNTER_PREFIX = 'counter#'
+
+class HistoryWriter:
+    """
+    Buffers the history rows of a batch and writes them with batch_writer
+    on flush. Rows of aggregated statuses only increment counters.
+    """
+
+    def __init__(self, dynamodb, table_name: str):
+        self.table = dynamodb.Table(table_name)
+        self.items: List[Dict[str, Any]] = []
+        self.counters = Counter()
+
+    def add(self, item: Dict[str, Any]):
+        """Queue a history row, or count it when its status is aggregated"""
+        if item['status'] in AGGREGATED_STATUSES:
+            hour = datetime.utcnow().strftime('%Y-%m-%dT%H')
+            self.counters[(item.get('notification_type', 'default'), item['status'], hour)] += 1
+            return
+
+        self.items.append(item)
+
+    def flush(self):
+        """Write the buffered rows and counters. Errors are logged, not raised."""
+        items, self.items = self.items, []
+        counters, self.counters = self.counters, Counter()
+
+        if items:
+            self._write_items(items)
+        for key, count in counters.items():
+            self._increment_counter(*key, count)
+
+    def _write_items(self, items: List[Dict[str, Any]]):
+        # batch_writer resends unprocessed items itself; a failed request is
+        # retried as a whole, which only rewrites the same keys
+        for attempt in range(1, HISTORY_WRITE_MAX_ATTEMPTS + 1):
+            try:
+                with self.table.batch_writer(overwrite_by_pkeys=['notification_id', 'timestamp']) as batch:
+                    for item in items:
+                        batch.put_item(Item=item)
+                return
+            except Exception as e:
+                if attempt == HISTORY_WRITE_MAX_ATTEMPTS:
+                    print(f"Error recording notification history ({len(items)} items): {str(e)}")
+                    return
+                time.sleep(min(0.05 * (2 ** (attempt - 1)), 2))
+
+    def _increment_counter(self, notification_type: str, status: str, hour: str, count: int):
+        try:
+            self.table.update_item(
+                Key={
+                    'notification_id': f"{COUNTER_PREFIX}{notification_type}#{status}",
+                    'timestamp': hour
+                },
+                UpdateExpression='ADD #count :count SET notification_type = :type, aggregated_status = :status, expires_at = :expires_at',
+                ExpressionAttributeNames={'#count': 'count'},
+                ExpressionAttributeValues={
+                    ':count': count,
+                    ':type': notification_type,
+                    ':status': status,
+                    ':expires_at': int(time.time()) + HISTORY_TTL_SECONDS
+                }
+            )
+        except Exception as e:
+            print(f"Error recording {status} notification counter: {str(e)}")
@@ -3,7 +3,12 @@ import boto3
 import redis
 import os
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, List
+
+from sqs_batch import batch_item_failures, all_items_failed, record_id, raise_for_sns_failures, has_sns_records
+from preference_cache import preference_keys, prefetch_preferences, is_enabled
+from history_writer import HistoryWriter
+from redis_client import get_redis_client
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
@@ -16,19 +21,24 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     # Environment variables
     preferences_table_name = os.environ['PREFERENCES_TABLE']
     history_table_name = os.environ['HISTORY_TABLE']
-    redis_endpoint = os.environ['REDIS_ENDPOINT']
     websocket_api_endpoint = os.environ.get('WEBSOCKET_API_ENDPOINT', '')
     
     try:
-        # Connect to Redis
-        redis_client = redis.Redis(
-            host=redis_endpoint.split(':')[0],
-            port=int(redis_endpoint.split(':')[1]) if ':' in redis_endpoint else 6379,
-            decode_responses=True
-        )
+        # Redis connection reused across warm invocations
+        redis_client = get_redis_client()
         
         processed_count = 0
         failed_count = 0
+        failed_message_ids = []
+        
+        # Opted-in notifications of the batch, delivered together
+        pending = []
+        
+        # History rows of the batch, written together once it is processed
+        history = HistoryWriter(dynamodb, history_table_name)
+        
+        # Load the preferences of the whole batch with one BatchGetItem
+        prefetch_preferences(preferences_table_name, preference_keys(event.get('Records', []), 'in_app'))
         
         for record in event.get('Records', []):
             try:
@@ -56,159 +66,155 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 
                 # Check preferences
                 if should_send_in_app(preferences_table_name, user_id, 'in_app'):
-                    # Send via WebSocket to active connections
-                    result = send_websocket_notification(
-                        redis_client=redis_client,
-                        user_id=user_id,
-                        notification_data=notification_data
-                    )
-                    
-                    # Store in user's notification inbox
-                    store_in_app_notification(
-                        redis_client=redis_client,
-                        user_id=user_id,
-                        notification_data=notification_data
-                    )
-                    
-                    # Record history
-                    record_in_app_history(
-                        history_table_name=history_table_name,
-                        user_id=user_id,
-                        notification_data=notification_data,
-                        status='sent' if result['success'] else 'failed',
-                        error=result.get('error')
-                    )
-                    
-                    if result['success']:
-                        processed_count += 1
-                    else:
-                        failed_count += 1
+                    # Delivered with the rest of the batch in two Redis round trips
+                    pending.append({
+                        'message_id': record_id(record),
+                        'user_id': user_id,
+                        'notification_data': notification_data
+                    })
                         
             except Exception as e:
                 print(f"Error processing in-app record: {str(e)}")
                 failed_count += 1
+                # Returned to the queue for retry instead of being dropped
+                failed_message_ids.append(record_id(record))
+        
+        if pending:
+            results = deliver_in_app_notifications(redis_client, pending)
+            
+            for notification, result in zip(pending, results):
+                # Record history
+                record_in_app_history(
+                    history=history,
+                    user_id=notification['user_id'],
+                    notification_data=notification['notification_data'],
+                    status='sent' if result['success'] else 'failed',
+                    error=result.get('error')
+                )
+                
+                if result['success']:
+                    processed_count += 1
+                else:
+                    failed_count += 1
+                    # Returned to the queue like records that failed to parse
+                    failed_message_ids.append(notification['message_id'])
+        
+        history.flush()
+        
+        # SNS retries only invocations that raise
+        raise_for_sns_failures(event.get('Records', []), failed_message_ids)
         
         return {
             'statusCode': 200,
             'body': json.dumps({
                 'processed': processed_count,
                 'failed': failed_count
-            })
+            }),
+            'batchItemFailures': batch_item_failures(event.get('Records', []), failed_message_ids)
         }
         
     except Exception as e:
         print(f"Error in in-app processor: {str(e)}")
+        if has_sns_records(event.get('Records', [])):
+            raise
         return {
             'statusCode': 500,
-            'body': json.dumps({'error': str(e)})
+            'body': json.dumps({'error': str(e)}),
+            'batchItemFailures': all_items_failed(event.get('Records', []))
         }
 
 def should_send_in_app(table_name: str, user_id: str, notification_type: str) -> bool:
     """Check in-app preferences"""
-    try:
-        dynamodb = boto3.resource('dynamodb')
-        table = dynamodb.Table(table_name)
-        
-        response = table.get_item(
-            Key={
-                'user_id': user_id,
-                'notification_type': notification_type
-            }
-        )
-        
-        return response.get('Item', {}).get('enabled', True)
-        
-    except Exception as e:
-        print(f"Error checking in-app preferences: {str(e)}")
-        return True
+    return is_enabled(table_name, user_id, notification_type, default=True)
 
-def send_websocket_notification(redis_client, user_id: str, notification_data: Dict) -> Dict:
-    """Send notification via WebSocket to active connections"""
+def deliver_in_app_notifications(redis_client, pending: List[Dict]) -> List[Dict]:
+    """
+    Push notifications to the users' active WebSocket connections and
+    inboxes with two pipelines: one reading the connections of every user,
+    one with all the writes. Returns one result per notification, in order.
+    """
     try:
-        # Get user's active WebSocket connections from Redis
-        connection_key = f"websocket_connections:{user_id}"
-        connections = redis_client.smembers(connection_key)
-        
-        if not connections:
-            return {'success': True, 'message': 'No active connections'}
-        
-        # Send to each active connection
-        successful_sends = 0
-        for connection_id in connections:
-            try:
-                # In a real implementation, you'd use API Gateway Management API
-                # to send to specific WebSocket connections
-                notification_message = {
-                    'type': 'notification',
-                    'data': notification_data
-                }
-                
-                # Store message for connection to pick up
-                message_key = f"websocket_message:{connection_id}"
-                redis_client.lpush(message_key, json.dumps(notification_message))
-                redis_client.expire(message_key, 3600)  # Expire in 1 hour
-                
-                successful_sends += 1
-                
-            except Exception as e:
-                print(f"Error sending to connection {connection_id}: {str(e)}")
-        
-        return {
-            'success': True, 
-            'sent_to': successful_sends,
-            'total_connections': len(connections)
-        }
-        
-    except Exception as e:
-        return {'success': False, 'error': str(e)}
-
-def store_in_app_notification(redis_client, user_id: str, notification_data: Dict):
-    """Store notification in user's inbox"""
+        pipe = redis_client.pipeline(transaction=False)
+        for notification in pending:
+            pipe.smembers(f"websocket_connections:{notification['user_id']}")
+        connections_by_notification = pipe.execute()
+    except redis.RedisError as e:
+        return [{'success': False, 'error': str(e)} for _ in pending]
+    
+    pipe = redis_client.pipeline(transaction=False)
+    # Commands of each notification in the pipeline, to map replies back
+    spans = []
+    for notification, connections in zip(pending, connections_by_notification):
+        start = len(pipe)
+        queue_websocket_notification(pipe, connections, notification['notification_data'])
+        queue_in_app_notification(pipe, notification['user_id'], notification['notification_data'])
+        spans.append((start, len(pipe), len(connections)))
+    
     try:
-        inbox_key = f"user_notifications:{user_id}"
-        
-        # Add to user's notification list
-        redis_client.lpush(inbox_key, json.dumps(notification_data))
-        
-        # Keep only last 100 notifications
-        redis_client.ltrim(inbox_key, 0, 99)
-        
-        # Set expiry for the inbox (30 days)
-        redis_client.expire(inbox_key, 30 * 24 * 60 * 60)
-        
-        # Update unread count
-        unread_key = f"unread_notifications:{user_id}"
-        redis_client.incr(unread_key)
-        redis_client.expire(unread_key, 30 * 24 * 60 * 60)
-        
-    except Exception as e:
-        print(f"Error storing in-app notification: {str(e)}")
+        replies = pipe.execute(raise_on_error=False)
+    except redis.RedisError as e:
+        return [{'success': False, 'error': str(e)} for _ in pending]
+    
+    results = []
+    for start, end, connection_count in spans:
+        errors = [reply for reply in replies[start:end] if isinstance(reply, Exception)]
+        if errors:
+            results.append({'success': False, 'error': str(errors[0])})
+        else:
+            results.append({'success': True, 'sent_to': connection_count, 'total_connections': connection_count})
+    return results
+
+def queue_websocket_notification(pipe, connections, notification_data: Dict):
+    """Queue the notification for each active WebSocket connection of a user"""
+    # In a real implementation, you'd use API Gateway Management API
+    # to send to specific WebSocket connections
+    notification_message = json.dumps({
+        'type': 'notification',
+        'data': notification_data
+    })
+    
+    for connection_id in connections:
+        # Store message for connection to pick up
+        message_key = f"websocket_message:{connection_id}"
+        pipe.lpush(message_key, notification_message)
+        pipe.expire(message_key, 3600)  # Expire in 1 hour
+
+def queue_in_app_notification(pipe, user_id: str, notification_data: Dict):
+    """Queue the commands storing a notification in the user's inbox"""
+    inbox_key = f"user_notifications:{user_id}"
+    
+    # Add to user's notification list
+    pipe.lpush(inbox_key, json.dumps(notification_data))
+    
+    # Keep only last 100 notifications
+    pipe.ltrim(inbox_key, 0, 99)
+    
+    # Set expiry for the inbox (30 days)
+    pipe.expire(inbox_key, 30 * 24 * 60 * 60)
+    
+    # Update unread count
+    unread_key = f"unread_notifications:{user_id}"
+    pipe.incr(unread_key)
+    pipe.expire(unread_key, 30 * 24 * 60 * 60)
 
-def record_in_app_history(history_table_name: str, user_id: str, notification_data: Dict, 
+def record_in_app_history(history: HistoryWriter, user_id: str, notification_data: Dict, 
                          status: str, error: str = None):
     """Record in-app notification in history"""
-    try:
-        dynamodb = boto3.resource('dynamodb')
-        table = dynamodb.Table(history_table_name)
-        
-        notification_id = notification_data['id']
-        timestamp = datetime.utcnow().isoformat()
-        
-        item = {
-            'notification_id': notification_id,
-            'timestamp': timestamp,
-            'user_id': user_id,
-            'notification_type': 'in_app',
-            'title': notification_data.get('title', ''),
-            'content': notification_data.get('content', ''),
-            'status': status,
-            'expires_at': int(datetime.utcnow().timestamp()) + (30 * 24 * 60 * 60)
-        }
-        
-        if error:
-            item['error'] = error
-        
-        table.put_item(Item=item)
-        
-    except Exception as e:
-        print(f"Error recording in-app history: {str(e)}")
\ No newline at end of file
+    notification_id = notification_data['id']
+    timestamp = datetime.utcnow().isoformat()
+    
+    item = {
+        'notification_id': notification_id,
+        'timestamp': timestamp,
+        'user_id': user_id,
+        'notification_type': 'in_app',
+        'title': notification_data.get('title', ''),
+        'content': notification_data.get('content', ''),
+        'status': status,
+        'expires_at': int(datetime.utcnow().timestamp()) + (30 * 24 * 60 * 60)
+    }
+    
+    if error:
+        item['error'] = error
+    
+    history.add(item)
@@ -4,6 +4,10 @@ import os
 from datetime import datetime
 from typing import Dict, Any
 
+from preference_store import read_preferences, write_preferences
+from redis_client import get_redis_client
+from device_tokens import register_device_token, remove_device_tokens
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
     API for managing notification preferences and history.
@@ -15,6 +19,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     # Environment variables
     preferences_table_name = os.environ['PREFERENCES_TABLE']
     history_table_name = os.environ['HISTORY_TABLE']
+    device_tokens_table_name = os.environ['DEVICE_TOKENS_TABLE']
     
     try:
         # Parse API Gateway event
@@ -41,6 +46,12 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             return send_notification(body_data)
         elif '/history/' in path and http_method == 'GET':
             return get_notification_history(history_table_name, path_parameters.get('user_id'), query_parameters)
+        elif '/devices/' in path and http_method == 'POST':
+            return register_device(device_tokens_table_name, path_parameters.get('user_id'), body_data)
+        elif '/devices/' in path and http_method == 'DELETE':
+            return unregister_device(
+                device_tokens_table_name, path_parameters.get('user_id'), path_parameters.get('device_token')
+            )
         else:
             return {
                 'statusCode': 404,
@@ -69,18 +80,8 @@ def get_preferences(table_name: str, user_id: str) -> Dict:
         dynamodb = boto3.resource('dynamodb')
         table = dynamodb.Table(table_name)
         
-        # Get all preferences for the user
-        response = table.query(
-            KeyConditionExpression='user_id = :user_id',
-            ExpressionAttributeValues={':user_id': user_id}
-        )
-        
-        preferences = {}
-        for item in response.get('Items', []):
-            preferences[item['notification_type']] = {
-                'enabled': item.get('enabled', True),
-                'updated_at': item.get('updated_at', '')
-            }
+        # One GetItem of the user's preference document
+        preferences = read_preferences(table, user_id)
         
         # Set defaults for missing preferences
         default_preferences = ['push', 'email', 'sms', 'in_app']
@@ -119,21 +120,14 @@ def update_preferences(table_name: str, user_id: str, preferences_data: Dict) ->
         table = dynamodb.Table(table_name)
         
         preferences = preferences_data.get('preferences', {})
-        updated_count = 0
+        enabled_by_type = {
+            notification_type: bool(settings.get('enabled', True))
+            for notification_type, settings in preferences.items()
+            if notification_type in ['push', 'email', 'sms', 'in_app']
+        }
         
-        for notification_type, settings in preferences.items():
-            if notification_type not in ['push', 'email', 'sms', 'in_app']:
-                continue
-            
-            table.put_item(
-                Item={
-                    'user_id': user_id,
-                    'notification_type': notification_type,
-                    'enabled': bool(settings.get('enabled', True)),
-                    'updated_at': datetime.utcnow().isoformat()
-                }
-            )
-            updated_count += 1
+        write_preferences(table, user_id, enabled_by_type)
+        updated_count = len(enabled_by_type)
         
         return {
             'statusCode': 200,
@@ -152,6 +146,70 @@ def update_preferences(table_name: str, user_id: str, preferences_data: Dict) ->
             'body': json.dumps({'error': str(e)})
         }
 
+def register_device(table_name: str, user_id: str, device_data: Dict) -> Dict:
+    """Register a push device token of a user"""
+    try:
+        device_token = device_data.get('device_token')
+        if not user_id or not device_token:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json'},
+                'body': json.dumps({'error': 'user_id and device_token are required'})
+            }
+        
+        dynamodb = boto3.resource('dynamodb')
+        register_device_token(
+            get_redis_client(), dynamodb.Table(table_name), user_id, device_token,
+            device_data.get('platform', 'android')
+        )
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({
+                'message': 'Device registered',
+                'user_id': user_id
+            })
+        }
+        
+    except Exception as e:
+        print(f"Error registering device: {str(e)}")
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'error': str(e)})
+        }
+
+def unregister_device(table_name: str, user_id: str, device_token: str) -> Dict:
+    """Remove a push device token of a user"""
+    try:
+        if not user_id or not device_token:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json'},
+                'body': json.dumps({'error': 'user_id and device_token are required'})
+            }
+        
+        dynamodb = boto3.resource('dynamodb')
+        remove_device_tokens(get_redis_client(), dynamodb, table_name, {user_id: [device_token]})
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({
+                'message': 'Device unregistered',
+                'user_id': user_id
+            })
+        }
+        
+    except Exception as e:
+        print(f"Error unregistering device: {str(e)}")
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'error': str(e)})
+        }
+
 def send_notification(notification_data: Dict) -> Dict:
     """Send a notification"""
     try:
@@ -237,106 +295,3 @@ def get_notification_history(table_name: str, user_id: str, query_params: Dict)
             'headers': {'Content-Type': 'application/json'},
             'body': json.dumps({'error': str(e)})
         }
-
-def should_send_notification(table_name: str, user_id: str, notification_type: str) -> bool:
-    """Check if user wants to receive this type of notification"""
-    try:
-        dynamodb = boto3.resource('dynamodb')
-        table = dynamodb.Table(table_name)
-        
-        response = table.get_item(
-            Key={
-                'user_id': user_id,
-                'notification_type': notification_type
-            }
-        )
-        
-        if 'Item' in response:
-            return response['Item'].get('enabled', True)
-        
-        # Default to enabled if no preference set
-        return True
-        
-    except Exception as e:
-        print(f"Error checking notification preferences: {str(e)}")
-        return True  # Default to sending if error
-
-def send_push_notification(user_id: str, title: str, body: str, data: Dict, fcm_server_key: str) -> Dict:
-    """Send push notification via FCM"""
-    try:
-        import requests
-        
-        # Get user's device tokens (simplified - would query user table)
-        device_tokens = get_user_device_tokens(user_id)
-        
-        if not device_tokens:
-            return {'success': False, 'error': 'No device tokens found'}
-        
-        # FCM payload
-        fcm_payload = {
-            'registration_ids': device_tokens,
-            'notification': {
-                'title': title,
-                'body': body,
-                'sound': 'default',
-                'badge': '1'
-            },
-            'data': data,
-            'priority': 'high'
-        }
-        
-        # Send to FCM
-        headers = {
-            'Authorization': f'key={fcm_server_key}',
-            'Content-Type': 'application/json'
-        }
-        
-        response = requests.post(
-            'https://fcm.googleapis.com/fcm/send',
-            headers=headers,
-            json=fcm_payload,
-            timeout=30
-        )
-        
-        if response.status_code == 200:
-            return {'success': True, 'response': response.json()}
-        else:
-            return {'success': False, 'error': f'FCM error: {response.status_code}'}
-            
-    except Exception as e:
-        return {'success': False, 'error': str(e)}
-
-def get_user_device_tokens(user_id: str) -> List[str]:
-    """Get user's device tokens from database"""
-    # Simplified implementation - in production, query user devices table
-    # This would typically be stored in a separate DynamoDB table
-    return []
-
-def record_notification_history(history_table_name: str, user_id: str, notification_type: str, 
-                               title: str, body: str, status: str, error: str = None):
-    """Record notification in history table"""
-    try:
-        dynamodb = boto3.resource('dynamodb')
-        table = dynamodb.Table(history_table_name)
-        
-        notification_id = f"{user_id}_{int(datetime.utcnow().timestamp())}"
-        timestamp = datetime.utcnow().isoformat()
-        
-        item = {
-            'notification_id': notification_id,
-            'timestamp': timestamp,
-            'user_id': user_id,
-            'notification_type': notification_type,
-            'title': title,
-            'body': body,
-            'status': status,
-            'expires_at': int(datetime.utcnow().timestamp()) + (30 * 24 * 60 * 60)  # 30 days TTL
-        }
-        
-        if error:
-            item['error'] = error
-        
-        table.put_item(Item=item)
-        
-    except Exception as e:
-        print(f"Error recording notification history: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,134 @@
+import json
+import boto3
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+from preference_store import CHANNELS_ATTRIBUTE, document_mode, row_key, document_key, batch_get_items
+
+# Preferences are cached per container for a short time; a change made
+# through the API reaches the processors within PREFERENCE_CACHE_TTL seconds
+PREFERENCE_CACHE_TTL = int(os.environ.get('PREFERENCE_CACHE_TTL', '60'))
+PREFERENCE_CACHE_MAX_ENTRIES = int(os.environ.get('PREFERENCE_CACHE_MAX_ENTRIES', '10000'))
+
+# (user_id, notification_type) -> (preference or None, expiry), least
+# recently used first; reused across warm invocations
+_cache: 'OrderedDict[Tuple[str, str], Tuple[Optional[Dict[str, Any]], float]]' = OrderedDict()
+_dynamodb = None
+
+def get_dynamodb():
+    """Return the DynamoDB resource shared by every invocation of the container"""
+    global _dynamodb
+    if _dynamodb is None:
+        _dynamodb = boto3.resource('dynamodb')
+    return _dynamodb
+
+def record_message(record: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Parse the notification carried by an SQS or SNS record"""
+    try:
+        if 'body' in record:
+            return json.loads(record['body'])
+        if 'Sns' in record:
+            return json.loads(record['Sns']['Message'])
+    except (ValueError, TypeError):
+        pass
+    return None
+
+def preference_keys(records: List[Dict[str, Any]], notification_type: Optional[str] = None) -> List[Tuple[str, str]]:
+    """
+    Collect the (user_id, notification_type) keys of a batch. Without a
+    fixed notification_type the type of each message is used.
+    """
+    keys = []
+    for record in records:
+        message = record_message(record)
+        if not message or not message.get('user_id'):
+            continue
+        keys.append((message['user_id'], notification_type or message.get('type', 'default')))
+    return keys
+
+def _cached(key: Tuple[str, str], now: float):
+    entry = _cache.get(key)
+    if entry is None or entry[1] <= now:
+        return False, None
+    _cache.move_to_end(key)
+    return True, entry[0]
+
+def _store(key: Tuple[str, str], preference: Optional[Dict[str, Any]], now: float):
+    _cache[key] = (preference, now + PREFERENCE_CACHE_TTL)
+    _cache.move_to_end(key)
+    while len(_cache) > PREFERENCE_CACHE_MAX_ENTRIES:
+        _cache.popitem(last=False)
+
+def prefetch_preferences(table_name: str, keys: Iterable[Tuple[str, str]]):
+    """
+    Load every preference of a batch missing from the cache with
+    BatchGetItem: the users' preference documents first, then the per-type
+    rows of users without one. Keys without a stored preference are cached
+    as such; keys that could not be read are left to is_enabled.
+    """
+    now = time.time()
+    missing = [key for key in dict.fromkeys(keys) if not _cached(key, now)[0]]
+    if not missing:
+        return
+
+    try:
+        dynamodb = get_dynamodb()
+
+        if document_mode():
+            user_ids = list(dict.fromkeys(user_id for user_id, _ in missing))
+            items, unread = batch_get_items(dynamodb, table_name, [document_key(user_id) for user_id in user_ids])
+            documents = {item['user_id']: item.get(CHANNELS_ATTRIBUTE, {}) for item in items}
+            unread_users = {key['user_id'] for key in unread}
+
+            without_document = []
+            for key in missing:
+                if key[0] in documents:
+                    _store(key, documents[key[0]].get(key[1]), now)
+                elif key[0] not in unread_users:
+                    without_document.append(key)
+            missing = without_document
+
+        items, unread = batch_get_items(dynamodb, table_name, [row_key(*key) for key in missing])
+        found = {(item['user_id'], item['notification_type']): item for item in items}
+        unread_keys = {(key['user_id'], key['notification_type']) for key in unread}
+
+        for key in missing:
+            if key not in unread_keys:
+                _store(key, found.get(key), now)
+
+    except Exception as e:
+        print(f"Error prefetching notification preferences: {str(e)}")
+
+def load_preference(table_name: str, user_id: str, notification_type: str) -> Optional[Dict[str, Any]]:
+    """Read one preference from the user's document, or its row without one"""
+    table = get_dynamodb().Table(table_name)
+
+    if document_mode():
+        response = table.get_item(Key=document_key(user_id))
+        if 'Item' in response:
+            return response['Item'].get(CHANNELS_ATTRIBUTE, {}).get(notification_type)
+
+    return table.get_item(Key=row_key(user_id, notification_type)).get('Item')
+
+def is_enabled(table_name: str, user_id: str, notification_type: str, default: bool) -> bool:
+    """
+    Whether a user receives a notification type, from the cache or read
+    on a miss. Without a stored preference, or on errors, default applies.
+    """
+    key = (user_id, notification_type)
+    now = time.time()
+
+    hit, preference = _cached(key, now)
+    if not hit:
+        try:
+            preference = load_preference(table_name, user_id, notification_type)
+        except Exception as e:
+            print(f"Error checking notification preferences: {str(e)}")
+            return default
+        _store(key, preference, now)
+
+    if preference is None:
+        return default
+    return preference.get('enabled', default)
@@ -0,0 +1,160 @@
+import os
+import time
+from datetime import datetime
+from typing import Dict, Any, List, Tuple
+
+# 'document' keeps all of a user's channel preferences in one item, read with
+# a single GetItem; 'rows' keeps one item per notification type. Documents
+# are created lazily from existing rows, which are read while none exists.
+PREFERENCE_STORAGE = os.environ.get('PREFERENCE_STORAGE', 'document')
+
+# Sort key of the preference document, alongside the per-type rows
+DOCUMENT_TYPE = '_preferences'
+# Map of notification_type -> {'enabled': bool, 'updated_at': str}
+CHANNELS_ATTRIBUTE = 'channels'
+
+# BatchGetItem accepts at most 100 keys per call
+BATCH_GET_MAX_KEYS = 100
+BATCH_GET_MAX_RETRIES = 3
+
+def document_mode() -> bool:
+    return PREFERENCE_STORAGE == 'document'
+
+def row_key(user_id: str, notification_type: str) -> Dict[str, str]:
+    return {'user_id': user_id, 'notification_type': notification_type}
+
+def document_key(user_id: str) -> Dict[str, str]:
+    return row_key(user_id, DOCUMENT_TYPE)
+
+def batch_get_items(dynamodb, table_name: str, keys: List[Dict[str, str]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, str]]]:
+    """
+    Read keys with BatchGetItem in chunks of 100, retrying unprocessed keys
+    with exponential backoff. Returns the items found and the keys that
+    could not be read.
+    """
+    items = []
+    unread = []
+
+    for i in range(0, len(keys), BATCH_GET_MAX_KEYS):
+        request = {table_name: {'Keys': keys[i:i + BATCH_GET_MAX_KEYS]}}
+
+        attempt = 0
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            items.extend(response.get('Responses', {}).get(table_name, []))
+
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+
+            attempt += 1
+            if attempt > BATCH_GET_MAX_RETRIES:
+                unread.extend(request.get(table_name, {}).get('Keys', []))
+                break
+
+            time.sleep(min(0.05 * (2 ** (attempt - 1)), 1))
+
+    return items, unread
+
+def query_preference_rows(table, user_id: str) -> Dict[str, Dict[str, Any]]:
+    """Channel preferences of a user stored as one item per notification type"""
+    query_kwargs = {
+        'KeyConditionExpression': 'user_id = :user_id',
+        'ExpressionAttributeValues': {':user_id': user_id}
+    }
+
+    preferences = {}
+    while True:
+        response = table.query(**query_kwargs)
+        for item in response.get('Items', []):
+            if item['notification_type'] == DOCUMENT_TYPE:
+                continue
+            preferences[item['notification_type']] = {
+                'enabled': item.get('enabled', True),
+                'updated_at': item.get('updated_at', '')
+            }
+
+        if 'LastEvaluatedKey' not in response:
+            return preferences
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def read_preferences(table, user_id: str) -> Dict[str, Dict[str, Any]]:
+    """
+    All channel preferences of a user. In document mode a user without a
+    document is read from the per-type rows, which are then migrated into
+    one.
+    """
+    if not document_mode():
+        return query_preference_rows(table, user_id)
+
+    response = table.get_item(Key=document_key(user_id))
+    if 'Item' in response:
+        return dict(response['Item'].get(CHANNELS_ATTRIBUTE, {}))
+
+    preferences = query_preference_rows(table, user_id)
+    if preferences:
+        create_document(table, user_id, preferences)
+    return preferences
+
+def create_document(table, user_id: str, preferences: Dict[str, Dict[str, Any]]) -> bool:
+    """Write a user's first preference document; False if one already exists"""
+    try:
+        table.put_item(
+            Item={**document_key(user_id), CHANNELS_ATTRIBUTE: preferences},
+            ConditionExpression='attribute_not_exists(user_id)'
+        )
+        return True
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+def write_preferences(table, user_id: str, enabled_by_type: Dict[str, bool]):
+    """
+    Store channel preferences. In document mode this is a single UpdateItem
+    of the document's map, or its creation from the existing rows the first
+    time a user saves preferences.
+    """
+    updated_at = datetime.utcnow().isoformat()
+
+    if not document_mode():
+        for notification_type, enabled in enabled_by_type.items():
+            table.put_item(
+                Item={
+                    **row_key(user_id, notification_type),
+                    'enabled': enabled,
+                    'updated_at': updated_at
+                }
+            )
+        return
+
+    if not enabled_by_type:
+        return
+
+    names = {'#channels': CHANNELS_ATTRIBUTE}
+    values = {}
+    assignments = []
+    for i, (notification_type, enabled) in enumerate(enabled_by_type.items()):
+        names[f'#type{i}'] = notification_type
+        values[f':preference{i}'] = {'enabled': enabled, 'updated_at': updated_at}
+        assignments.append(f'#channels.#type{i} = :preference{i}')
+
+    # A concurrent first write can create the document between both steps
+    for _ in range(2):
+        try:
+            table.update_item(
+                Key=document_key(user_id),
+                UpdateExpression='SET ' + ', '.join(assignments),
+                ConditionExpression='attribute_exists(#channels)',
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values
+            )
+            return
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+        preferences = query_preference_rows(table, user_id)
+        for notification_type, enabled in enabled_by_type.items():
+            preferences[notification_type] = {'enabled': enabled, 'updated_at': updated_at}
+        if create_document(table, user_id, preferences):
+            return
+
+    raise RuntimeError(f"Could not update the preference document of user {user_id}")
@@ -1,8 +1,15 @@
-mport json
+import json
 import boto3
 import os
 from datetime import datetime
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Tuple
+
+from sqs_batch import batch_item_failures, all_items_failed, record_id, raise_for_sns_failures, has_sns_records
+from preference_cache import preference_keys, prefetch_preferences, is_enabled
+from history_writer import HistoryWriter
+from redis_client import get_redis_client
+from device_tokens import get_device_tokens_batch, remove_device_tokens
+from fcm import FCM_MULTICAST_MAX_TOKENS, INVALID_TOKEN_ERRORS, send_multicast
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
@@ -12,17 +19,26 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     # Initialize AWS clients
     dynamodb = boto3.resource('dynamodb')
-    sns = boto3.client('sns')
     
     # Environment variables
     preferences_table_name = os.environ['PREFERENCES_TABLE']
     history_table_name = os.environ['HISTORY_TABLE']
+    device_tokens_table_name = os.environ['DEVICE_TOKENS_TABLE']
     fcm_server_key = os.environ.get('FCM_SERVER_KEY', '')
-    max_batch_size = int(os.environ.get('MAX_BATCH_SIZE', '100'))
     
     try:
         processed_count = 0
         failed_count = 0
+        failed_message_ids = []
+        
+        # Opted-in notifications of the batch, delivered together
+        pending = []
+        
+        # History rows of the batch, written together once it is processed
+        history = HistoryWriter(dynamodb, history_table_name)
+        
+        # Load the preferences of the whole batch with one BatchGetItem
+        prefetch_preferences(preferences_table_name, preference_keys(event.get('Records', [])))
         
         # Process each record from SQS/SNS
         for record in event.get('Records', []):
@@ -49,34 +65,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 
                 # Check user preferences
                 if should_send_notification(preferences_table_name, user_id, notification_type):
-                    # Send push notification
-                    result = send_push_notification(
-                        user_id=user_id,
-                        title=title,
-                        body=body,
-                        data=data,
-                        fcm_server_key=fcm_server_key
-                    )
-                    
-                    # Record in history
-                    record_notification_history(
-                        history_table_name=history_table_name,
-                        user_id=user_id,
-                        notification_type=notification_type,
-                        title=title,
-                        body=body,
-                        status='sent' if result['success'] else 'failed',
-                        error=result.get('error')
-                    )
-                    
-                    if result['success']:
-                        processed_count += 1
-                    else:
-                        failed_count += 1
+                    # Sent in multicast batches once the whole batch is read
+                    pending.append({
+                        'message_id': record_id(record),
+                        'user_id': user_id,
+                        'notification_type': notification_type,
+                        'title': title,
+                        'body': body,
+                        'data': data
+                    })
                 else:
                     # User opted out - record as skipped
                     record_notification_history(
-                        history_table_name=history_table_name,
+                        history=history,
                         user_id=user_id,
                         notification_type=notification_type,
                         title=title,
@@ -88,6 +89,21 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             except Exception as e:
                 print(f"Error processing record: {str(e)}")
                 failed_count += 1
+                # Returned to the queue for retry instead of being dropped
+                failed_message_ids.append(record_id(record))
+        
+        if pending:
+            processed, failed, retry_message_ids = deliver_push_notifications(
+                dynamodb, device_tokens_table_name, fcm_server_key, pending, history
+            )
+            processed_count += processed
+            failed_count += failed
+            failed_message_ids.extend(retry_message_ids)
+        
+        history.flush()
+        
+        # SNS retries only invocations that raise
+        raise_for_sns_failures(event.get('Records', []), failed_message_ids)
         
         return {
             'statusCode': 200,
@@ -95,81 +111,135 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'processed': processed_count,
                 'failed': failed_count,
                 'total': len(event.get('Records', []))
-            })
+            }),
+            'batchItemFailures': batch_item_failures(event.get('Records', []), failed_message_ids)
         }
         
     except Exception as e:
         print(f"Error in push processor: {str(e)}")
+        if has_sns_records(event.get('Records', [])):
+            raise
         return {
             'statusCode': 500,
-            'body': json.dumps({'error': str(e)})
+            'body': json.dumps({'error': str(e)}),
+            'batchItemFailures': all_items_failed(event.get('Records', []))
         }
 
-def should_send_sms(table_name: str, user_id: str, notification_type: str) -> bool:
-    """Check SMS preferences"""
-    try:
-        dynamodb = boto3.resource('dynamodb')
-        table = dynamodb.Table(table_name)
-        
-        response = table.get_item(
-            Key={
-                'user_id': user_id,
-                'notification_type': notification_type
-            }
-        )
-        
-        return response.get('Item', {}).get('enabled', False)  # SMS defaults to disabled
-        
-    except Exception as e:
-        print(f"Error checking SMS preferences: {str(e)}")
-        return False
+def should_send_notification(table_name: str, user_id: str, notification_type: str) -> bool:
+    """Check if user wants to receive this type of notification"""
+    # Default to sending if no preference is set or on error
+    return is_enabled(table_name, user_id, notification_type, default=True)
 
-def send_sms(sns_client, phone_number: str, message: str, sender_id: str) -> Dict:
-    """Send SMS via SNS"""
-    try:
-        response = sns_client.publish(
-            PhoneNumber=phone_number,
-            Message=message,
-            MessageAttributes={
-                'AWS.SNS.SMS.SenderID': {
-                    'DataType': 'String',
-                    'StringValue': sender_id
-                },
-                'AWS.SNS.SMS.SMSType': {
-                    'DataType': 'String',
-                    'StringValue': 'Transactional'
-                }
-            }
-        )
-        return {'success': True, 'message_id': response['MessageId']}
-    except Exception as e:
-        return {'success': False, 'error': str(e)}
-
-def record_sms_history(history_table_name: str, user_id: str, phone_number: str, 
-                      content: str, status: str, error: str = None):
-    """Record SMS in history"""
-    try:
-        dynamodb = boto3.resource('dynamodb')
-        table = dynamodb.Table(history_table_name)
-        
-        notification_id = f"sms_{user_id}_{int(datetime.utcnow().timestamp())}"
-        timestamp = datetime.utcnow().isoformat()
-        
-        item = {
-            'notification_id': notification_id,
-            'timestamp': timestamp,
-            'user_id': user_id,
-            'notification_type': 'sms',
-            'phone_number': phone_number,
-            'content': content,
-            'status': status,
-            'expires_at': int(datetime.utcnow().timestamp()) + (30 * 24 * 60 * 60)
-        }
+def deliver_push_notifications(dynamodb, device_tokens_table_name: str, fcm_server_key: str,
+                               pending: List[Dict], history: HistoryWriter) -> Tuple[int, int, List[str]]:
+    """
+    Deliver notifications to their users' devices. Notifications with the
+    same payload share FCM multicast requests of up to 500 tokens, and
+    tokens FCM reports as invalid are removed from the registry. Returns
+    the sent and failed counts, and the record IDs to retry because
+    none of their devices could be reached.
+    """
+    redis_client = get_redis_client()
+    tokens_by_user = get_device_tokens_batch(
+        redis_client, dynamodb.Table(device_tokens_table_name), [push['user_id'] for push in pending]
+    )
+    
+    # Delivery state per notification: delivered, first error, retry
+    outcomes = [{'sent': False, 'error': None, 'retry': False} for _ in pending]
+    invalid_tokens = {}
+    
+    groups = {}
+    for index, push in enumerate(pending):
+        if not tokens_by_user.get(push['user_id']):
+            outcomes[index]['error'] = 'No device tokens found'
+            continue
+        payload = json.dumps([push['title'], push['body'], push['data']], sort_keys=True, default=str)
+        groups.setdefault(payload, []).append(index)
+    
+    for indexes in groups.values():
+        first = pending[indexes[0]]
+        targets = [
+            (index, device_token)
+            for index in indexes
+            for device_token in tokens_by_user[pending[index]['user_id']]
+        ]
         
-        if error:
-            item['error'] = error
+        for i in range(0, len(targets), FCM_MULTICAST_MAX_TOKENS):
+            chunk = targets[i:i + FCM_MULTICAST_MAX_TOKENS]
+            try:
+                response = send_multicast(
+                    fcm_server_key, [device_token for _, device_token in chunk],
+                    first['title'], first['body'], first['data']
+                )
+            except Exception as e:
+                response = {'success': False, 'error': str(e), 'retry': True}
+            
+            if not response['success']:
+                for index, _ in chunk:
+                    outcomes[index]['error'] = outcomes[index]['error'] or response['error']
+                    outcomes[index]['retry'] = outcomes[index]['retry'] or response.get('retry', False)
+                continue
+            
+            for (index, device_token), result in zip(chunk, response['results']):
+                if 'message_id' in result:
+                    outcomes[index]['sent'] = True
+                    continue
+                outcomes[index]['error'] = outcomes[index]['error'] or result.get('error')
+                if result.get('error') in INVALID_TOKEN_ERRORS:
+                    invalid_tokens.setdefault(pending[index]['user_id'], set()).add(device_token)
+    
+    if invalid_tokens:
+        try:
+            remove_device_tokens(redis_client, dynamodb, device_tokens_table_name, invalid_tokens)
+        except Exception as e:
+            print(f"Error pruning invalid device tokens: {str(e)}")
+    
+    processed_count = 0
+    failed_count = 0
+    retry_message_ids = []
+    
+    for push, outcome in zip(pending, outcomes):
+        # Notifications that reached a device are not retried, to avoid duplicates
+        if not outcome['sent'] and outcome['retry']:
+            failed_count += 1
+            retry_message_ids.append(push['message_id'])
+            continue
         
-        table.put_item(Item=item)
+        record_notification_history(
+            history=history,
+            user_id=push['user_id'],
+            notification_type=push['notification_type'],
+            title=push['title'],
+            body=push['body'],
+            status='sent' if outcome['sent'] else 'failed',
+            error=None if outcome['sent'] else outcome['error']
+        )
         
-    except Exception as e:
-        print(f"Error recording SMS history: {str(e)}")
+        if outcome['sent']:
+            processed_count += 1
+        else:
+            failed_count += 1
+    
+    return processed_count, failed_count, retry_message_ids
+
+def record_notification_history(history: HistoryWriter, user_id: str, notification_type: str, 
+                               title: str, body: str, status: str, error: str = None):
+    """Record notification in history table"""
+    notification_id = f"{user_id}_{int(datetime.utcnow().timestamp())}"
+    timestamp = datetime.utcnow().isoformat()
+    
+    item = {
+        'notification_id': notification_id,
+        'timestamp': timestamp,
+        'user_id': user_id,
+        'notification_type': notification_type,
+        'title': title,
+        'body': body,
+        'status': status,
+        'expires_at': int(datetime.utcnow().timestamp()) + (30 * 24 * 60 * 60)  # 30 days TTL
+    }
+    
+    if error:
+        item['error'] = error
+    
+    history.add(item)
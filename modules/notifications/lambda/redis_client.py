@@ -0,0 +1,22 @@
+import os
+from redis.cluster import RedisCluster
+
+REDIS_ENDPOINT = os.environ.get('REDIS_ENDPOINT', '')
+
+# Redis connection reused across warm invocations
+_redis_client = None
+
+def get_redis_client():
+    """Return the shared Redis client, or None when Redis is not configured"""
+    global _redis_client
+
+    if _redis_client is None and REDIS_ENDPOINT:
+        # The Redis endpoint runs in cluster mode: the client follows the
+        # slot map, and each script or transaction must stay within one slot
+        _redis_client = RedisCluster(
+            host=REDIS_ENDPOINT.split(':')[0],
+            port=int(REDIS_ENDPOINT.split(':')[1]) if ':' in REDIS_ENDPOINT else 6379,
+            decode_responses=True
+        )
+
+    return _redis_client
@@ -0,0 +1,170 @@
+import json
+import math
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+# SMS sent concurrently per container
+SMS_MAX_WORKERS = int(os.environ.get('SMS_MAX_WORKERS', '10'))
+
+# Messages per second across all containers: for the whole account, and per
+# destination country prefix. SMS_COUNTRY_SEND_RATES maps E.164 country
+# prefixes to rates, e.g. {"1": 10, "44": 5}; other numbers share a bucket
+# per ITU country code at SMS_DEFAULT_COUNTRY_SEND_RATE.
+SMS_ACCOUNT_SEND_RATE = float(os.environ.get('SMS_ACCOUNT_SEND_RATE', '20'))
+SMS_COUNTRY_SEND_RATES = {
+    prefix: float(rate) for prefix, rate in json.loads(os.environ.get('SMS_COUNTRY_SEND_RATES') or '{}').items()
+}
+SMS_DEFAULT_COUNTRY_SEND_RATE = float(os.environ.get('SMS_DEFAULT_COUNTRY_SEND_RATE', '10'))
+
+# Rate-limit waits up to SMS_MAX_INLINE_WAIT_MS are slept out in the
+# container, at most SMS_MAX_INLINE_WAITS times per message and only while
+# the invocation has more than SMS_WAIT_TIME_MARGIN_MS left
+SMS_MAX_INLINE_WAIT_MS = int(os.environ.get('SMS_MAX_INLINE_WAIT_MS', '1000'))
+SMS_MAX_INLINE_WAITS = int(os.environ.get('SMS_MAX_INLINE_WAITS', '5'))
+SMS_WAIT_TIME_MARGIN_MS = int(os.environ.get('SMS_WAIT_TIME_MARGIN_MS', '10000'))
+
+# Throttled messages go back to the queue this many times before failing
+SMS_MAX_THROTTLED_REQUEUES = int(os.environ.get('SMS_MAX_THROTTLED_REQUEUES', '10'))
+# SQS caps message delays at 15 minutes
+MAX_DELAY_SECONDS = 900
+
+SEND_RATE_KEY_PREFIX = 'sms_rate:'
+
+# Takes one token from every bucket, or none. Buckets refill at their rate
+# and hold at most one second of sends. Returns 0 when the send may go
+# ahead, otherwise the milliseconds until every bucket has a token.
+# KEYS: bucket keys; ARGV: now in ms, then the rate of each bucket
+SEND_RATE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or rate
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(rate, tokens + math.max(0, now - updated) * rate / 1000)
+    levels[i] = tokens
+    if tokens < 1 then
+        wait = math.max(wait, math.ceil((1 - tokens) * 1000 / rate))
+    end
+end
+for i, key in ipairs(KEYS) do
+    local tokens = levels[i]
+    if wait == 0 then
+        tokens = tokens - 1
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'updated', ARGV[1])
+    redis.call('PEXPIRE', key, 60000)
+end
+return wait
+"""
+
+# ITU-T E.164 country codes are prefix-free: zones 1 (NANP) and 7 are one
+# digit, these are two digits and every other code is three
+TWO_DIGIT_COUNTRY_CODES = {
+    '20', '27', '30', '31', '32', '33', '34', '36', '39', '40', '41', '43',
+    '44', '45', '46', '47', '48', '49', '51', '52', '53', '54', '55', '56',
+    '57', '58', '60', '61', '62', '63', '64', '65', '66', '81', '82', '84',
+    '86', '90', '91', '92', '93', '94', '95', '98'
+}
+
+_executor = ThreadPoolExecutor(max_workers=SMS_MAX_WORKERS)
+
+def country_code(digits: str) -> str:
+    """ITU country code of an E.164 number without its '+'"""
+    if digits[:1] in ('1', '7'):
+        return digits[:1]
+    if digits[:2] in TWO_DIGIT_COUNTRY_CODES:
+        return digits[:2]
+    return digits[:3]
+
+def country_prefix(phone_number: str) -> Tuple[str, float]:
+    """Rate-limit bucket of an E.164 number: its country prefix and rate"""
+    digits = phone_number.lstrip('+')
+    for length in (4, 3, 2, 1):
+        prefix = digits[:length]
+        if prefix in SMS_COUNTRY_SEND_RATES:
+            return prefix, SMS_COUNTRY_SEND_RATES[prefix]
+    return country_code(digits), SMS_DEFAULT_COUNTRY_SEND_RATE
+
+def acquire_send_slot(redis_client, account_id: str, phone_number: str) -> int:
+    """
+    Take a send from the account and country buckets shared in Redis.
+    Returns 0 when the SMS may be sent, otherwise the milliseconds to wait.
+    Without Redis sends are not limited here.
+    """
+    if redis_client is None:
+        return 0
+
+    prefix, country_rate = country_prefix(phone_number)
+    # Hash tag keeps both buckets in one slot on a cluster
+    keys = [f"{SEND_RATE_KEY_PREFIX}{{{account_id}}}", f"{SEND_RATE_KEY_PREFIX}{{{account_id}}}:{prefix}"]
+    try:
+        return int(redis_client.eval(
+            SEND_RATE_SCRIPT, len(keys), *keys,
+            int(time.time() * 1000), SMS_ACCOUNT_SEND_RATE, country_rate
+        ))
+    except Exception as e:
+        print(f"Error checking SMS send rate: {str(e)}")
+        return 0
+
+def is_throttling_error(error: Exception) -> bool:
+    response: Optional[Dict[str, Any]] = getattr(error, 'response', None)
+    return bool(response) and response.get('Error', {}).get('Code') in ('Throttling', 'ThrottlingException', 'ThrottledException')
+
+def dispatch(send, redis_client, account_id: str, messages: List[Dict[str, Any]],
+             remaining_ms: Optional[Callable[[], int]] = None) -> List[Dict[str, Any]]:
+    """
+    Send messages on the thread pool, each after taking a slot from the
+    shared rate limits. send(message) publishes one SMS; remaining_ms()
+    is the time left in the invocation. Returns one result per message, in
+    order: {'success', 'message_id' | 'error'}, or {'throttled': True,
+    'delay_seconds'} when it should be sent later.
+    """
+    def can_wait(wait_ms, waits):
+        return (
+            wait_ms <= SMS_MAX_INLINE_WAIT_MS and waits < SMS_MAX_INLINE_WAITS
+            and (remaining_ms is None or remaining_ms() - wait_ms > SMS_WAIT_TIME_MARGIN_MS)
+        )
+
+    def send_one(message):
+        wait_ms = acquire_send_slot(redis_client, account_id, message['phone_number'])
+        waits = 0
+        # A requeue costs at least a second of SQS delay; wait out shorter ones
+        while wait_ms and can_wait(wait_ms, waits):
+            # Jitter so the waiting workers do not all retry at once
+            time.sleep((wait_ms + random.uniform(0, 50)) / 1000)
+            waits += 1
+            wait_ms = acquire_send_slot(redis_client, account_id, message['phone_number'])
+        if wait_ms:
+            return {'throttled': True, 'delay_seconds': wait_ms / 1000}
+        try:
+            return {'success': True, 'message_id': send(message)}
+        except Exception as e:
+            if is_throttling_error(e):
+                return {'throttled': True, 'delay_seconds': 1}
+            return {'success': False, 'error': str(e)}
+
+    return list(_executor.map(send_one, messages))
+
+def requeue_throttled(sqs_client, queue_url: str, message: Dict[str, Any], delay_seconds: float) -> bool:
+    """
+    Send a throttled SMS back to the queue after a jittered delay. Returns
+    False once it was throttled SMS_MAX_THROTTLED_REQUEUES times.
+    """
+    attempts = message.get('throttled_requeues', 0)
+    if attempts >= SMS_MAX_THROTTLED_REQUEUES:
+        return False
+
+    # Grows with each requeue so a burst spreads out instead of colliding again
+    delay = min(MAX_DELAY_SECONDS, math.ceil(delay_seconds * (2 ** attempts) + random.uniform(0, 1 + attempts)))
+    sqs_client.send_message(
+        QueueUrl=queue_url,
+        MessageBody=json.dumps({**message, 'throttled_requeues': attempts + 1}),
+        DelaySeconds=max(1, delay)
+    )
+    return True
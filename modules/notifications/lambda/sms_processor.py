@@ -2,7 +2,13 @@ import json
 import boto3
 import os
 from datetime import datetime
-from typing import Dict, Any
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+from sqs_batch import batch_item_failures, all_items_failed, record_id, raise_for_sns_failures, has_sns_records
+from preference_cache import preference_keys, prefetch_preferences, is_enabled
+from history_writer import HistoryWriter
+from redis_client import get_redis_client
+from sms_dispatch import dispatch, requeue_throttled
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
@@ -11,16 +17,28 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     # Initialize AWS clients
     sns = boto3.client('sns')
+    sqs = boto3.client('sqs')
     dynamodb = boto3.resource('dynamodb')
     
     # Environment variables
     preferences_table_name = os.environ['PREFERENCES_TABLE']
     history_table_name = os.environ['HISTORY_TABLE']
     sms_sender_id = os.environ.get('SMS_SENDER_ID', 'SocialApp')
+    sms_queue_url = os.environ['SMS_QUEUE_URL']
     
     try:
         processed_count = 0
         failed_count = 0
+        failed_message_ids = []
+        
+        # Opted-in messages of the batch, dispatched together
+        pending = []
+        
+        # History rows of the batch, written together once it is processed
+        history = HistoryWriter(dynamodb, history_table_name)
+        
+        # Load the preferences of the whole batch with one BatchGetItem
+        prefetch_preferences(preferences_table_name, preference_keys(event.get('Records', []), 'sms'))
         
         for record in event.get('Records', []):
             try:
@@ -41,43 +59,143 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 
                 # Check preferences
                 if should_send_sms(preferences_table_name, user_id, 'sms'):
-                    # Send SMS
-                    result = send_sms(
-                        sns_client=sns,
-                        phone_number=phone_number,
-                        message=sms_content,
-                        sender_id=sms_sender_id
-                    )
-                    
-                    # Record history
-                    record_sms_history(
-                        history_table_name=history_table_name,
-                        user_id=user_id,
-                        phone_number=phone_number,
-                        content=sms_content,
-                        status='sent' if result['success'] else 'failed',
-                        error=result.get('error')
-                    )
-                    
-                    if result['success']:
-                        processed_count += 1
-                    else:
-                        failed_count += 1
+                    # Sent concurrently once the whole batch is read
+                    pending.append({
+                        'message_id': record_id(record),
+                        'message': message,
+                        'user_id': user_id,
+                        'phone_number': phone_number,
+                        'content': sms_content
+                    })
                         
             except Exception as e:
                 print(f"Error processing SMS record: {str(e)}")
                 failed_count += 1
+                # Returned to the queue for retry instead of being dropped
+                failed_message_ids.append(record_id(record))
+        
+        if pending:
+            # Rate limits are shared by every function of the account
+            account_id = context.invoked_function_arn.split(':')[4]
+            processed, failed, retry_message_ids = dispatch_sms(
+                sns, sqs, sms_queue_url, sms_sender_id, account_id, pending, history,
+                context.get_remaining_time_in_millis
+            )
+            processed_count += processed
+            failed_count += failed
+            failed_message_ids.extend(retry_message_ids)
+        
+        history.flush()
+        
+        # SNS retries only invocations that raise
+        raise_for_sns_failures(event.get('Records', []), failed_message_ids)
         
         return {
             'statusCode': 200,
             'body': json.dumps({
                 'processed': processed_count,
                 'failed': failed_count
-            })
+            }),
+            'batchItemFailures': batch_item_failures(event.get('Records', []), failed_message_ids)
         }
         
     except Exception as e:
         print(f"Error in SMS processor: {str(e)}")
+        if has_sns_records(event.get('Records', [])):
+            raise
         return {
-            'statusCode': 500
-        }
\ No newline at end of file
+            'statusCode': 500,
+            'batchItemFailures': all_items_failed(event.get('Records', []))
+        }
+
+def should_send_sms(table_name: str, user_id: str, notification_type: str) -> bool:
+    """Check SMS preferences"""
+    # SMS defaults to disabled
+    return is_enabled(table_name, user_id, notification_type, default=False)
+
+def dispatch_sms(sns_client, sqs_client, sms_queue_url: str, sender_id: str, account_id: str,
+                 pending: List[Dict], history: HistoryWriter,
+                 remaining_ms: Optional[Callable[[], int]] = None) -> Tuple[int, int, List[str]]:
+    """
+    Send the queued messages concurrently under the shared rate limits and
+    record their results. Short rate-limit waits are slept out while
+    remaining_ms() allows; messages throttled for longer are sent back to
+    the SMS queue with a delay instead. Returns the sent and failed counts, and the record
+    message IDs to retry because they could not be requeued.
+    """
+    results = dispatch(
+        lambda sms: send_sms(sns_client, sms['phone_number'], sms['content'], sender_id),
+        get_redis_client(), account_id, pending, remaining_ms
+    )
+    
+    processed_count = 0
+    failed_count = 0
+    retry_message_ids = []
+    
+    for sms, result in zip(pending, results):
+        if result.get('throttled'):
+            try:
+                if requeue_throttled(sqs_client, sms_queue_url, sms['message'], result['delay_seconds']):
+                    continue
+                result = {'success': False, 'error': 'Throttled too many times'}
+            except Exception as e:
+                print(f"Error requeueing throttled SMS: {str(e)}")
+                failed_count += 1
+                retry_message_ids.append(sms['message_id'])
+                continue
+        
+        record_sms_history(
+            history=history,
+            user_id=sms['user_id'],
+            phone_number=sms['phone_number'],
+            content=sms['content'],
+            status='sent' if result['success'] else 'failed',
+            error=result.get('error')
+        )
+        
+        if result['success']:
+            processed_count += 1
+        else:
+            failed_count += 1
+    
+    return processed_count, failed_count, retry_message_ids
+
+def send_sms(sns_client, phone_number: str, message: str, sender_id: str) -> str:
+    """Send SMS via SNS and return its message ID"""
+    response = sns_client.publish(
+        PhoneNumber=phone_number,
+        Message=message,
+        MessageAttributes={
+            'AWS.SNS.SMS.SenderID': {
+                'DataType': 'String',
+                'StringValue': sender_id
+            },
+            'AWS.SNS.SMS.SMSType': {
+                'DataType': 'String',
+                'StringValue': 'Transactional'
+            }
+        }
+    )
+    return response['MessageId']
+
+def record_sms_history(history: HistoryWriter, user_id: str, phone_number: str, 
+                      content: str, status: str, error: str = None):
+    """Record SMS in history"""
+    notification_id = f"sms_{user_id}_{int(datetime.utcnow().timestamp())}"
+    timestamp = datetime.utcnow().isoformat()
+    
+    item = {
+        'notification_id': notification_id,
+        'timestamp': timestamp,
+        'user_id': user_id,
+        'notification_type': 'sms',
+        'phone_number': phone_number,
+        'content': content,
+        'status': status,
+        'expires_at': int(datetime.utcnow().timestamp()) + (30 * 24 * 60 * 60)
+    }
+    
+    if error:
+        item['error'] = error
+    
+    history.add(item)
@@ -0,0 +1,61 @@
+from typing import Dict, Any, List, Iterable
+
+def is_sqs_record(record: Dict[str, Any]) -> bool:
+    """Check whether a record was delivered by an SQS event source mapping"""
+    return record.get('eventSource') == 'aws:sqs'
+
+def is_sns_record(record: Dict[str, Any]) -> bool:
+    """Check whether a record was delivered by an SNS subscription"""
+    return record.get('EventSource') == 'aws:sns'
+
+def record_id(record: Dict[str, Any]) -> str:
+    """ID tracking a record in a batch: the SQS messageId or the SNS MessageId"""
+    if is_sns_record(record):
+        return record['Sns']['MessageId']
+    return record.get('messageId')
+
+def batch_item_failures(records: List[Dict[str, Any]], failed_message_ids: Iterable[str]) -> List[Dict[str, str]]:
+    """
+    Build the batchItemFailures list for ReportBatchItemFailures.
+
+    Only SQS records are reported; SNS invocations ignore the field. On FIFO
+    queues every record after a failure in the same message group is also
+    returned so the group is retried in order.
+    """
+    failed_message_ids = set(failed_message_ids)
+    failures = []
+    failed_groups = set()
+
+    for record in records:
+        if not is_sqs_record(record):
+            continue
+
+        message_id = record['messageId']
+        group_id = record.get('attributes', {}).get('MessageGroupId')
+
+        if message_id in failed_message_ids or (group_id is not None and group_id in failed_groups):
+            failures.append({'itemIdentifier': message_id})
+            if group_id is not None:
+                failed_groups.add(group_id)
+
+    return failures
+
+def all_items_failed(records: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    """Report every SQS record in the batch as failed"""
+    return [{'itemIdentifier': record['messageId']} for record in records if is_sqs_record(record)]
+
+def raise_for_sns_failures(records: List[Dict[str, Any]], failed_message_ids: Iterable[str]):
+    """
+    Fail the invocation when an SNS record failed. SNS invokes functions
+    asynchronously and ignores batchItemFailures, so a failed record is only
+    retried, and sent to the on-failure destination, when the handler raises.
+    """
+    failed_message_ids = set(failed_message_ids)
+    failed = [record_id(record) for record in records
+              if is_sns_record(record) and record_id(record) in failed_message_ids]
+    if failed:
+        raise RuntimeError(f"{len(failed)} SNS notifications failed: {', '.join(failed)}")
+
+def has_sns_records(records: List[Dict[str, Any]]) -> bool:
+    """Check whether an invocation came from an SNS subscription"""
+    return any(is_sns_record(record) for record in records)
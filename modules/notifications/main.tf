@@ -40,7 +40,8 @@ resource "aws_sns_topic" "in_app_notifications" {
   })
 }
 
-# DynamoDB table for notification preferences
+# DynamoDB table for notification preferences. In document storage mode a
+# user's channels live in one item (notification_type "_preferences") as a map.
 resource "aws_dynamodb_table" "notification_preferences" {
   name           = "${var.name_prefix}-notification-preferences"
   billing_mode   = "PAY_PER_REQUEST"
@@ -139,6 +140,36 @@ resource "aws_dynamodb_table" "notification_history" {
   })
 }
 
+# DynamoDB table for push device tokens, one item per user and token
+resource "aws_dynamodb_table" "device_tokens" {
+  name           = "${var.name_prefix}-device-tokens"
+  billing_mode   = "PAY_PER_REQUEST"
+  hash_key       = "user_id"
+  range_key      = "device_token"
+
+  attribute {
+    name = "user_id"
+    type = "S"
+  }
+
+  attribute {
+    name = "device_token"
+    type = "S"
+  }
+
+  point_in_time_recovery {
+    enabled = true
+  }
+
+  server_side_encryption {
+    enabled = true
+  }
+
+  tags = merge(var.tags, {
+    Name = "${var.name_prefix}-device-tokens"
+  })
+}
+
 # SQS queues for notification processing
 resource "aws_sqs_queue" "notification_processing" {
   name                      = "${var.name_prefix}-notification-processing"
@@ -160,6 +191,110 @@ resource "aws_sqs_queue" "notification_dlq" {
   tags = var.tags
 }
 
+# Email intake queue for bulk sending (email_send_mode = "bulk")
+resource "aws_sqs_queue" "email_bulk" {
+  count                      = var.email_send_mode == "bulk" ? 1 : 0
+  name                       = "${var.name_prefix}-email-bulk"
+  visibility_timeout_seconds = 1800
+  message_retention_seconds  = 1209600
+  receive_wait_time_seconds  = 20
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.notification_dlq.arn
+    maxReceiveCount     = 3
+  })
+
+  tags = var.tags
+}
+
+resource "aws_sqs_queue_policy" "email_bulk" {
+  count     = var.email_send_mode == "bulk" ? 1 : 0
+  queue_url = aws_sqs_queue.email_bulk[0].id
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect    = "Allow"
+        Principal = { Service = "sns.amazonaws.com" }
+        Action    = "sqs:SendMessage"
+        Resource  = aws_sqs_queue.email_bulk[0].arn
+        Condition = {
+          ArnEquals = { "aws:SourceArn" = aws_sns_topic.email_notifications.arn }
+        }
+      }
+    ]
+  })
+}
+
+# SMS dispatch queue; throttled messages are sent back to it with a delay
+resource "aws_sqs_queue" "sms_dispatch" {
+  name                       = "${var.name_prefix}-sms-dispatch"
+  visibility_timeout_seconds = 1800
+  message_retention_seconds  = 345600
+  receive_wait_time_seconds  = 20
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.notification_dlq.arn
+    maxReceiveCount     = 3
+  })
+
+  tags = var.tags
+}
+
+resource "aws_sqs_queue_policy" "sms_dispatch" {
+  queue_url = aws_sqs_queue.sms_dispatch.id
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect    = "Allow"
+        Principal = { Service = "sns.amazonaws.com" }
+        Action    = "sqs:SendMessage"
+        Resource  = aws_sqs_queue.sms_dispatch.arn
+        Condition = {
+          ArnEquals = { "aws:SourceArn" = aws_sns_topic.sms_notifications.arn }
+        }
+      }
+    ]
+  })
+}
+
+# In-app delivery queue, so the processor receives notifications in batches
+resource "aws_sqs_queue" "in_app_delivery" {
+  name                       = "${var.name_prefix}-in-app-delivery"
+  visibility_timeout_seconds = 1800
+  message_retention_seconds  = 345600
+  receive_wait_time_seconds  = 20
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.notification_dlq.arn
+    maxReceiveCount     = 3
+  })
+
+  tags = var.tags
+}
+
+resource "aws_sqs_queue_policy" "in_app_delivery" {
+  queue_url = aws_sqs_queue.in_app_delivery.id
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect    = "Allow"
+        Principal = { Service = "sns.amazonaws.com" }
+        Action    = "sqs:SendMessage"
+        Resource  = aws_sqs_queue.in_app_delivery.arn
+        Condition = {
+          ArnEquals = { "aws:SourceArn" = aws_sns_topic.in_app_notifications.arn }
+        }
+      }
+    ]
+  })
+}
+
 # FIFO queue for high-priority notifications
 resource "aws_sqs_queue" "priority_notifications" {
   name                        = "${var.name_prefix}-priority-notifications.fifo"
@@ -203,6 +338,11 @@ resource "aws_lambda_function" "push_processor" {
       APNS_CERTIFICATE_ARN   = var.apns_certificate_arn
       REDIS_ENDPOINT         = var.redis_endpoint
       MAX_BATCH_SIZE         = var.max_notification_batch_size
+      PREFERENCE_CACHE_TTL   = var.preference_cache_ttl_seconds
+      PREFERENCE_STORAGE     = var.preference_storage_mode
+      HISTORY_AGGREGATED_STATUSES = join(",", var.history_aggregated_statuses)
+      DEVICE_TOKENS_TABLE    = aws_dynamodb_table.device_tokens.name
+      DEVICE_TOKEN_CACHE_TTL = var.device_token_cache_ttl_seconds
     }
   }
 
@@ -229,6 +369,13 @@ resource "aws_lambda_function" "email_processor" {
       SES_REGION       = var.aws_region
       FROM_EMAIL       = var.from_email_address
       TEMPLATE_BUCKET  = aws_s3_bucket.email_templates.bucket
+      PREFERENCE_CACHE_TTL = var.preference_cache_ttl_seconds
+      PREFERENCE_STORAGE   = var.preference_storage_mode
+      HISTORY_AGGREGATED_STATUSES = join(",", var.history_aggregated_statuses)
+      TEMPLATE_REVALIDATE_SECONDS = var.email_template_revalidate_seconds
+      EMAIL_SEND_MODE  = var.email_send_mode
+      SES_MAX_SEND_RATE = var.ses_max_send_rate_per_container
+      SES_TEMPLATE_PREFIX = var.name_prefix
     }
   }
 
@@ -254,6 +401,15 @@ resource "aws_lambda_function" "sms_processor" {
       HISTORY_TABLE    = aws_dynamodb_table.notification_history.name
       SNS_REGION       = var.aws_region
       SMS_SENDER_ID    = var.sms_sender_id
+      PREFERENCE_CACHE_TTL = var.preference_cache_ttl_seconds
+      PREFERENCE_STORAGE   = var.preference_storage_mode
+      HISTORY_AGGREGATED_STATUSES = join(",", var.history_aggregated_statuses)
+      SMS_QUEUE_URL    = aws_sqs_queue.sms_dispatch.url
+      REDIS_ENDPOINT   = var.redis_endpoint
+      SMS_MAX_WORKERS  = var.sms_max_workers
+      SMS_ACCOUNT_SEND_RATE         = var.sms_account_send_rate
+      SMS_COUNTRY_SEND_RATES        = jsonencode(var.sms_country_send_rates)
+      SMS_DEFAULT_COUNTRY_SEND_RATE = var.sms_default_country_send_rate
     }
   }
 
@@ -279,6 +435,9 @@ resource "aws_lambda_function" "in_app_processor" {
       HISTORY_TABLE    = aws_dynamodb_table.notification_history.name
       REDIS_ENDPOINT   = var.redis_endpoint
       WEBSOCKET_API_ENDPOINT = var.websocket_api_endpoint
+      PREFERENCE_CACHE_TTL   = var.preference_cache_ttl_seconds
+      PREFERENCE_STORAGE     = var.preference_storage_mode
+      HISTORY_AGGREGATED_STATUSES = join(",", var.history_aggregated_statuses)
     }
   }
 
@@ -311,6 +470,9 @@ resource "aws_lambda_event_source_mapping" "notification_processing" {
   batch_size       = 10
   
   maximum_batching_window_in_seconds = 5
+
+  # Only failed records are returned to the queue
+  function_response_types = ["ReportBatchItemFailures"]
 }
 
 resource "aws_lambda_event_source_mapping" "priority_notifications" {
@@ -319,6 +481,43 @@ resource "aws_lambda_event_source_mapping" "priority_notifications" {
   batch_size       = 5
   
   maximum_batching_window_in_seconds = 1
+
+  # Only failed records are returned to the queue
+  function_response_types = ["ReportBatchItemFailures"]
+}
+
+resource "aws_lambda_event_source_mapping" "email_bulk" {
+  count            = var.email_send_mode == "bulk" ? 1 : 0
+  event_source_arn = aws_sqs_queue.email_bulk[0].arn
+  function_name    = aws_lambda_function.email_processor.arn
+  batch_size       = var.email_bulk_batch_size
+
+  maximum_batching_window_in_seconds = 5
+
+  # Only failed records are returned to the queue
+  function_response_types = ["ReportBatchItemFailures"]
+}
+
+resource "aws_lambda_event_source_mapping" "sms_dispatch" {
+  event_source_arn = aws_sqs_queue.sms_dispatch.arn
+  function_name    = aws_lambda_function.sms_processor.arn
+  batch_size       = var.sms_batch_size
+
+  maximum_batching_window_in_seconds = 1
+
+  # Only failed records are returned to the queue
+  function_response_types = ["ReportBatchItemFailures"]
+}
+
+resource "aws_lambda_event_source_mapping" "in_app_delivery" {
+  event_source_arn = aws_sqs_queue.in_app_delivery.arn
+  function_name    = aws_lambda_function.in_app_processor.arn
+  batch_size       = var.in_app_batch_size
+
+  maximum_batching_window_in_seconds = 1
+
+  # Only failed records are returned to the queue
+  function_response_types = ["ReportBatchItemFailures"]
 }
 
 # SNS topic subscriptions for Lambda triggers
@@ -328,22 +527,54 @@ resource "aws_sns_topic_subscription" "push_notifications" {
   endpoint  = aws_lambda_function.push_processor.arn
 }
 
+# In bulk mode emails go through a queue so the processor receives them in
+# batches it can group by template
 resource "aws_sns_topic_subscription" "email_notifications" {
-  topic_arn = aws_sns_topic.email_notifications.arn
-  protocol  = "lambda"
-  endpoint  = aws_lambda_function.email_processor.arn
+  topic_arn            = aws_sns_topic.email_notifications.arn
+  protocol             = var.email_send_mode == "bulk" ? "sqs" : "lambda"
+  endpoint             = var.email_send_mode == "bulk" ? aws_sqs_queue.email_bulk[0].arn : aws_lambda_function.email_processor.arn
+  raw_message_delivery = var.email_send_mode == "bulk"
 }
 
+# SMS go through a queue so throttled messages can be sent again later
 resource "aws_sns_topic_subscription" "sms_notifications" {
-  topic_arn = aws_sns_topic.sms_notifications.arn
-  protocol  = "lambda"
-  endpoint  = aws_lambda_function.sms_processor.arn
+  topic_arn            = aws_sns_topic.sms_notifications.arn
+  protocol             = "sqs"
+  endpoint             = aws_sqs_queue.sms_dispatch.arn
+  raw_message_delivery = true
 }
 
+# In-app notifications go through a queue so Redis delivery is pipelined
+# per batch and failed deliveries are retried
 resource "aws_sns_topic_subscription" "in_app_notifications" {
-  topic_arn = aws_sns_topic.in_app_notifications.arn
-  protocol  = "lambda"
-  endpoint  = aws_lambda_function.in_app_processor.arn
+  topic_arn            = aws_sns_topic.in_app_notifications.arn
+  protocol             = "sqs"
+  endpoint             = aws_sqs_queue.in_app_delivery.arn
+  raw_message_delivery = true
+}
+
+# SNS invokes the processors asynchronously: an invocation that raises is
+# retried twice, then its event goes to the notification DLQ
+resource "aws_lambda_function_event_invoke_config" "push_processor" {
+  function_name          = aws_lambda_function.push_processor.function_name
+  maximum_retry_attempts = 2
+
+  destination_config {
+    on_failure {
+      destination = aws_sqs_queue.notification_dlq.arn
+    }
+  }
+}
+
+resource "aws_lambda_function_event_invoke_config" "email_processor" {
+  function_name          = aws_lambda_function.email_processor.function_name
+  maximum_retry_attempts = 2
+
+  destination_config {
+    on_failure {
+      destination = aws_sqs_queue.notification_dlq.arn
+    }
+  }
 }
 
 # Lambda permissions for SNS
@@ -371,13 +602,6 @@ resource "aws_lambda_permission" "allow_sns_sms" {
   source_arn    = aws_sns_topic.sms_notifications.arn
 }
 
-resource "aws_lambda_permission" "allow_sns_in_app" {
-  statement_id  = "AllowExecutionFromSNS"
-  action        = "lambda:InvokeFunction"
-  function_name = aws_lambda_function.in_app_processor.function_name
-  principal     = "sns.amazonaws.com"
-  source_arn    = aws_sns_topic.in_app_notifications.arn
-}
 
 # IAM role for notification Lambda functions
 resource "aws_iam_role" "notification_lambda" {
@@ -410,14 +634,18 @@ resource "aws_iam_role_policy" "notification_lambda" {
         Effect = "Allow"
         Action = [
           "dynamodb:GetItem",
+          "dynamodb:BatchGetItem",
           "dynamodb:PutItem",
+          "dynamodb:BatchWriteItem",
           "dynamodb:UpdateItem",
+          "dynamodb:DeleteItem",
           "dynamodb:Query",
           "dynamodb:Scan"
         ]
         Resource = [
           aws_dynamodb_table.notification_preferences.arn,
           aws_dynamodb_table.notification_history.arn,
+          aws_dynamodb_table.device_tokens.arn,
           "${aws_dynamodb_table.notification_preferences.arn}/index/*",
           "${aws_dynamodb_table.notification_history.arn}/index/*"
         ]
@@ -434,7 +662,9 @@ resource "aws_iam_role_policy" "notification_lambda" {
         Action = [
           "ses:SendEmail",
           "ses:SendTemplatedEmail",
-          "ses:SendRawEmail"
+          "ses:SendBulkTemplatedEmail",
+          "ses:SendRawEmail",
+          "ses:CreateTemplate"
         ]
         Resource = "*"
       },
@@ -453,12 +683,14 @@ resource "aws_iam_role_policy" "notification_lambda" {
           "sqs:GetQueueAttributes",
           "sqs:SendMessage"
         ]
-        Resource = [
+        Resource = concat([
           aws_sqs_queue.notification_processing.arn,
           aws_sqs_queue.priority_notifications.arn,
           aws_sqs_queue.notification_dlq.arn,
-          aws_sqs_queue.priority_dlq.arn
-        ]
+          aws_sqs_queue.priority_dlq.arn,
+          aws_sqs_queue.sms_dispatch.arn,
+          aws_sqs_queue.in_app_delivery.arn
+        ], aws_sqs_queue.email_bulk[*].arn)
       }
     ]
   })
@@ -589,6 +821,10 @@ resource "aws_lambda_function" "notification_api" {
     variables = {
       PREFERENCES_TABLE = aws_dynamodb_table.notification_preferences.name
       HISTORY_TABLE    = aws_dynamodb_table.notification_history.name
+      PREFERENCE_STORAGE = var.preference_storage_mode
+      DEVICE_TOKENS_TABLE = aws_dynamodb_table.device_tokens.name
+      DEVICE_TOKEN_CACHE_TTL = var.device_token_cache_ttl_seconds
+      REDIS_ENDPOINT     = var.redis_endpoint
     }
   }
 
@@ -628,6 +864,18 @@ resource "aws_apigatewayv2_route" "notification_history" {
   target    = "integrations/${aws_apigatewayv2_integration.notification_api.id}"
 }
 
+resource "aws_apigatewayv2_route" "register_device" {
+  api_id    = aws_apigatewayv2_api.notification_api.id
+  route_key = "POST /devices/{user_id}"
+  target    = "integrations/${aws_apigatewayv2_integration.notification_api.id}"
+}
+
+resource "aws_apigatewayv2_route" "unregister_device" {
+  api_id    = aws_apigatewayv2_api.notification_api.id
+  route_key = "DELETE /devices/{user_id}/{device_token}"
+  target    = "integrations/${aws_apigatewayv2_integration.notification_api.id}"
+}
+
 # API stage
 resource "aws_apigatewayv2_stage" "notification_api" {
   api_id      = aws_apigatewayv2_api.notification_api.id
@@ -678,6 +926,34 @@ data "archive_file" "push_processor" {
     content  = file("${path.module}/lambda/push_processor.py")
     filename = "push_processor.py"
   }
+  source {
+    content  = file("${path.module}/lambda/sqs_batch.py")
+    filename = "sqs_batch.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/preference_cache.py")
+    filename = "preference_cache.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/preference_store.py")
+    filename = "preference_store.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/history_writer.py")
+    filename = "history_writer.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/device_tokens.py")
+    filename = "device_tokens.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/fcm.py")
+    filename = "fcm.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/redis_client.py")
+    filename = "redis_client.py"
+  }
 }
 
 data "archive_file" "email_processor" {
@@ -687,6 +963,30 @@ data "archive_file" "email_processor" {
     content  = file("${path.module}/lambda/email_processor.py")
     filename = "email_processor.py"
   }
+  source {
+    content  = file("${path.module}/lambda/sqs_batch.py")
+    filename = "sqs_batch.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/preference_cache.py")
+    filename = "preference_cache.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/preference_store.py")
+    filename = "preference_store.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/history_writer.py")
+    filename = "history_writer.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/email_templates.py")
+    filename = "email_templates.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/email_bulk.py")
+    filename = "email_bulk.py"
+  }
 }
 
 data "archive_file" "sms_processor" {
@@ -696,6 +996,30 @@ data "archive_file" "sms_processor" {
     content  = file("${path.module}/lambda/sms_processor.py")
     filename = "sms_processor.py"
   }
+  source {
+    content  = file("${path.module}/lambda/sqs_batch.py")
+    filename = "sqs_batch.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/preference_cache.py")
+    filename = "preference_cache.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/preference_store.py")
+    filename = "preference_store.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/history_writer.py")
+    filename = "history_writer.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/redis_client.py")
+    filename = "redis_client.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/sms_dispatch.py")
+    filename = "sms_dispatch.py"
+  }
 }
 
 data "archive_file" "in_app_processor" {
@@ -705,6 +1029,26 @@ data "archive_file" "in_app_processor" {
     content  = file("${path.module}/lambda/in_app_processor.py")
     filename = "in_app_processor.py"
   }
+  source {
+    content  = file("${path.module}/lambda/sqs_batch.py")
+    filename = "sqs_batch.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/preference_cache.py")
+    filename = "preference_cache.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/preference_store.py")
+    filename = "preference_store.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/history_writer.py")
+    filename = "history_writer.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/redis_client.py")
+    filename = "redis_client.py"
+  }
 }
 
 data "archive_file" "notification_scheduler" {
@@ -723,4 +1067,16 @@ data "archive_file" "notification_api" {
     content  = file("${path.module}/lambda/notification_api.py")
     filename = "notification_api.py"
   }
+  source {
+    content  = file("${path.module}/lambda/preference_store.py")
+    filename = "preference_store.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/device_tokens.py")
+    filename = "device_tokens.py"
+  }
+  source {
+    content  = file("${path.module}/lambda/redis_client.py")
+    filename = "redis_client.py"
+  }
 }
\ No newline at end of file
@@ -28,6 +28,11 @@ output "notification_preferences_table_arn" {
   value       = aws_dynamodb_table.notification_preferences.arn
 }
 
+output "device_tokens_table_name" {
+  description = "DynamoDB table name for push device tokens"
+  value       = aws_dynamodb_table.device_tokens.name
+}
+
 output "notification_history_table_name" {
   description = "DynamoDB table name for notification history"
   value       = aws_dynamodb_table.notification_history.name
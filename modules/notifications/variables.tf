@@ -78,6 +78,100 @@ variable "lambda_concurrent_executions" {
   default     = 50
 }
 
+variable "preference_cache_ttl_seconds" {
+  description = "Seconds a processor container caches a user's notification preferences"
+  type        = number
+  default     = 60
+}
+
+variable "email_template_revalidate_seconds" {
+  description = "Seconds the email processor serves a cached template before revalidating its ETag with S3"
+  type        = number
+  default     = 60
+}
+
+variable "email_send_mode" {
+  description = "Send each email on its own ('single') or batch them through a queue and send per template with SES bulk templated email ('bulk')"
+  type        = string
+  default     = "single"
+
+  validation {
+    condition     = contains(["single", "bulk"], var.email_send_mode)
+    error_message = "Email send mode must be either 'single' or 'bulk'."
+  }
+}
+
+variable "email_bulk_batch_size" {
+  description = "Emails per email processor invocation in bulk mode"
+  type        = number
+  default     = 100
+}
+
+variable "ses_max_send_rate_per_container" {
+  description = "SES sends per second allowed to each email processor container (account send rate divided by concurrency, 0 to disable)"
+  type        = number
+  default     = 14
+}
+
+variable "device_token_cache_ttl_seconds" {
+  description = "Seconds a user's push device tokens stay cached in Redis"
+  type        = number
+  default     = 300
+}
+
+variable "sms_batch_size" {
+  description = "SMS per SMS processor invocation"
+  type        = number
+  default     = 50
+}
+
+variable "in_app_batch_size" {
+  description = "In-app notifications per in-app processor invocation"
+  type        = number
+  default     = 100
+}
+
+variable "sms_max_workers" {
+  description = "SMS sent concurrently by each SMS processor container"
+  type        = number
+  default     = 10
+}
+
+variable "sms_account_send_rate" {
+  description = "SMS per second allowed for the whole account, shared by all containers through Redis"
+  type        = number
+  default     = 20
+}
+
+variable "sms_country_send_rates" {
+  description = "SMS per second per destination country, keyed by E.164 country prefix (e.g. { \"1\" = 10 })"
+  type        = map(number)
+  default     = {}
+}
+
+variable "sms_default_country_send_rate" {
+  description = "SMS per second for destination countries not listed in sms_country_send_rates"
+  type        = number
+  default     = 10
+}
+
+variable "history_aggregated_statuses" {
+  description = "Notification statuses recorded as hourly counters instead of one history row each (e.g. [\"skipped\"])"
+  type        = list(string)
+  default     = []
+}
+
+variable "preference_storage_mode" {
+  description = "Store notification preferences as one document item per user ('document') or one item per type ('rows')"
+  type        = string
+  default     = "document"
+
+  validation {
+    condition     = contains(["document", "rows"], var.preference_storage_mode)
+    error_message = "Preference storage mode must be either 'document' or 'rows'."
+  }
+}
+
 # Monitoring configuration
 variable "alarm_actions" {
   description = "SNS topic ARNs for alarm actions"
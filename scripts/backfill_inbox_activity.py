@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Backfill last_activity onto user_conversations rows for InboxIndex.
+
+InboxIndex (modules/chat/main.tf) is keyed on last_activity, which message
+processing only writes on new activity, so rows that predate it are missing
+from get_inbox until someone posts in the conversation. This scans
+user_conversations for rows without last_activity and copies the
+conversation's last_activity and last_message_preview onto them (created_at
+for conversations without any activity). The writes use the same condition
+as message processing, so rows updated meanwhile are left alone and the
+script can be re-run safely.
+
+Run once after applying the InboxIndex change:
+
+    python3 scripts/backfill_inbox_activity.py --name-prefix <prefix> [--dry-run]
+"""
+import argparse
+import os
+import sys
+import time
+
+import boto3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules', 'chat', 'lambda'))
+
+from inbox import update_inbox_row  # noqa: E402
+
+# BatchGetItem accepts at most 100 keys per call
+BATCH_GET_MAX_KEYS = 100
+BATCH_GET_MAX_RETRIES = 5
+
+def rows_without_activity(user_conversations_table):
+    """Page through the keys of user_conversations rows without last_activity"""
+    scan_kwargs = {
+        'ProjectionExpression': 'user_id, conversation_id',
+        'FilterExpression': 'attribute_not_exists(last_activity)'
+    }
+
+    while True:
+        response = user_conversations_table.scan(**scan_kwargs)
+        yield from response.get('Items', [])
+
+        if 'LastEvaluatedKey' not in response:
+            return
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def load_activity(dynamodb, conversations_table_name, conversation_ids):
+    """
+    Latest activity of conversations with BatchGetItem, as
+    conversation_id -> (timestamp, preview)
+    """
+    activity = {}
+    conversation_ids = list(conversation_ids)
+
+    for i in range(0, len(conversation_ids), BATCH_GET_MAX_KEYS):
+        keys = [{'conversation_id': conversation_id} for conversation_id in conversation_ids[i:i + BATCH_GET_MAX_KEYS]]
+
+        attempt = 0
+        while keys:
+            response = dynamodb.batch_get_item(RequestItems={
+                conversations_table_name: {
+                    'Keys': keys,
+                    'ProjectionExpression': 'conversation_id, last_activity, last_message_preview, created_at'
+                }
+            })
+
+            for item in response.get('Responses', {}).get(conversations_table_name, []):
+                timestamp = item.get('last_activity') or item.get('created_at')
+                if timestamp:
+                    activity[item['conversation_id']] = (timestamp, item.get('last_message_preview', ''))
+
+            keys = response.get('UnprocessedKeys', {}).get(conversations_table_name, {}).get('Keys', [])
+            if not keys:
+                break
+
+            attempt += 1
+            if attempt > BATCH_GET_MAX_RETRIES:
+                print(f"Could not read {len(keys)} conversations, re-run to retry them")
+                break
+
+            # Exponential backoff: 50ms, 100ms, 200ms, ... capped at 2s
+            time.sleep(min(0.05 * (2 ** (attempt - 1)), 2))
+
+    return activity
+
+def backfill(dynamodb, user_conversations_table, conversations_table_name, rows, dry_run):
+    """Copy conversation activity onto one page of rows. Returns (updated, skipped)."""
+    activity = load_activity(dynamodb, conversations_table_name, {row['conversation_id'] for row in rows})
+
+    updated = skipped = 0
+    for row in rows:
+        if row['conversation_id'] not in activity:
+            skipped += 1
+            continue
+
+        timestamp, preview = activity[row['conversation_id']]
+        if dry_run or update_inbox_row(
+            user_conversations_table, row['user_id'], row['conversation_id'], timestamp, preview
+        ):
+            updated += 1
+        else:
+            skipped += 1
+
+    return updated, skipped
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--name-prefix', required=True, help='name_prefix the chat module was applied with')
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('--dry-run', action='store_true', help='count the rows without writing them')
+    args = parser.parse_args()
+
+    dynamodb = boto3.resource('dynamodb')
+    user_conversations_table = dynamodb.Table(f"{args.name_prefix}-user-conversations")
+    conversations_table_name = f"{args.name_prefix}-conversations"
+
+    updated = skipped = 0
+    page = []
+    for row in rows_without_activity(user_conversations_table):
+        page.append(row)
+        if len(page) >= args.page_size:
+            page_updated, page_skipped = backfill(dynamodb, user_conversations_table, conversations_table_name, page, args.dry_run)
+            updated, skipped = updated + page_updated, skipped + page_skipped
+            page = []
+            print(f"{updated} rows backfilled, {skipped} skipped")
+
+    if page:
+        page_updated, page_skipped = backfill(dynamodb, user_conversations_table, conversations_table_name, page, args.dry_run)
+        updated, skipped = updated + page_updated, skipped + page_skipped
+
+    print(f"Done: {updated} rows {'to backfill' if args.dry_run else 'backfilled'}, {skipped} skipped")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Estimate the DynamoDB capacity saved by compressing large chat message
+bodies (modules/chat/lambda/message_codec.py).
+
+Builds a seeded synthetic corpus shaped like our chat traffic (mostly short
+texts, some paragraphs, pasted logs/code and rich JSON payloads), sizes each
+chat_messages item with and without the codec using DynamoDB's item size
+rules, and reports write units (1 KB per WCU) and query read units
+(4 KB per RCU, eventually consistent, 50-message history pages).
+
+    python3 scripts/benchmark_message_compression.py [--messages 100000] [--threshold 512]
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules', 'chat', 'lambda'))
+
+import message_codec  # noqa: E402
+
+WORDS = (
+    'the meeting moved to tomorrow can you send the latest deck thanks lol ok sounds good '
+    'shipping release build now deploy pipeline failed again on staging after the migration '
+    'customer reported latency spikes in the eu region please check the dashboard before standup '
+    'great work everyone see you at the offsite bring laptops and chargers'
+).split()
+
+LOG_LINE = '2026-10-17T12:{:02d}:{:02d}.{:03d}Z ERROR [worker-{}] request_id={} upstream timeout after 3000ms path=/api/v2/conversations/{}/messages status=504'
+
+# Share of messages by kind, roughly matching production traffic
+CORPUS_MIX = [
+    ('short_text', 0.78),
+    ('paragraph', 0.14),
+    ('pasted_log', 0.03),
+    ('rich_payload', 0.05),
+]
+
+HISTORY_PAGE_SIZE = 50
+
+def words(rng, count):
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+def make_content(rng, kind):
+    if kind == 'short_text':
+        return words(rng, rng.randint(1, 20))
+    if kind == 'paragraph':
+        return '\n\n'.join(words(rng, rng.randint(40, 120)) for _ in range(rng.randint(1, 4)))
+    if kind == 'pasted_log':
+        return '\n'.join(
+            LOG_LINE.format(rng.randint(0, 59), rng.randint(0, 59), rng.randint(0, 999),
+                            rng.randint(1, 32), uuid.UUID(int=rng.getrandbits(128)), rng.randint(1, 10 ** 6))
+            for _ in range(rng.randint(10, 80))
+        )
+    return {
+        'type': 'link_preview',
+        'text': words(rng, rng.randint(5, 30)),
+        'attachments': [
+            {
+                'url': f"https://cdn.example.com/media/{uuid.UUID(int=rng.getrandbits(128))}.jpg",
+                'title': words(rng, rng.randint(3, 10)),
+                'description': words(rng, rng.randint(20, 60)),
+                'width': 1280,
+                'height': 720,
+            }
+            for _ in range(rng.randint(1, 4))
+        ],
+        'mentions': [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(rng.randint(0, 5))],
+    }
+
+def attribute_size(value):
+    """Size of an attribute value under DynamoDB's item size rules"""
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, bool) or value is None:
+        return 1
+    if isinstance(value, (int, float)):
+        return math.ceil(len(str(abs(value)).replace('.', '')) / 2) + 1
+    if isinstance(value, dict):
+        return 3 + sum(len(name.encode('utf-8')) + attribute_size(item) + 1 for name, item in value.items())
+    if isinstance(value, list):
+        return 3 + sum(attribute_size(item) + 1 for item in value)
+    raise TypeError(type(value))
+
+def item_size(item):
+    return sum(len(name.encode('utf-8')) + attribute_size(value) for name, value in item.items())
+
+def build_item(rng, index, content, encode):
+    timestamp = f"2026-10-17T12:00:{index % 60:02d}.{index:06d}+00:00"
+    message_id = str(uuid.UUID(int=rng.getrandbits(128)))
+    item = {
+        'conversation_id': str(uuid.UUID(int=rng.getrandbits(128))),
+        'timestamp_message_id': f"{timestamp}#{message_id}",
+        'user_id': str(uuid.UUID(int=rng.getrandbits(128))),
+        'message_type': 'text',
+        'timestamp': timestamp,
+        'message_id': message_id,
+    }
+    item.update(message_codec.encode_content(content) if encode else {'content': content})
+    return item
+
+def capacity(sizes):
+    wcu = sum(math.ceil(size / 1024) for size in sizes)
+    rcu = sum(
+        math.ceil(sum(sizes[i:i + HISTORY_PAGE_SIZE]) / 4096) * 0.5
+        for i in range(0, len(sizes), HISTORY_PAGE_SIZE)
+    )
+    return wcu, rcu
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--threshold', type=int, default=message_codec.COMPRESSION_THRESHOLD_BYTES)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    message_codec.COMPRESSION_THRESHOLD_BYTES = args.threshold
+    rng = random.Random(args.seed)
+    kinds = [kind for kind, _ in CORPUS_MIX]
+    weights = [weight for _, weight in CORPUS_MIX]
+    corpus = [(kind, make_content(rng, kind)) for kind in rng.choices(kinds, weights, k=args.messages)]
+
+    # Same item IDs for both runs, only the body encoding differs
+    plain, encoded = [], []
+    encode_seconds = decode_seconds = 0.0
+    for index, (_, content) in enumerate(corpus):
+        plain.append(item_size(build_item(random.Random(index), index, content, encode=False)))
+
+        started = time.perf_counter()
+        item = build_item(random.Random(index), index, content, encode=True)
+        encode_seconds += time.perf_counter() - started
+        encoded.append(item_size(item))
+
+        started = time.perf_counter()
+        assert message_codec.decode_content(item) == content
+        decode_seconds += time.perf_counter() - started
+
+    print(f"{args.messages} messages, compression threshold {args.threshold} bytes")
+    print(f"{'kind':<14}{'share':>8}{'avg bytes':>12}{'avg stored':>12}")
+    for kind in kinds:
+        positions = [i for i, (k, _) in enumerate(corpus) if k == kind]
+        if positions:
+            print(f"{kind:<14}{len(positions) / len(corpus):>8.1%}"
+                  f"{sum(plain[i] for i in positions) / len(positions):>12.0f}"
+                  f"{sum(encoded[i] for i in positions) / len(positions):>12.0f}")
+
+    plain_wcu, plain_rcu = capacity(plain)
+    encoded_wcu, encoded_rcu = capacity(encoded)
+    print(f"storage  {sum(plain) / 2 ** 20:10.1f} MiB -> {sum(encoded) / 2 ** 20:10.1f} MiB"
+          f"  ({1 - sum(encoded) / sum(plain):.1%} saved)")
+    print(f"writes   {plain_wcu:10d} WCU -> {encoded_wcu:10d} WCU  ({1 - encoded_wcu / plain_wcu:.1%} saved)")
+    print(f"reads    {plain_rcu:10.1f} RCU -> {encoded_rcu:10.1f} RCU  ({1 - encoded_rcu / plain_rcu:.1%} saved)"
+          f"  [{HISTORY_PAGE_SIZE}-message pages]")
+    print(f"codec cost {encode_seconds / len(corpus) * 1e6:.1f} us encode, "
+          f"{decode_seconds / len(corpus) * 1e6:.1f} us decode per message")
+
+if __name__ == '__main__':
+    main()